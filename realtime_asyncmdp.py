@@ -1,56 +1,334 @@
-dimport multiprocessing as mp
+import multiprocessing as mp
 import os
 import queue
 import time
 
 import gymnasium as gym
+import numpy as np
+
+from src.latency import Histogram, LatencyRecorder
+from src.shared_memory_ring import SharedMemoryRing, TransitionMailbox, space_dtype
+from src.wakeup import WAIT_POLICIES, Doorbell, wait_until
 
 
 def getenv_as_int(name, default: int = 0):
     return int(os.getenv(name, str(default)))
 
 
+OVERRUN_POLICIES = ("catch_up", "skip")
+CHANNELS = ("queue", "mailbox", "ring")
+
+
+def payload_dtype(observation_space) -> np.dtype:
+    """
+    Fixed binary layout of a payload on the "ring" channel. The info dict is not part of
+        it, `has_info` says whether it was sent on the side channel.
+    """
+    observation_dtype, observation_shape = space_dtype(observation_space)
+    return np.dtype(
+        [
+            ("observation", observation_dtype, observation_shape),
+            ("reward", np.float64),
+            ("terminated", np.bool_),
+            ("truncated", np.bool_),
+            ("has_info", np.bool_),
+            ("total_reward", np.float64),
+            ("index", np.uint64),
+            ("sent_at", np.float64),
+        ]
+    )
+
+
+class RateMonitor:
+    """
+    Achieved rate and timing error of a loop that runs on a fixed schedule.
+    `tick` is called when a scheduled tick actually runs, `lateness` is how long after
+        its scheduled time that was, `jitter` the standard deviation of the time
+        between ticks.
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self._start_time = None
+        self._last_time = None
+        self.num_ticks = 0
+        self.num_skipped = 0
+        self._lateness = Histogram()
+        # Welford's running variance of the intervals between ticks
+        self._num_intervals = 0
+        self._mean_interval = 0.0
+        self._m2_interval = 0.0
+
+    def tick(self, now: float, scheduled: float):
+        if self._start_time is None:
+            self._start_time = now
+        else:
+            interval = now - self._last_time
+            self._num_intervals += 1
+            delta = interval - self._mean_interval
+            self._mean_interval += delta / self._num_intervals
+            self._m2_interval += delta * (interval - self._mean_interval)
+        self._last_time = now
+        self._lateness.record(max(now - scheduled, 0.0))
+        self.num_ticks += 1
+
+    def summary(self, reset: bool = True) -> dict:
+        lateness = self._lateness.summary()
+        summary = {
+            "achieved_hz": (
+                self._num_intervals / (self._last_time - self._start_time)
+                if self._num_intervals
+                else float("nan")
+            ),
+            "jitter": (
+                (self._m2_interval / self._num_intervals) ** 0.5
+                if self._num_intervals
+                else float("nan")
+            ),
+            "lateness_p50": lateness["p50"],
+            "lateness_p99": lateness["p99"],
+            "ticks": self.num_ticks,
+            "skipped_ticks": self.num_skipped,
+        }
+        if reset:
+            self.reset()
+        return summary
+
+
 class AsyncWrapper:
-    def __init__(self, env_name, data_rate=2, worker_queue_size=-1, main_queue_size=-1):
+    def __init__(
+        self,
+        env_name,
+        data_rate=2,
+        worker_queue_size=-1,
+        main_queue_size=-1,
+        wait_policy="hybrid",
+        spin_budget=1e-3,
+        record_latency=False,
+        overrun_policy="catch_up",
+        channel="queue",
+    ):
+        """
+        See `Worker` for `wait_policy`, `spin_budget` and `overrun_policy`.
+        `channel` carries payloads from the worker to the agent: "queue" delivers every
+            payload in order through `main_buffer`, and drops (counted in `dropped`) when
+            it is full. "mailbox" is a shared-memory slot holding the latest payload,
+            `step` returns the freshest one with the rewards of the payloads it
+            overwrote summed in, see `shared_memory_ring.TransitionMailbox`.
+            `overwritten` counts the payloads the agent never saw, `dropped` the episode
+            ends it never saw. "ring" delivers every payload in order like "queue", as
+            fixed-size binary records in shared memory (see `payload_dtype`) that are
+            never pickled, `dropped` counts the ones that didn't fit in the
+            `main_queue_size` records. Non-empty infos, e.g. at the end of an episode,
+            follow on the `info_buffer` side channel.
+        With `record_latency`, the agent's time between steps (`inference`), the round
+            trip, the worker-to-agent `transport` time, the env step and the number of
+            ticks each action was repeated for are recorded in histograms, and the last
+            payload of each episode carries their percentiles in `info["latency"]`.
+        """
+        assert channel in CHANNELS, f"unknown channel {channel}"
         # Buffer to receive actions
         self.worker_buffer = mp.Queue(maxsize=worker_queue_size)
         print("Worker Buffer Size:", worker_queue_size)
 
+        self.env = gym.make(env_name)
+
         # Buffer to send observations, rewards, and done flags
-        self.main_buffer = mp.Queue(maxsize=main_queue_size)
-        print("Main Buffer Size:", main_queue_size)
+        self.main_buffer = None
+        self.mailbox = None
+        self.ring = None
+        self.info_buffer = None
+        self.doorbell = None
+        if channel == "queue":
+            self.main_buffer = mp.Queue(maxsize=main_queue_size)
+            print("Main Buffer Size:", main_queue_size)
+        elif channel == "mailbox":
+            self.mailbox = TransitionMailbox(self.env.observation_space)
+            self.doorbell = Doorbell()
+        else:
+            capacity = main_queue_size if main_queue_size > 0 else 1024
+            self.ring = SharedMemoryRing(
+                payload_dtype(self.env.observation_space), capacity
+            )
+            self.info_buffer = mp.Queue()
+            self.doorbell = Doorbell()
+        self._queue_dropped = mp.Value("Q", 0, lock=False)
+        self._wait_policy = wait_policy
+        self._spin_budget = spin_budget
 
         # Metrics Data
         self.metrics_per_episode_buffer = mp.Queue()
 
-        self.env = gym.make(env_name)
         self.data_rate = data_rate
+        self.latency = LatencyRecorder() if record_latency else None
+        self._last_receive_time = None
         self.worker = Worker(
             worker_buffer=self.worker_buffer,
             main_buffer=self.main_buffer,
             metrics_per_episode_buffer=self.metrics_per_episode_buffer,
             env=self.env,
             data_rate=self.data_rate,
+            wait_policy=wait_policy,
+            spin_budget=spin_budget,
+            record_latency=record_latency,
+            overrun_policy=overrun_policy,
+            mailbox=self.mailbox,
+            ring=self.ring,
+            info_buffer=self.info_buffer,
+            doorbell=self.doorbell,
+            queue_dropped=self._queue_dropped,
         )
 
+    @property
+    def overwritten(self) -> int:
+        return self.mailbox.overwritten if self.mailbox is not None else 0
+
+    @property
+    def dropped(self) -> int:
+        if self.mailbox is not None:
+            return self.mailbox.dropped
+        if self.ring is not None:
+            return self.ring.dropped
+        return self._queue_dropped.value
+
     def start(self):
         self.worker.daemon = True  # Set worker as daemon
         self.worker.start()
 
     def step(self, action):
+        send_time = time.monotonic()
         self.worker_buffer.put(action)
-        out = self.main_buffer.get()
+        if self.mailbox is not None:
+            out = self._receive_latest()
+        elif self.ring is not None:
+            out = self._receive_record()
+        else:
+            out = self.main_buffer.get()
+        if self.latency is not None:
+            self._record_latency(out, send_time)
         return out
 
+    def _wait_for_payload(self, buffer):
+        # `spin_budget` is sized to land on the worker's ticks, the agent waits for an
+        # event instead and only spins briefly before sleeping on the doorbell.
+        wait_until(
+            lambda: len(buffer) > 0,
+            self.doorbell,
+            policy=self._wait_policy,
+            spin_budget=min(self._spin_budget, 50e-6),
+        )
+
+    def _receive_record(self):
+        self._wait_for_payload(self.ring)
+        record = self.ring.pop(0)
+        info = {"total_reward": float(record["total_reward"])}
+        if record["sent_at"]:
+            info["sent_at"] = float(record["sent_at"])
+        if record["has_info"]:
+            # Infos of records that were dropped are skipped.
+            index = int(record["index"])
+            while True:
+                info_index, side_info = self.info_buffer.get()
+                if info_index == index:
+                    info.update(side_info)
+                    break
+        return {
+            "observation": record["observation"],
+            "reward": float(record["reward"]),
+            "terminated": bool(record["terminated"]),
+            "truncated": bool(record["truncated"]),
+            "info": info,
+        }
+
+    def _receive_latest(self):
+        self._wait_for_payload(self.mailbox)
+        (
+            observation,
+            reward,
+            terminated,
+            truncated,
+            side_info,
+            sent_at,
+            total_reward,
+        ) = self.mailbox.get()
+        info = {"total_reward": total_reward}
+        if sent_at:
+            info["sent_at"] = sent_at
+        info.update(side_info)
+        return {
+            "observation": observation,
+            "reward": reward,
+            "terminated": terminated,
+            "truncated": truncated,
+            "info": info,
+        }
+
+    def _record_latency(self, payload, send_time):
+        receive_time = time.monotonic()
+        if self._last_receive_time is not None:
+            self.latency.record("inference", send_time - self._last_receive_time)
+        self._last_receive_time = receive_time
+        self.latency.record("round_trip", receive_time - send_time)
+
+        info = payload["info"]
+        # CLOCK_MONOTONIC is system-wide, so the worker's timestamp is comparable
+        sent_at = info.pop("sent_at", None)
+        if sent_at is not None:
+            self.latency.record("transport", receive_time - sent_at)
+        if payload["terminated"] or payload["truncated"]:
+            info["latency"] = {**info.get("latency", {}), **self.latency.summary()}
+
     def close(self):
         self.env.close()
+        if self.mailbox is not None:
+            self.mailbox.close()
+        if self.ring is not None:
+            self.ring.close()
+        if self.doorbell is not None:
+            self.doorbell.close()
 
 
 class Worker(mp.Process):
     def __init__(
-        self, worker_buffer, main_buffer, metrics_per_episode_buffer, env, data_rate=2
+        self,
+        worker_buffer,
+        main_buffer,
+        metrics_per_episode_buffer,
+        env,
+        data_rate=2,
+        wait_policy="hybrid",
+        spin_budget=1e-3,
+        record_latency=False,
+        overrun_policy="catch_up",
+        mailbox=None,
+        ring=None,
+        info_buffer=None,
+        doorbell=None,
+        queue_dropped=None,
     ):
+        """
+        Steps `env` on absolute ticks `1 / data_rate` apart, so the time spent stepping,
+            sending and resetting doesn't stretch the period.
+        `wait_policy` decides how the worker waits for the next tick while collecting
+            actions: "spin" polls the queue, "block" sleeps in `Queue.get`, which can
+            wake up late by the OS timer slack, "hybrid" sleeps until `spin_budget`
+            seconds before the tick and polls from there.
+        `overrun_policy` decides what happens when a tick is missed because a step took
+            too long: "catch_up" runs the missed ticks back to back, "skip" drops them
+            and waits for the next tick on the schedule.
+        The last payload of each episode reports the achieved rate, jitter and tick
+            lateness in `info["rate"]`.
+        Payloads go to `mailbox` or `ring` (ringing `doorbell`) if given, else to
+            `main_buffer`, counting the ones that don't fit in `queue_dropped`. With a
+            `ring`, non-empty infos go to `info_buffer`.
+        """
         super(Worker, self).__init__()
+        assert wait_policy in WAIT_POLICIES, f"unknown wait policy {wait_policy}"
+        assert (
+            overrun_policy in OVERRUN_POLICIES
+        ), f"unknown overrun policy {overrun_policy}"
         self.worker_buffer = worker_buffer
         self.main_buffer = main_buffer
         self.metrics_per_episode_buffer = metrics_per_episode_buffer
@@ -58,21 +336,105 @@ class Worker(mp.Process):
         self.data_rate = data_rate
         self.running = True
         self._ep = 0
+        self.wait_policy = wait_policy
+        self.spin_budget = spin_budget
+        self.record_latency = record_latency
+        self.overrun_policy = overrun_policy
+        self.mailbox = mailbox
+        self.ring = ring
+        self.info_buffer = info_buffer
+        self.doorbell = doorbell
+        self.queue_dropped = queue_dropped
+        self._index = 0
+
+    def _send(
+        self, observation, reward, terminated, truncated, info, total_reward=None
+    ):
+        """`total_reward` is only given for env steps, not resets."""
+        sent_at = time.monotonic() if self.record_latency else 0.0
+        if self.ring is not None:
+            has_info = bool(info)
+            if has_info:
+                self.info_buffer.put((self._index, info))
+            self.ring.append(
+                (
+                    observation,
+                    reward,
+                    terminated,
+                    truncated,
+                    has_info,
+                    total_reward or 0.0,
+                    self._index,
+                    sent_at,
+                )
+            )
+            self._index += 1
+            self.doorbell.ring()
+            return
+
+        if self.mailbox is not None:
+            # The mailbox keeps the running reward, `get` derives `total_reward`.
+            self.mailbox.put(
+                (observation, reward, terminated, truncated, info, sent_at)
+            )
+            self.doorbell.ring()
+            return
+
+        if total_reward is not None:
+            info["total_reward"] = total_reward
+        if self.record_latency:
+            info["sent_at"] = sent_at
+
+        payload = {
+            "observation": observation,
+            "reward": reward,
+            "terminated": terminated,
+            "truncated": truncated,
+            "info": info,
+        }
+        try:
+            self.main_buffer.put_nowait(payload)
+        except queue.Full:
+            if self.queue_dropped is not None:
+                self.queue_dropped.value += 1
+            if getenv_as_int("DEBUG") > 0:
+                print(
+                    "Error:",
+                    "Main Buffer Full",
+                    f"Dropping {payload}",
+                )
+
+    def _receive_action(self, deadline):
+        """Returns the next action, or raises `queue.Empty` once `deadline` passes."""
+        if self.wait_policy != "spin":
+            sleep_until = deadline
+            if self.wait_policy == "hybrid":
+                sleep_until -= self.spin_budget
+            remaining = sleep_until - time.monotonic()
+            if remaining > 0:
+                try:
+                    return self.worker_buffer.get(timeout=remaining)
+                except queue.Empty:
+                    pass
+            if self.wait_policy == "block":
+                raise queue.Empty
+
+        while True:
+            try:
+                return self.worker_buffer.get_nowait()
+            except queue.Empty:
+                if time.monotonic() >= deadline:
+                    raise
 
     def run(self):
+        latency = LatencyRecorder() if self.record_latency else None
+        ticks_since_action = 0
+
         observation, info = self.env.reset()
         total_reward = 0
         terminated = truncated = False
 
-        self.main_buffer.put_nowait(
-            {
-                "observation": observation,
-                "reward": 0,
-                "terminated": terminated,
-                "truncated": truncated,
-                "info": info,
-            }
-        )
+        self._send(observation, 0, terminated, truncated, info)
 
         if getenv_as_int("WAIT_FOR_FIRST_ACTION") > 0:
             last_action = self.env.action_space.sample()
@@ -80,24 +442,27 @@ class Worker(mp.Process):
             last_action = self.worker_buffer.get()
 
         # asynchronous
+        period = 1 / self.data_rate
+        rate = RateMonitor()
+        next_tick = time.monotonic() + period
         while self.running:
-            dt = 0
-            action = None
-            while dt < 1 / self.data_rate:
-                start_time = time.monotonic()
-                action_to_be = None
+            # Keep the latest action that arrives before the next tick
+            fresh_action = False
+            while True:
                 try:
-                    action_to_be = self.worker_buffer.get_nowait()
-                except:
-                    pass
-
-                if action_to_be is not None:
-                    action = action_to_be
+                    last_action = self._receive_action(next_tick)
+                    fresh_action = True
+                except queue.Empty:
+                    break
+            action = last_action
+            rate.tick(time.monotonic(), next_tick)
+
+            if latency is not None:
+                if fresh_action:
+                    latency.record("repeats", ticks_since_action)
+                    ticks_since_action = 0
                 else:
-                    action = last_action
-
-                end_time = time.monotonic()
-                dt += end_time - start_time
+                    ticks_since_action += 1
 
             # if action is None:
             #     action = self.env.action_space.sample()
@@ -107,33 +472,23 @@ class Worker(mp.Process):
             #     if getenv_as_int("DEBUG") > 0:
             #         print("Action:", action)
 
-            payload = self.env.step(action)
-            payload = {
-                "observation": payload[0],
-                "reward": payload[1],
-                "terminated": payload[2],
-                "truncated": payload[3],
-                "info": payload[4],
-            }
-            total_reward += payload.get("reward")
+            step_start_time = time.monotonic()
+            observation, reward, terminated, truncated, info = self.env.step(action)
+            if latency is not None:
+                latency.record("env_step", time.monotonic() - step_start_time)
+            total_reward += reward
 
-            payload["info"].update({"total_reward": total_reward})
+            episode_ended = terminated or truncated
+            if episode_ended:
+                info["rate"] = rate.summary()
+                if latency is not None:
+                    info["latency"] = latency.summary()
 
-            try:
-                self.main_buffer.put_nowait(payload)
-            except queue.Full:
-                if getenv_as_int("DEBUG") > 0:
-                    print(
-                        "Error:",
-                        "Main Buffer Full",
-                        f"Dropping {payload}",
-                    )
-                pass
-
-            if payload.get("terminated"):
+            self._send(observation, reward, terminated, truncated, info, total_reward)
+
+            if episode_ended:
                 self._ep += 1
-                metrics_dic = payload.get("info")
-                metrics_dic.update({"episode": self._ep})
+                metrics_dic = dict(info, total_reward=total_reward, episode=self._ep)
                 self.metrics_per_episode_buffer.put(metrics_dic)
                 print("put in metrics")
 
@@ -141,15 +496,15 @@ class Worker(mp.Process):
                 terminated = False
                 truncated = False
                 total_reward = 0
-                self.main_buffer.put_nowait(
-                    {
-                        "observation": observation,
-                        "reward": 0,
-                        "terminated": terminated,
-                        "truncated": truncated,
-                        "info": info,
-                    }
-                )
+                self._send(observation, 0, terminated, truncated, info)
+
+            # The next tick is on the schedule, however long this one took
+            next_tick += period
+            if self.overrun_policy == "skip":
+                missed_ticks = int((time.monotonic() - next_tick) // period) + 1
+                if missed_ticks > 0:
+                    next_tick += missed_ticks * period
+                    rate.num_skipped += missed_ticks
 
 
 if __name__ == "__main__":
@@ -5,6 +5,8 @@
 #SBATCH --time=0-2:59
 #SBATCH --cpu-freq=Performance
 #SBATCH --array=1-30%1
+#SBATCH --signal=B:USR1@180
+#SBATCH --requeue
 
 # setup and tear down takes .5-2 minutes.
 
@@ -37,9 +39,26 @@ export python_venv=$SLURM_TMPDIR/virtualenvs/pyenv/bin/python3.10
 
 module load swig
 
+# Checkpoints outlive the job, a requeued task resumes from its own.
+checkpoint_dir=${CHECKPOINT_ROOT:-$HOME/scratch/checkpoints}/${SLURM_ARRAY_JOB_ID:-$SLURM_JOB_ID}_${SLURM_ARRAY_TASK_ID:-0}
+
+# Near the time limit SLURM signals this script, the run checkpoints and the task
+# goes back in the queue.
+requeue() {
+    echo "Time limit close, checkpointing and requeueing..."
+    kill -USR1 $child
+    wait $child
+    if [ $? -eq 75 ]; then
+        scontrol requeue $SLURM_JOB_ID
+    fi
+}
+trap requeue USR1
+
 echo "Running experiment..."
 cd $SLURM_TMPDIR/project
-$python_venv $@ --seed $SLURM_ARRAY_TASK_ID
+$python_venv $@ --seed $SLURM_ARRAY_TASK_ID --checkpoint-dir $checkpoint_dir &
+child=$!
+wait $child
 
 echo "done"
 
@@ -0,0 +1,62 @@
+#!/bin/bash
+#SBATCH --account=def-mbowling
+#SBATCH --mem-per-cpu=4G
+#SBATCH --cpu-freq=Performance
+#SBATCH --signal=B:USR1@180
+#SBATCH --requeue
+
+# Runs a pack of jobs written by `src/job_submitter.py` (PACK_CPUS > 0) in one
+# allocation: the venv and the repo are set up once, then the jobs run side by side,
+# each pinned to its own CPUs. The CPUs and time limit are set when submitting.
+# sbatch --cpus-per-task 32 --time 2:59:00 ./slurm_pack.sh packs/<pack>.json
+
+if [ "$SLURM_TMPDIR" == "" ]; then
+    exit 1
+fi
+
+pack=$1
+
+echo "Copying virtualenv..."
+cp ~/projects/def-mbowling/aorenste/venv.tar.gz $SLURM_TMPDIR/
+cd $SLURM_TMPDIR
+tar -xzf venv.tar.gz
+rm venv.tar.gz
+
+echo "Setting up SOCKS5 proxy..."
+ssh -q -N -T -f -D 8888 `echo $SSH_CONNECTION | cut -d " " -f 3`
+export ALL_PROXY=socks5h://localhost:8888
+
+echo "Cloning repo..."
+git config --global http.proxy 'socks5://127.0.0.1:8888'
+git clone --quiet https://github.com/AdrianOrenstein/async-mdp.git $SLURM_TMPDIR/project
+
+echo "Exporting env variables"
+export PYTHONPATH=$SLURM_TMPDIR/project/src:.
+export PATH=$SLURM_TMPDIR/virtualenvs/pyenv/bin:$PATH
+export python_venv=$SLURM_TMPDIR/virtualenvs/pyenv/bin/python3.10
+
+# Checkpoints and logs outlive the allocation, a requeued pack resumes its jobs.
+export CHECKPOINT_ROOT=${CHECKPOINT_ROOT:-$HOME/scratch/checkpoints}
+export JOB_LOG_DIR=$SLURM_SUBMIT_DIR/logs/$SLURM_JOB_ID
+
+module load swig
+
+# Near the time limit SLURM signals this script, the jobs checkpoint and the pack
+# goes back in the queue.
+requeue() {
+    echo "Time limit close, checkpointing and requeueing..."
+    kill -USR1 $child
+    wait $child
+    if [ $? -eq 75 ]; then
+        scontrol requeue $SLURM_JOB_ID
+    fi
+}
+trap requeue USR1
+
+echo "Running pack $pack..."
+cd $SLURM_TMPDIR/project
+$python_venv src/job_submitter.py --run-pack $pack &
+child=$!
+wait $child
+
+echo "done"
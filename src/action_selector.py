@@ -0,0 +1,69 @@
+import numpy as np
+import torch
+import torch.nn as nn
+from gymnasium import spaces
+
+COMPILE_MODES = (None, "script", "compile")
+
+
+def compile_network(network: nn.Module, mode: str = None) -> nn.Module:
+    """
+    A view of `network` for inference, sharing its parameters so weight updates and
+        `load_state_dict` show through: `script` with TorchScript, `compile` with
+        `torch.compile`, or `network` itself.
+    """
+    assert mode in COMPILE_MODES, f"unknown compile mode {mode}"
+    if mode == "script":
+        return torch.jit.script(network)
+    if mode == "compile":
+        return torch.compile(network)
+    return network
+
+
+class ActionSelector:
+    def __init__(
+        self,
+        network: nn.Module,
+        observation_space: spaces.Box,
+        action_space: spaces.Discrete,
+        num_envs: int,
+        device: torch.device = "cpu",
+        seed: int = None,
+    ):
+        """
+        Epsilon-greedy actions for a batch of environments.
+        One draw of the random generator per batch decides which envs explore and
+            what they play. The network only runs when at least one env is greedy,
+            under `torch.inference_mode`, on observations copied into a preallocated
+            (pinned, when on cuda) tensor.
+        `network` is called as is, see `compile_network` for a compiled view.
+        """
+        self.network = network
+        self.num_envs = num_envs
+        self.num_actions = int(action_space.n)
+        self.device = torch.device(device)
+        self.rng = np.random.default_rng(seed)
+
+        self._observations = torch.empty(
+            (num_envs,) + observation_space.shape,
+            dtype=torch.float32,
+            pin_memory=self.device.type == "cuda",
+        )
+        self._observations_array = self._observations.numpy()
+
+    def greedy(self, observations: np.ndarray) -> np.ndarray:
+        self._observations_array[...] = observations
+        with torch.inference_mode():
+            q_values = self.network(
+                self._observations.to(self.device, non_blocking=True)
+            )
+            return torch.argmax(q_values, dim=1).cpu().numpy()
+
+    def __call__(self, observations: np.ndarray, epsilon: float) -> np.ndarray:
+        # The first row decides who explores, the second picks their actions.
+        uniform = self.rng.random((2, self.num_envs))
+        explore = uniform[0] < epsilon
+        actions = (uniform[1] * self.num_actions).astype(np.int64)
+        if not explore.all():
+            actions = np.where(explore, actions, self.greedy(observations))
+        return actions
@@ -0,0 +1,139 @@
+from typing import Tuple
+
+import numpy as np
+
+
+class SumRewards:
+    """
+    The last observation and the sum of the rewards of the repeated actions, the same
+        as `simple_asyncmdp.accumulate_rewards_and_pick_last_obs`.
+    Only needs the running sum, so the catch-up can be fast-forwarded.
+    """
+
+    supports_fast_forward = True
+
+    def begin(self):
+        self._reward = 0.0
+
+    def add(self, observation, reward: float):
+        self._reward += reward
+
+    def add_fast_forward(self, observation, total_reward: float, num_steps: int):
+        self._reward += total_reward
+
+    def reward(self) -> float:
+        return self._reward
+
+    def update_info(self, info: dict):
+        pass
+
+
+class DiscountedSumRewards(SumRewards):
+    """
+    The last observation and the rewards of the repeated actions discounted by `gamma`,
+        as if the agent had seen every step.
+    """
+
+    supports_fast_forward = False
+
+    def __init__(self, gamma: float = 0.99):
+        self.gamma = gamma
+
+    def begin(self):
+        self._reward = 0.0
+        self._discount = 1.0
+
+    def add(self, observation, reward: float):
+        self._reward += self._discount * reward
+        self._discount *= self.gamma
+
+
+class Trajectory(SumRewards):
+    """
+    The last observation and the summed reward, plus every intermediate observation and
+        reward in `info["trajectory"]`.
+    Steps are written into preallocated arrays and `info["trajectory"]` holds views of
+        them, so recording doesn't allocate per env step. The views are overwritten by the
+        next step, copy them to keep them.
+    Pass `observations` and `rewards` to write straight into storage you own, e.g. a slice
+        of a replay buffer.
+    Steps beyond `max_steps` still count towards the reward but are not recorded, the
+        number of them is in `info["trajectory"]["num_dropped"]` and their rewards,
+        discounted by `gamma` as one n-step transition, in `["dropped_reward"]`.
+    """
+
+    supports_fast_forward = False
+
+    def __init__(
+        self,
+        observation_space,
+        max_steps: int = 1024,
+        observations: np.ndarray = None,
+        rewards: np.ndarray = None,
+        gamma: float = 0.99,
+    ):
+        if observations is None:
+            observations = np.empty(
+                (max_steps,) + observation_space.shape, dtype=observation_space.dtype
+            )
+        if rewards is None:
+            rewards = np.empty(len(observations), dtype=np.float64)
+        assert len(observations) == len(rewards), "one reward per observation"
+        self.observations = observations
+        self.rewards = rewards
+        self.gamma = gamma
+
+    def begin(self):
+        self._reward = 0.0
+        self._num_steps = 0
+        self._dropped_reward = 0.0
+        self._dropped_discount = 1.0
+
+    def add(self, observation, reward: float):
+        if self._num_steps < len(self.rewards):
+            self.observations[self._num_steps] = observation
+            self.rewards[self._num_steps] = reward
+        else:
+            self._dropped_reward += self._dropped_discount * reward
+            self._dropped_discount *= self.gamma
+        self._reward += reward
+        self._num_steps += 1
+
+    def update_info(self, info: dict):
+        num_recorded = min(self._num_steps, len(self.rewards))
+        info["trajectory"] = {
+            "observations": self.observations[:num_recorded],
+            "rewards": self.rewards[:num_recorded],
+            "num_dropped": self._num_steps - num_recorded,
+            "dropped_reward": self._dropped_reward,
+        }
+
+
+def last_transition(trajectory: dict, gamma: float) -> Tuple[float, float]:
+    """
+    The reward and bootstrap discount of the transition that ends a `Trajectory`'s
+        `info["trajectory"]`: its last step, or the steps past `max_steps` as one
+        n-step transition.
+    """
+    if trajectory["num_dropped"]:
+        return trajectory["dropped_reward"], gamma ** trajectory["num_dropped"]
+    return float(trajectory["rewards"][-1]), gamma
+
+
+AGGREGATORS = {
+    "sum": SumRewards,
+    "discounted": DiscountedSumRewards,
+    "trajectory": Trajectory,
+}
+
+
+if __name__ == "__main__":
+    # Two recorded steps and three past `max_steps`: 1 + 0.5 * 2 + 0.25 * 4, gamma ** 3.
+    trajectory = Trajectory(None, observations=np.zeros((2, 1)), gamma=0.5)
+    trajectory.begin()
+    for reward in (8.0, 8.0, 1.0, 2.0, 4.0):
+        trajectory.add(np.zeros(1), reward)
+    info = {}
+    trajectory.update_info(info)
+    assert last_transition(info["trajectory"], 0.5) == (3.0, 0.125)
+    print("aggregators ok")
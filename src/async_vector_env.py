@@ -0,0 +1,424 @@
+import multiprocessing as mp
+import time
+from multiprocessing import shared_memory
+from typing import Callable, Dict, List, Tuple
+
+import gymnasium as gym
+import numpy as np
+from gymnasium.vector.utils import CloudpickleWrapper
+from loguru import logger
+
+from shared_memory_ring import space_dtype
+from wakeup import Doorbell, wait_until
+
+_STEP = 0
+_RESET = 1
+_CLOSE = 2
+
+
+class _SharedArrays:
+    """Named NumPy arrays laid out back to back in one shared memory segment."""
+
+    def __init__(self, spec: Dict[str, Tuple[np.dtype, Tuple[int, ...]]]):
+        self._spec = spec
+        _, nbytes = self._layout()
+        self._shm = shared_memory.SharedMemory(create=True, size=max(1, nbytes))
+        self._owner = True
+        self._attach()
+        for array in self.arrays.values():
+            array[...] = 0
+
+    def _layout(self):
+        offsets, offset = {}, 0
+        for name, (dtype, shape) in self._spec.items():
+            # 64 byte aligned, so no two arrays share a cache line.
+            offset = (offset + 63) // 64 * 64
+            offsets[name] = offset
+            offset += np.dtype(dtype).itemsize * int(np.prod(shape))
+        return offsets, offset
+
+    def _attach(self):
+        offsets, _ = self._layout()
+        self.arrays = {
+            name: np.ndarray(
+                shape, dtype=dtype, buffer=self._shm.buf, offset=offsets[name]
+            )
+            for name, (dtype, shape) in self._spec.items()
+        }
+
+    def __getattr__(self, name):
+        try:
+            return self.__dict__["arrays"][name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def __getstate__(self):
+        return {"name": self._shm.name, "spec": self._spec}
+
+    def __setstate__(self, state):
+        self._spec = state["spec"]
+        self._shm = shared_memory.SharedMemory(name=state["name"])
+        self._owner = False
+        self._attach()
+
+    def close(self):
+        self.arrays = {}
+        self._shm.close()
+        if self._owner:
+            self._shm.unlink()
+
+
+class AsyncVectorGym(gym.vector.VectorEnv):
+    def __init__(
+        self,
+        env_fns: List[Callable[[], gym.Env]],
+        environment_steps_per_second=2,
+        copy: bool = True,
+        wait_policy: str = "hybrid",
+        spin_budget: float = 50e-6,
+        context: str = None,
+    ):
+        """
+        Subprocess-backed vector version of `AsynchronousGym`.
+        Each worker owns one environment and its own real-time clock: after handing an
+            observation to the agent it keeps stepping the environment with the last
+            action at `environment_steps_per_second` until the agent's next action
+            arrives, then plays the new action.
+        If an episode ends while the agent is thinking, the worker stops and returns the
+            terminal step as soon as the next action arrives, without playing it.
+        Workers write into one contiguous shared memory block, so observations and the
+            `num_repeat_actions`, `agent_response_time` and `ratio` infos come back as
+            batched arrays without pickling.
+        `environment_steps_per_second=0` makes every worker wait for the agent.
+        """
+        dummy_env = env_fns[0]()
+        single_observation_space = dummy_env.observation_space
+        single_action_space = dummy_env.action_space
+        dummy_env.close()
+        del dummy_env
+
+        super(AsyncVectorGym, self).__init__(
+            len(env_fns), single_observation_space, single_action_space
+        )
+        self.copy = copy
+
+        observation_dtype, observation_shape = space_dtype(single_observation_space)
+        action_dtype, action_shape = space_dtype(single_action_space)
+        n = self.num_envs
+        self._shared = _SharedArrays(
+            {
+                "observations": (observation_dtype, (n,) + observation_shape),
+                "final_observations": (observation_dtype, (n,) + observation_shape),
+                "actions": (action_dtype, (n,) + action_shape),
+                "rewards": (np.float64, (n,)),
+                "terminateds": (np.bool_, (n,)),
+                "truncateds": (np.bool_, (n,)),
+                "num_repeat_actions": (np.int64, (n,)),
+                "agent_response_time": (np.float64, (n,)),
+                "ratio": (np.float64, (n,)),
+                "episode_return": (np.float64, (n,)),
+                "episode_length": (np.int64, (n,)),
+                "episode_time": (np.float64, (n,)),
+                "has_episode": (np.bool_, (n,)),
+                "seeds": (np.int64, (n,)),
+                "has_seed": (np.bool_, (n,)),
+                "commands": (np.int64, (n,)),
+                "request_seq": (np.int64, (n,)),
+                "result_seq": (np.int64, (n,)),
+                "errors": (np.bool_, (n,)),
+            }
+        )
+
+        environment_steps_per_second = np.broadcast_to(
+            np.asarray(environment_steps_per_second, dtype=np.float64), (n,)
+        )
+        self._wait_policy = wait_policy
+        self._spin_budget = spin_budget
+
+        ctx = mp.get_context(context)
+        self._results_doorbell = Doorbell(ctx)
+        self._request_doorbells = [Doorbell(ctx) for _ in range(n)]
+        self.workers = []
+        for i, env_fn in enumerate(env_fns):
+            worker = ctx.Process(
+                target=_worker,
+                name=f"AsyncVectorGymWorker-{i}",
+                args=(
+                    i,
+                    CloudpickleWrapper(env_fn),
+                    self._shared,
+                    float(environment_steps_per_second[i]),
+                    self._request_doorbells[i],
+                    self._results_doorbell,
+                    wait_policy,
+                    spin_budget,
+                ),
+                daemon=True,
+            )
+            worker.start()
+            self.workers.append(worker)
+
+    def _request(self, command: int):
+        self._shared.commands[:] = command
+        self._shared.request_seq += 1
+        for doorbell in self._request_doorbells:
+            doorbell.ring()
+
+    def _wait_for_results(self):
+        shared = self._shared
+        wait_until(
+            lambda: np.array_equal(shared.result_seq, shared.request_seq)
+            or shared.errors.any(),
+            self._results_doorbell,
+            policy=self._wait_policy,
+            spin_budget=self._spin_budget,
+        )
+        if shared.errors.any():
+            raise RuntimeError(
+                f"AsyncVectorGym workers {np.flatnonzero(shared.errors).tolist()} crashed"
+            )
+
+    def _observations(self):
+        observations = self._shared.observations
+        return np.copy(observations) if self.copy else observations
+
+    def reset_async(self, seed=None, options=None):
+        if options is not None:
+            logger.warning("AsyncVectorGym ignores reset options")
+        if seed is None:
+            seed = [None for _ in range(self.num_envs)]
+        if isinstance(seed, int):
+            seed = [seed + i for i in range(self.num_envs)]
+        assert len(seed) == self.num_envs
+
+        for i, single_seed in enumerate(seed):
+            self._shared.has_seed[i] = single_seed is not None
+            self._shared.seeds[i] = single_seed or 0
+        self._request(_RESET)
+
+    def reset_wait(self, seed=None, options=None):
+        self._wait_for_results()
+        infos = {
+            "num_repeat_actions": np.zeros(self.num_envs, dtype=np.int64),
+            "agent_response_time": np.zeros(self.num_envs),
+        }
+        return self._observations(), infos
+
+    def step_async(self, actions):
+        self._shared.actions[:] = actions
+        self._request(_STEP)
+
+    def step_wait(self):
+        self._wait_for_results()
+        shared = self._shared
+
+        infos = {
+            "num_repeat_actions": shared.num_repeat_actions.copy(),
+            "agent_response_time": shared.agent_response_time.copy(),
+            "ratio": shared.ratio.copy(),
+        }
+        dones = shared.terminateds | shared.truncateds
+        if dones.any():
+            final_observation = np.full(self.num_envs, None, dtype=object)
+            final_info = np.full(self.num_envs, None, dtype=object)
+            for i in np.flatnonzero(dones):
+                final_observation[i] = shared.final_observations[i].copy()
+                final_info[i] = {}
+                if shared.has_episode[i]:
+                    final_info[i]["episode"] = {
+                        "r": np.array([shared.episode_return[i]]),
+                        "l": np.array([shared.episode_length[i]]),
+                        "t": np.array([shared.episode_time[i]]),
+                    }
+            infos.update(
+                {
+                    "final_observation": final_observation,
+                    "_final_observation": dones,
+                    "final_info": final_info,
+                    "_final_info": dones,
+                }
+            )
+
+        return (
+            self._observations(),
+            shared.rewards.copy(),
+            shared.terminateds.copy(),
+            shared.truncateds.copy(),
+            infos,
+        )
+
+    def close_extras(self, timeout=None, terminate=False):
+        if not terminate and not self._shared.errors.any():
+            self._request(_CLOSE)
+        for worker in self.workers:
+            worker.join(timeout=1 if timeout is None else timeout)
+            if worker.is_alive():
+                worker.terminate()
+        for doorbell in self._request_doorbells + [self._results_doorbell]:
+            doorbell.close()
+        self._shared.close()
+
+
+def _worker(
+    index,
+    env_fn,
+    shared,
+    environment_steps_per_second,
+    request_doorbell,
+    results_doorbell,
+    wait_policy,
+    spin_budget,
+):
+    i = index
+    period = 1 / environment_steps_per_second if environment_steps_per_second else None
+
+    def publish(
+        observation,
+        reward,
+        terminated,
+        truncated,
+        info,
+        num_repeat_actions,
+        handoff_time,
+    ):
+        """Writes the step the agent asked for and returns the new handoff time."""
+        if terminated or truncated:
+            shared.final_observations[i] = observation
+            episode = info.get("episode")
+            shared.has_episode[i] = episode is not None
+            if episode is not None:
+                shared.episode_return[i] = np.asarray(episode["r"]).item()
+                shared.episode_length[i] = np.asarray(episode["l"]).item()
+                shared.episode_time[i] = np.asarray(episode["t"]).item()
+            observation, _ = env.reset()
+
+        now = time.monotonic()
+        agent_response_time = 0 if handoff_time is None else now - handoff_time
+        shared.observations[i] = observation
+        shared.rewards[i] = reward
+        shared.terminateds[i] = terminated
+        shared.truncateds[i] = truncated
+        shared.num_repeat_actions[i] = num_repeat_actions
+        shared.agent_response_time[i] = agent_response_time
+        shared.ratio[i] = environment_steps_per_second * agent_response_time
+        # The sequence number publishes the step, it has to be written last.
+        shared.result_seq[i] = shared.request_seq[i]
+        results_doorbell.ring()
+        return now
+
+    try:
+        env = env_fn()
+        seen_seq = 0
+        handoff_time = None
+        last_action = None
+        next_tick = None
+        terminal_step = None
+        reward = 0.0
+        num_repeat_actions = 0
+
+        while True:
+            # Between requests the environment keeps running on its own clock.
+            running = (
+                period is not None and last_action is not None and terminal_step is None
+            )
+            has_request = wait_until(
+                lambda: shared.request_seq[i] != seen_seq,
+                request_doorbell,
+                deadline=next_tick if running else None,
+                policy=wait_policy,
+                spin_budget=spin_budget,
+            )
+
+            if not has_request:
+                # The agent is late, repeat its last action.
+                observation, step_reward, terminated, truncated, info = env.step(
+                    last_action
+                )
+                reward += step_reward
+                num_repeat_actions += 1
+                next_tick += period
+                if terminated or truncated:
+                    terminal_step = (observation, terminated, truncated, info)
+                continue
+
+            seen_seq = int(shared.request_seq[i])
+            command = int(shared.commands[i])
+            if command == _CLOSE:
+                break
+
+            if command == _RESET:
+                seed = int(shared.seeds[i]) if shared.has_seed[i] else None
+                observation, info = env.reset(seed=seed)
+                handoff_time, last_action, terminal_step = None, None, None
+                publish(observation, 0.0, False, False, info, 0, None)
+            elif terminal_step is not None:
+                # The episode ended while the agent was deciding, its action is dropped.
+                observation, terminated, truncated, info = terminal_step
+                handoff_time = publish(
+                    observation,
+                    reward,
+                    terminated,
+                    truncated,
+                    info,
+                    num_repeat_actions,
+                    handoff_time,
+                )
+                terminal_step = None
+            else:
+                action = shared.actions[i]
+                action = action.item() if action.ndim == 0 else action.copy()
+                observation, step_reward, terminated, truncated, info = env.step(action)
+                handoff_time = publish(
+                    observation,
+                    reward + step_reward,
+                    terminated,
+                    truncated,
+                    info,
+                    num_repeat_actions,
+                    handoff_time,
+                )
+                last_action = action
+
+            reward = 0.0
+            num_repeat_actions = 0
+            if handoff_time is not None and period is not None:
+                next_tick = handoff_time + period
+    except Exception:
+        logger.exception(f"AsyncVectorGym worker {i} crashed")
+        shared.errors[i] = True
+        results_doorbell.ring()
+    finally:
+        if "env" in locals():
+            env.close()
+
+
+if __name__ == "__main__":
+    num_envs = 4
+    envs = AsyncVectorGym(
+        [
+            lambda: gym.wrappers.RecordEpisodeStatistics(gym.make("CartPole-v1"))
+            for _ in range(num_envs)
+        ],
+        environment_steps_per_second=1000,
+    )
+    observations, infos = envs.reset(seed=0)
+    assert observations.shape == (num_envs,) + envs.single_observation_space.shape
+
+    returns = []
+    start_time = time.monotonic()
+    for _ in range(1000):
+        time.sleep(0.002)  # simulate agent processing delay
+        observations, rewards, terminateds, truncateds, infos = envs.step(
+            envs.action_space.sample()
+        )
+        if "final_info" in infos:
+            returns += [
+                info["episode"]["r"].item() for info in infos["final_info"] if info
+            ]
+    print(
+        f"sps={1000 / (time.monotonic() - start_time):.1f}",
+        f"episodes={len(returns)}",
+        f"mean_return={np.mean(returns):.1f}",
+        f"mean_num_repeat_actions={infos['num_repeat_actions'].mean():.1f}",
+    )
+    envs.close()
@@ -0,0 +1,202 @@
+import asyncio
+import time
+from typing import Callable, List, Optional
+
+import gymnasium as gym
+import numpy as np
+
+from clocks import EventLoopClock
+from multiprocess_asyncmdp import AsyncGymWrapper
+from simple_asyncmdp import AsynchronousGym
+from wakeup import wait_until_async
+
+"""
+`async def reset()/step()` on top of the async wrappers, so one agent process can drive
+many environments from a single event loop, and `BatchedPolicy` to run one inference
+for all of the environments that are waiting for an action.
+
+PYTHONPATH=./src python src/asyncio_asyncmdp.py
+"""
+
+
+class AsyncioGym:
+    def __init__(
+        self,
+        env: gym.Env,
+        environment_steps_per_second: int = 2,
+        aggregator=None,
+        record_latency: bool = False,
+    ):
+        """
+        `AsynchronousGym` stepped from a coroutine, timed by the event loop's clock.
+        Every step yields to the loop once, so the agent's response time includes the
+            time it waits on the other environments and on the batched inference.
+        """
+        self.env = AsynchronousGym(
+            env,
+            environment_steps_per_second=environment_steps_per_second,
+            clock=EventLoopClock(),
+            aggregator=aggregator,
+            record_latency=record_latency,
+        )
+        self.observation_space = self.env.observation_space
+        self.action_space = self.env.action_space
+
+    async def reset(self, **kwargs):
+        # Doesn't yield, so environments that reset stay in step with the others.
+        return self.env.reset(**kwargs)
+
+    async def step(self, action):
+        result = self.env.step(action)
+        await asyncio.sleep(0)
+        return result
+
+    def close(self):
+        self.env.close()
+
+
+class AsyncioWorkerGym:
+    def __init__(self, env: gym.Env, data_rate: int = 2, **kwargs):
+        """
+        `multiprocess_asyncmdp.AsyncGymWrapper` whose agent side waits in the event
+            loop: the loop watches the worker's doorbell instead of the agent spinning
+            or blocking on it, see `wakeup.wait_until_async`.
+        `kwargs` are passed on to `AsyncGymWrapper`, its `wait_policy` only applies to
+            the worker.
+        The worker resets the env on its own, `reset` returns the next observation it
+            sends, i.e. the first one or the one following the end of an episode.
+        """
+        self.env = AsyncGymWrapper(env, data_rate=data_rate, **kwargs)
+        self.observation_space = env.observation_space
+        self.action_space = env.action_space
+
+    async def _wait(self):
+        await wait_until_async(self.env._transition_ready, self.env._agent_doorbell)
+
+    async def reset(self, **kwargs):
+        await self._wait()
+        observation, _, _, _, info = self.env._agent_receive()
+        return observation, info
+
+    async def step(self, action):
+        send_time = time.monotonic()
+        self.env._agent_send(action)
+        await self._wait()
+        return self.env._receive(send_time)
+
+    def close(self):
+        self.env.close()
+
+
+class BatchedPolicy:
+    def __init__(
+        self,
+        act: Callable[[np.ndarray], np.ndarray],
+        max_batch_size: Optional[int] = None,
+    ):
+        """
+        `await policy(observation)` returns one action, computed by `act` on the stacked
+            observations of every coroutine that asked during the same iteration of the
+            event loop.
+        A batch is run as soon as it holds `max_batch_size` observations, otherwise once
+            the coroutines that were ready have all asked.
+        """
+        self.act = act
+        self.max_batch_size = max_batch_size
+        self.num_batches = 0
+        self.num_observations = 0
+        self._observations = []
+        self._futures: List[asyncio.Future] = []
+        self._handle = None
+
+    @property
+    def mean_batch_size(self) -> float:
+        return self.num_observations / max(self.num_batches, 1)
+
+    async def __call__(self, observation):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._observations.append(observation)
+        self._futures.append(future)
+        if (
+            self.max_batch_size is not None
+            and len(self._futures) >= self.max_batch_size
+        ):
+            self._run()
+        elif self._handle is None:
+            # Runs after the coroutines woken up in this iteration of the loop.
+            self._handle = loop.call_soon(self._run)
+        return await future
+
+    def _run(self):
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+        observations, futures = self._observations, self._futures
+        self._observations, self._futures = [], []
+        if not futures:
+            return
+
+        try:
+            actions = self.act(np.stack(observations))
+        except Exception as error:
+            for future in futures:
+                if not future.done():
+                    future.set_exception(error)
+            return
+        self.num_batches += 1
+        self.num_observations += len(futures)
+        for future, action in zip(futures, actions):
+            if not future.done():
+                future.set_result(action)
+
+
+async def run_agent(env, policy, num_steps: int) -> List[float]:
+    """Plays `num_steps` steps of `env` with `policy`, returns the episodic returns."""
+    observation, _ = await env.reset()
+    episodic_return = 0.0
+    episodic_returns = []
+    for _ in range(num_steps):
+        action = await policy(observation)
+        observation, reward, terminated, truncated, _ = await env.step(action)
+        episodic_return += reward
+        if terminated or truncated:
+            episodic_returns.append(episodic_return)
+            episodic_return = 0.0
+            observation, _ = await env.reset()
+    return episodic_returns
+
+
+async def run_agents(envs, policy, num_steps: int) -> List[List[float]]:
+    """`run_agent` on all of `envs` at once, sharing `policy`."""
+    return await asyncio.gather(*(run_agent(env, policy, num_steps) for env in envs))
+
+
+if __name__ == "__main__":
+    rng = np.random.default_rng(0)
+
+    def act(observations):
+        # Stands in for a network's forward pass, the cost is paid once per batch.
+        time.sleep(1e-3)
+        return rng.integers(2, size=len(observations))
+
+    for name, make, num_envs in (
+        ("in-process", lambda: AsyncioGym(gym.make("CartPole-v1"), 100), 32),
+        # The worker hands over its newest transition, episode ends can be missed.
+        ("worker", lambda: AsyncioWorkerGym(gym.make("CartPole-v1"), 100), 4),
+    ):
+        envs = [make() for _ in range(num_envs)]
+        policy = BatchedPolicy(act)
+        num_steps = 200
+        start_time = time.monotonic()
+        returns = asyncio.run(run_agents(envs, policy, num_steps))
+        seconds = time.monotonic() - start_time
+        for env in envs:
+            env.close()
+
+        assert policy.num_observations == num_envs * num_steps
+        print(
+            f"{name}: {num_envs} envs, {num_envs * num_steps / seconds:.0f} sps, "
+            f"mean batch size {policy.mean_batch_size:.1f}"
+        )
+    print("Done")
@@ -0,0 +1,275 @@
+import json
+import os
+import platform
+import sys
+import time
+from dataclasses import dataclass, field
+from typing import Callable, List
+
+import gymnasium as gym
+import tyro
+
+from job_submitter import DATA_RATES
+from latency import Histogram
+from multiprocess_asyncmdp import AsyncGymWrapper
+from simple_asyncmdp import AsynchronousGym
+
+"""
+Measures how fast each async wrapper can go with an agent that answers immediately,
+so data rates for experiments can be picked from measurements on the target machine.
+
+PYTHONPATH=./src:. python src/benchmark.py --env-ids CartPole-v1 --duration 2
+"""
+
+WRAPPERS = (
+    "simple",
+    "multiprocess_shared_memory",
+    "multiprocess_manager",
+    "realtime",
+    "realtime_mailbox",
+    "realtime_ring",
+)
+
+
+@dataclass
+class Args:
+    wrappers: List[str] = field(default_factory=lambda: list(WRAPPERS))
+    """the wrappers to benchmark, any of `simple`, `multiprocess_shared_memory`, `multiprocess_manager`, `realtime`, `realtime_mailbox` and `realtime_ring`"""
+    env_ids: List[str] = field(
+        default_factory=lambda: [
+            "CartPole-v1",
+            "Acrobot-v1",
+            "MountainCar-v0",
+            "LunarLander-v2",
+        ]
+    )
+    """the ids of the environments, the ones that fail to make are reported as skipped"""
+    data_rates: List[int] = field(default_factory=lambda: list(DATA_RATES))
+    """the requested environment data rates (Hz)"""
+    duration: float = 5.0
+    """the seconds each wrapper, environment and data rate is measured for"""
+    wait_policy: str = "hybrid"
+    """how the process-based wrappers wait for data: `spin`, `block` or `hybrid`"""
+    output: str = "benchmark.json"
+    """where the results are written as JSON"""
+
+
+def host_info() -> dict:
+    return {
+        "hostname": platform.node(),
+        "platform": platform.platform(),
+        "processor": platform.processor(),
+        "python": sys.version.split()[0],
+        "cpu_count": os.cpu_count(),
+        "usable_cpus": (
+            len(os.sched_getaffinity(0))
+            if hasattr(os, "sched_getaffinity")
+            else os.cpu_count()
+        ),
+        "cluster": os.getenv("SLURM_CLUSTERID"),
+    }
+
+
+def measure(step: Callable[[], None], duration: float):
+    """Calls `step` for `duration` seconds, returns the number of calls, the seconds and their round trips."""
+    round_trip = Histogram()
+    num_steps = 0
+    start_time = time.monotonic()
+    end_time = start_time + duration
+    now = start_time
+    while now < end_time:
+        step()
+        step_end_time = time.monotonic()
+        round_trip.record(step_end_time - now)
+        now = step_end_time
+        num_steps += 1
+    return num_steps, now - start_time, round_trip
+
+
+def benchmark_simple(env_id: str, data_rate: int, args: Args) -> dict:
+    env = AsynchronousGym(gym.make(env_id), environment_steps_per_second=data_rate)
+    env.reset(seed=0)
+    num_env_steps = 0
+
+    def step():
+        nonlocal num_env_steps
+        _, _, terminated, truncated, info = env.step(env.action_space.sample())
+        num_env_steps += info["num_repeat_actions"] + 1
+        if terminated or truncated:
+            env.reset()
+
+    num_steps, seconds, round_trip = measure(step, args.duration)
+    env.close()
+    return {
+        "transport": None,
+        "num_steps": num_steps,
+        "seconds": seconds,
+        "round_trip": round_trip.summary(),
+        "num_env_steps": num_env_steps,
+        "dropped": 0,
+        "skipped": 0,
+        "backlog": 0,
+    }
+
+
+def benchmark_multiprocess(
+    env_id: str, data_rate: int, args: Args, transport: str
+) -> dict:
+    env = AsyncGymWrapper(
+        gym.make(env_id),
+        data_rate=data_rate,
+        transport=transport,
+        wait_policy=args.wait_policy,
+    )
+    action_space = env._env.action_space
+    buffer = env._agent_buffer
+
+    # Count from the first transition, not from the worker's start-up.
+    env.step(action_space.sample())
+    appended = buffer.appended if transport == "shared_memory" else None
+    backlog = len(buffer)
+
+    num_steps, seconds, round_trip = measure(
+        lambda: env.step(action_space.sample()), args.duration
+    )
+
+    new_backlog = len(buffer)
+    if transport == "shared_memory":
+        num_env_steps = buffer.appended - appended
+        dropped = buffer.dropped
+        # Taking the newest transition discards the older ones.
+        skipped = num_env_steps - num_steps - (new_backlog - backlog)
+    else:
+        # The manager list is only ever popped from the end, the rest stays behind.
+        num_env_steps = num_steps + new_backlog - backlog
+        dropped = 0
+        skipped = 0
+    env.close()
+    return {
+        "transport": transport,
+        "num_steps": num_steps,
+        "seconds": seconds,
+        "round_trip": round_trip.summary(),
+        "num_env_steps": num_env_steps,
+        "dropped": dropped,
+        "skipped": skipped,
+        "backlog": new_backlog,
+    }
+
+
+def benchmark_realtime(env_id: str, data_rate: int, args: Args, channel: str) -> dict:
+    # Lives at the root of the repository.
+    from realtime_asyncmdp import AsyncWrapper
+
+    env = AsyncWrapper(
+        env_id, data_rate=data_rate, wait_policy=args.wait_policy, channel=channel
+    )
+    env.start()
+    if channel == "queue":
+        # The first payload is the reset.
+        env.main_buffer.get()
+    action_space = env.env.action_space
+
+    env.step(action_space.sample())
+    if channel == "queue":
+        backlog = env.main_buffer.qsize()
+    elif channel == "ring":
+        appended = env.ring.appended
+        backlog = len(env.ring)
+    else:
+        published = env.mailbox.published
+        overwritten = env.overwritten
+
+    num_steps, seconds, round_trip = measure(
+        lambda: env.step(action_space.sample()), args.duration
+    )
+
+    if channel == "queue":
+        # The queue is consumed in order, payloads the agent hasn't reached pile up.
+        new_backlog = env.main_buffer.qsize()
+        num_env_steps = num_steps + new_backlog - backlog
+        skipped = 0
+    elif channel == "ring":
+        new_backlog = len(env.ring)
+        num_env_steps = env.ring.appended - appended
+        skipped = 0
+    else:
+        new_backlog = 0
+        num_env_steps = env.mailbox.published - published
+        skipped = env.overwritten - overwritten
+    dropped = env.dropped
+    env.worker.terminate()
+    env.close()
+    return {
+        "transport": channel,
+        "num_steps": num_steps,
+        "seconds": seconds,
+        "round_trip": round_trip.summary(),
+        "num_env_steps": num_env_steps,
+        "dropped": dropped,
+        "skipped": skipped,
+        "backlog": new_backlog,
+    }
+
+
+BENCHMARKS = {
+    "simple": benchmark_simple,
+    "multiprocess_shared_memory": lambda env_id, data_rate, args: (
+        benchmark_multiprocess(env_id, data_rate, args, "shared_memory")
+    ),
+    "multiprocess_manager": lambda env_id, data_rate, args: (
+        benchmark_multiprocess(env_id, data_rate, args, "manager")
+    ),
+    "realtime": lambda env_id, data_rate, args: (
+        benchmark_realtime(env_id, data_rate, args, "queue")
+    ),
+    "realtime_mailbox": lambda env_id, data_rate, args: (
+        benchmark_realtime(env_id, data_rate, args, "mailbox")
+    ),
+    "realtime_ring": lambda env_id, data_rate, args: (
+        benchmark_realtime(env_id, data_rate, args, "ring")
+    ),
+}
+
+
+def run(args: Args) -> dict:
+    results = []
+    for env_id in args.env_ids:
+        try:
+            gym.make(env_id).close()
+        except Exception as error:
+            print(f"Skipping {env_id}: {error!r}")
+            results.append({"env_id": env_id, "skipped": repr(error)})
+            continue
+
+        for wrapper in args.wrappers:
+            for data_rate in args.data_rates:
+                result = {
+                    "wrapper": wrapper,
+                    "env_id": env_id,
+                    "requested_data_rate": data_rate,
+                }
+                result.update(BENCHMARKS[wrapper](env_id, data_rate, args))
+                result["sps"] = result["num_steps"] / result["seconds"]
+                result["achieved_data_rate"] = (
+                    result["num_env_steps"] / result["seconds"]
+                )
+                print(
+                    f"{wrapper:28s} {env_id:16s} {data_rate:6d} Hz: "
+                    f"{result['sps']:9.1f} sps, "
+                    f"{result['achieved_data_rate']:9.1f} Hz achieved, "
+                    f"round trip p99 {result['round_trip']['p99'] * 1e3:.3f} ms"
+                )
+                results.append(result)
+    return {"host": host_info(), "args": vars(args), "results": results}
+
+
+if __name__ == "__main__":
+    args = tyro.cli(Args)
+    for wrapper in args.wrappers:
+        assert wrapper in BENCHMARKS, f"unknown wrapper {wrapper}"
+
+    report = run(args)
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"results saved to {args.output}")
@@ -0,0 +1,143 @@
+import os
+import queue
+import random
+import signal
+import threading
+from typing import Any, Dict, Iterable, Optional
+
+import numpy as np
+import torch
+
+# Exit status of a run that checkpointed on a signal and stopped before the end, so
+# whoever launched it knows to run it again (EX_TEMPFAIL).
+PREEMPTED_EXIT_CODE = 75
+
+
+def snapshot(state: Any) -> Any:
+    """A copy of `state` on the cpu: tensors and arrays are copied, containers rebuilt."""
+    if isinstance(state, torch.Tensor):
+        return state.detach().to("cpu", copy=True)
+    if isinstance(state, np.ndarray):
+        return np.array(state)
+    if isinstance(state, dict):
+        return {key: snapshot(value) for key, value in state.items()}
+    if isinstance(state, (list, tuple)):
+        return type(state)(snapshot(value) for value in state)
+    return state
+
+
+def rng_state_dict(generator: np.random.Generator = None) -> dict:
+    state = {
+        "python": random.getstate(),
+        "numpy": np.random.get_state(),
+        "torch": torch.get_rng_state(),
+    }
+    if torch.cuda.is_available():
+        state["cuda"] = torch.cuda.get_rng_state_all()
+    if generator is not None:
+        state["generator"] = generator.bit_generator.state
+    return state
+
+
+def load_rng_state_dict(state: dict, generator: np.random.Generator = None):
+    random.setstate(state["python"])
+    np.random.set_state(state["numpy"])
+    torch.set_rng_state(state["torch"])
+    if "cuda" in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state["cuda"])
+    if generator is not None and "generator" in state:
+        generator.bit_generator.state = state["generator"]
+
+
+class Checkpointer:
+    def __init__(self, directory: str, filename: str = "checkpoint.pt"):
+        """
+        Keeps the latest training state in `directory/filename`.
+        `save` only copies the state, serialising and writing it happen on a background
+            thread. The file is replaced atomically, a run killed mid-write still has
+            the previous checkpoint.
+        `save` waits while an earlier one is still queued behind the one being written.
+        `save` can also write NumPy arrays to other files in `directory` before the
+            state, and remove files the new state no longer refers to after it, e.g.
+            for `replay_buffer.ReplayBufferLog`.
+        After `handle_signals`, the signals set `requested` instead of killing the
+            process, for the training loop to checkpoint and stop at its next step.
+        """
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.path = os.path.join(directory, filename)
+        self.requested = False
+        self._pending = queue.Queue(maxsize=1)
+        self._error = None
+        self._thread = threading.Thread(
+            target=self._write, daemon=True, name="checkpoint"
+        )
+        self._thread.start()
+
+    def handle_signals(self, signals: Iterable[int] = (signal.SIGUSR1, signal.SIGTERM)):
+        def request(signum, frame):
+            self.requested = True
+
+        for signum in signals:
+            signal.signal(signum, request)
+
+    def load(self) -> Optional[dict]:
+        if not os.path.exists(self.path):
+            return None
+        # Holds RNG states and NumPy arrays next to the tensors.
+        return torch.load(self.path, map_location="cpu", weights_only=False)
+
+    def save(
+        self,
+        state: dict,
+        files: Dict[str, Dict[str, np.ndarray]] = None,
+        stale_files: Iterable[str] = (),
+    ):
+        """
+        `files` maps filenames to the arrays saved in them with `np.savez`, they aren't
+            copied and must not change afterwards.
+        """
+        if self._error is not None:
+            raise RuntimeError("writing the last checkpoint failed") from self._error
+        self._pending.put((snapshot(state), files or {}, list(stale_files)))
+
+    def _write(self):
+        while True:
+            item = self._pending.get()
+            try:
+                if item is None:
+                    return
+                state, files, stale_files = item
+                # The state refers to the files, they are on disk before it is.
+                for filename, arrays in files.items():
+                    self._replace(
+                        os.path.join(self.directory, filename),
+                        lambda f: np.savez(f, **arrays),
+                    )
+                self._replace(self.path, lambda f: torch.save(state, f))
+                for filename in stale_files:
+                    os.remove(os.path.join(self.directory, filename))
+            except BaseException as error:
+                self._error = error
+            finally:
+                self._pending.task_done()
+
+    @staticmethod
+    def _replace(path: str, write):
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            write(f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+    def wait(self):
+        """Blocks until the last `save` is on disk."""
+        self._pending.join()
+        if self._error is not None:
+            raise RuntimeError("writing the last checkpoint failed") from self._error
+
+    def close(self):
+        self.wait()
+        self._pending.put(None)
+        self._thread.join()
@@ -0,0 +1,94 @@
+import asyncio
+import time
+from typing import Callable, Union
+
+
+class MonotonicClock:
+    """
+    Wall-clock time.
+    The agent's response time includes everything the host does between steps, so
+        results depend on how fast (and how loaded) the machine is.
+    """
+
+    def mark(self) -> float:
+        return time.monotonic()
+
+    def elapsed(self, mark: float) -> float:
+        return time.monotonic() - mark
+
+
+class ComputeClock:
+    """
+    Virtual clock charged by the CPU time of the thread stepping the environment.
+    Time spent preempted, sleeping or waiting on other processes is not charged, but
+        the measured compute still scales with the speed of the host.
+    """
+
+    def mark(self) -> float:
+        return time.thread_time()
+
+    def elapsed(self, mark: float) -> float:
+        return time.thread_time() - mark
+
+
+class CostModelClock:
+    """
+    Deterministic virtual clock charged by a cost model instead of a measurement.
+    `seconds_per_step` is either a constant, or a function of how many agent steps
+        have been charged so far, e.g. to add the cost of a gradient step every
+        `train_frequency` steps.
+    The same cost model gives the same number of repeated actions on any hardware, and
+        experiments run as fast as the CPU allows.
+    """
+
+    def __init__(self, seconds_per_step: Union[float, Callable[[int], float]]):
+        self.seconds_per_step = seconds_per_step
+        self.num_charged_steps = 0
+
+    def mark(self) -> float:
+        return 0.0
+
+    def elapsed(self, mark: float) -> float:
+        if callable(self.seconds_per_step):
+            seconds = self.seconds_per_step(self.num_charged_steps)
+        else:
+            seconds = self.seconds_per_step
+        self.num_charged_steps += 1
+        return seconds
+
+    def state_dict(self) -> dict:
+        return {"num_charged_steps": self.num_charged_steps}
+
+    def load_state_dict(self, state: dict):
+        self.num_charged_steps = state["num_charged_steps"]
+
+
+class EventLoopClock:
+    """
+    Time of the asyncio event loop the environment is stepped from, see
+        `asyncio_asyncmdp`.
+    The agent's response time includes the time its coroutine waits for the others
+        on the same loop, e.g. for a batched inference to come back.
+    Binds to the running loop on first use, unless `loop` is given.
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop = None):
+        self._loop = loop
+
+    def _time(self) -> float:
+        if self._loop is None:
+            self._loop = asyncio.get_running_loop()
+        return self._loop.time()
+
+    def mark(self) -> float:
+        return self._time()
+
+    def elapsed(self, mark: float) -> float:
+        return self._time() - mark
+
+
+CLOCKS = {
+    "monotonic": MonotonicClock,
+    "compute": ComputeClock,
+    "cost_model": CostModelClock,
+}
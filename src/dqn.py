@@ -1,8 +1,11 @@
 # docs and experiment results can be found at https://docs.cleanrl.dev/rl-algorithms/dqn/#dqnpy
+import json
 import os
+import platform
 import random
+import sys
+import threading
 import time
-from dataclasses import dataclass
 
 import gymnasium as gym
 import numpy as np
@@ -11,9 +14,22 @@ import torch.nn as nn
 import torch.nn.functional as F
 import torch.optim as optim
 import tyro
-from stable_baselines3.common.buffers import ReplayBuffer
 from torch.utils.tensorboard import SummaryWriter
-from simple_asyncmdp import AsynchronousGym
+from action_selector import ActionSelector, compile_network
+from aggregators import DiscountedSumRewards, Trajectory, last_transition
+from checkpoint import (
+    PREEMPTED_EXIT_CODE,
+    Checkpointer,
+    load_rng_state_dict,
+    rng_state_dict,
+)
+from clocks import CLOCKS, CostModelClock
+from dqn_args import Args
+from learner import Learner
+from metrics import Metrics
+from replay_buffer import MemmapReplayBuffer, ReplayBuffer, ReplayBufferLog
+from result_cache import ResultCache, code_revision, config_key
+from simple_asyncmdp import AsynchronousGym, AsynchronousVectorGym
 
 from tqdm import tqdm
 
@@ -59,85 +75,7 @@ poetry run python src/dqn.py \
 """
 
 # TODO(adrian): send the agent a list of tuples, instead of selecting for the agent.
-
-
-@dataclass
-class Args:
-    async_datarate: int = None  # Hz
-    """the data rate of the async environment"""
-    num_repeat_actions: int = None
-    """the number of repeated actions used to be deterministic"""
-    accumulate_rewards: bool = True
-    """should the environment accumulate rewards for the repeated actions"""
-    exp_name: str = os.path.basename(__file__)[: -len(".py")]
-    """the name of this experiment"""
-    seed: int = 1
-    """seed of the experiment"""
-    torch_deterministic: bool = True
-    """if toggled, `torch.backends.cudnn.deterministic=False`"""
-    cuda: bool = True
-    """if toggled, cuda will be enabled by default"""
-    track: bool = False
-    """if toggled, this experiment will be tracked with Weights and Biases"""
-    wandb_project_name: str = "cleanRL"
-    """the wandb's project name"""
-    wandb_entity: str = None
-    """the entity (team) of wandb's project"""
-    capture_video: bool = False
-    """whether to capture videos of the agent performances (check out `videos` folder)"""
-    save_model: bool = False
-    """whether to save model into the `runs/{run_name}` folder"""
-    upload_model: bool = False
-    """whether to upload the saved model to huggingface"""
-    hf_entity: str = ""
-    """the user or org name of the model repository from the Hugging Face Hub"""
-    log_frequency: int = 100
-    """the frequency of logging"""
-
-    # Algorithm specific arguments
-    env_id: str = "CartPole-v1"
-    """the id of the environment"""
-    total_timesteps: int = 300_000
-    """total timesteps of the experiments"""
-    learning_rate: float = 0.003
-    """the learning rate of the optimizer"""
-    num_envs: int = 1
-    """the number of parallel game environments"""
-    buffer_size: int = 10000
-    """the replay memory buffer size"""
-    gamma: float = 0.99
-    """the discount factor gamma"""
-    tau: float = 1.0
-    """the target network update rate"""
-    target_network_frequency: int = 500
-    """the timesteps it takes to update the target network"""
-    batch_size: int = 128
-    """the batch size of sample from the reply memory"""
-    start_e: float = 1
-    """the starting epsilon for exploration"""
-    end_e: float = 0.05
-    """the ending epsilon for exploration"""
-    exploration_fraction: float = 0.25
-    """the fraction of `total-timesteps` it takes from start-e to go end-e"""
-    learning_starts: int = 10000
-    """timestep to start learning"""
-    train_frequency: int = 10
-    """the frequency of training"""
-
-    """
-    poetry run python src/dqn.py --num-envs 1 --env-id MountainCar-v0 --total-timesteps 200_000 --wandb-entity the-orbital-mind --wandb-project-name async-mdp-performance-vs-steprate-mountaincar-v0 --track --seed 0 \
-    --buffer_size 10_000 \
-    --learning_rate 4e-3 \
-    --gamma 0.99  \
-    --target_network_frequency 600 \
-    --batch_size 128 \
-    --start_e 1 \
-    --end_e 0.07 \
-    --exploration_fraction 0.2 \
-    --learning_starts 1_000 \
-    --train_frequency 16
-    1.2e5 = 120,000
-    """
+#   `--async-aggregator trajectory` adds every env step to the replay memory.
 
 
 def make_env(
@@ -173,35 +111,64 @@ class QNetwork(nn.Module):
     def __init__(self, env):
         super().__init__()
         self.network = nn.Sequential(
-            nn.Linear(np.array(env.single_observation_space.shape).prod(), 120),
+            nn.Linear(int(np.array(env.single_observation_space.shape).prod()), 120),
             nn.ReLU(),
             nn.Linear(120, 84),
             nn.ReLU(),
-            nn.Linear(84, env.single_action_space.n),
+            nn.Linear(84, int(env.single_action_space.n)),
         )
 
     def forward(self, x):
         return self.network(x)
 
 
-def linear_schedule(start_e: float, end_e: float, duration: int, t: int):
-    slope = (end_e - start_e) / duration
-    return max(slope * t + start_e, end_e)
+def estimate_flops(network: nn.Module, batch_size: int = 1) -> int:
+    """Multiply-adds of the network's linear layers for a forward pass."""
+    return batch_size * sum(
+        2 * layer.in_features * layer.out_features
+        for layer in network.modules()
+        if isinstance(layer, nn.Linear)
+    )
 
 
-if __name__ == "__main__":
-    import stable_baselines3 as sb3
+def linear_schedule(start_e: float, end_e: float, duration: int, t):
+    """Epsilon at step `t`, or at every step of an array of steps."""
+    slope = (end_e - start_e) / duration
+    return np.maximum(slope * t + start_e, end_e)
 
-    if sb3.__version__ < "2.0":
-        raise ValueError(
-            """Ongoing migration: run the following command to install the new dependencies:
 
-poetry run pip install "stable_baselines3==2.0.0a1"
-"""
-        )
+if __name__ == "__main__":
     args = tyro.cli(Args)
-    assert args.num_envs == 1, "vectorized envs are not supported at the moment"
-    run_name = f"{args.env_id}__{args.exp_name}__{args.seed}__{int(time.monotonic())}"
+    main_start_time = time.monotonic()
+    # Checkpoints and results are keyed by the config, neither is taken for another's.
+    revision = key = None
+    if args.checkpoint_dir is not None or args.result_cache is not None:
+        revision = args.code_revision or code_revision(
+            os.path.dirname(os.path.abspath(__file__))
+        )
+        key = config_key(vars(args), revision)
+    checkpointer = None
+    checkpoint = None
+    if args.checkpoint_dir is not None:
+        checkpointer = Checkpointer(args.checkpoint_dir)
+        checkpoint = checkpointer.load()
+        if checkpoint is not None and checkpoint.get("config_key") != key:
+            sys.exit(
+                f"{checkpointer.path} is of another config or code revision, "
+                "not resuming from it"
+            )
+        if checkpoint is not None and checkpoint["agent_step"] >= args.total_timesteps:
+            print(f"{checkpointer.path} is at the end of the run, nothing to do")
+            sys.exit(0)
+        # The signals only ask for a checkpoint, the loop takes it at its next step.
+        checkpointer.handle_signals()
+
+    if checkpoint is not None:
+        run_name = checkpoint["run_name"]
+    else:
+        run_name = (
+            f"{args.env_id}__{args.exp_name}__{args.seed}__{int(time.monotonic())}"
+        )
     if args.track:
         import wandb
 
@@ -213,6 +180,8 @@ poetry run pip install "stable_baselines3==2.0.0a1"
             name=run_name,
             monitor_gym=True,
             save_code=True,
+            id=checkpoint["wandb_id"] if checkpoint is not None else None,
+            resume="allow",
         )
     writer = SummaryWriter(f"runs/{run_name}")
     writer.add_text(
@@ -220,6 +189,8 @@ poetry run pip install "stable_baselines3==2.0.0a1"
         "|param|value|\n|-|-|\n%s"
         % ("\n".join([f"|{key}|{value}|" for key, value in vars(args).items()])),
     )
+    # per-step scalars, logged every `log_frequency` steps as mean/p50/p99
+    metrics = Metrics(writer, capacity=args.metrics_capacity)
 
     # TRY NOT TO MODIFY: seeding
     random.seed(args.seed)
@@ -229,20 +200,41 @@ poetry run pip install "stable_baselines3==2.0.0a1"
 
     device = torch.device("cuda" if torch.cuda.is_available() and args.cuda else "cpu")
 
-    # env setup
-    envs = gym.vector.SyncVectorEnv(
-        [
-            make_env(
-                args.env_id,
-                args.seed + i,
-                i,
-                args.capture_video,
-                run_name,
-                args.async_datarate,
-            )
-            for i in range(args.num_envs)
-        ]
-    )
+    # env setup, async envs share one clock across the whole batch
+    env_fns = [
+        make_env(
+            args.env_id,
+            args.seed + i,
+            i,
+            args.capture_video,
+            run_name,
+            async_datarate=None,
+        )
+        for i in range(args.num_envs)
+    ]
+    if args.async_datarate is not None and args.async_vector_backend == "subprocess":
+        from async_vector_env import AsyncVectorGym
+
+        envs = AsyncVectorGym(env_fns, environment_steps_per_second=args.async_datarate)
+    elif args.async_datarate is not None:
+        assert (
+            args.async_aggregator != "trajectory" or args.num_envs == 1
+        ), "the trajectory aggregator adds a different number of steps per env, it needs --num-envs 1"
+        aggregator_fns = {
+            "sum": None,
+            "discounted": lambda env: DiscountedSumRewards(args.gamma),
+            "trajectory": lambda env: Trajectory(
+                env.observation_space, gamma=args.gamma
+            ),
+        }
+        envs = AsynchronousVectorGym(
+            env_fns,
+            environment_steps_per_second=args.async_datarate,
+            aggregator_fn=aggregator_fns[args.async_aggregator],
+            record_latency=args.async_latency_histograms,
+        )
+    else:
+        envs = gym.vector.SyncVectorEnv(env_fns)
     assert isinstance(
         envs.single_action_space, gym.spaces.Discrete
     ), "only discrete action space is supported"
@@ -254,40 +246,267 @@ poetry run pip install "stable_baselines3==2.0.0a1"
 
     print("network params ", sum(p.numel() for p in target_network.parameters()))
 
-    rb = ReplayBuffer(
-        args.buffer_size,
+    # The actor acts with its own copy of the weights, so it never reads them mid-update.
+    if args.async_learner:
+        actor_network = QNetwork(envs).to(device)
+        actor_network.load_state_dict(q_network.state_dict())
+    else:
+        actor_network = q_network
+    action_selector = ActionSelector(
+        compile_network(actor_network, args.q_network_compile),
         envs.single_observation_space,
         envs.single_action_space,
+        args.num_envs,
         device,
-        handle_timeout_termination=False,
+        seed=args.seed,
     )
 
-    # TRY NOT TO MODIFY: start the game
-    obs, _ = envs.reset(seed=args.seed)
+    if args.async_datarate is not None and args.async_vector_backend == "sync":
+        if args.async_clock == "cost_model":
+            inference_flops = estimate_flops(q_network, args.num_envs)
+            # forward and backward of the online network, forward of the target network
+            train_flops = 4 * estimate_flops(q_network, args.batch_size)
+
+            def seconds_per_step(num_charged_steps):
+                # The step charged now trained at the end of the previous agent step.
+                agent_step = num_charged_steps
+                trained = (
+                    agent_step > args.learning_starts
+                    and agent_step % args.train_frequency == 0
+                )
+                if args.async_learner:
+                    trained = False
+                flops = inference_flops + (train_flops if trained else 0)
+                return flops / args.async_flops_per_second
 
-    episodic_return_running_avg = 0
-    episodic_return_running_length = 0
-    number_of_times_logged = 0
-    for agent_step in tqdm(range(args.total_timesteps)):
-        start_time = time.monotonic()
-        dstart_time = time.monotonic()
-        # ALGO LOGIC: put action logic here
-        epsilon = linear_schedule(
-            args.start_e,
-            args.end_e,
-            args.exploration_fraction * args.total_timesteps,
-            agent_step,
+            envs.clock = CostModelClock(seconds_per_step)
+        else:
+            envs.clock = CLOCKS[args.async_clock]()
+
+    if args.buffer_dir is not None:
+        rb = MemmapReplayBuffer(
+            args.buffer_size,
+            envs.single_observation_space,
+            envs.single_action_space,
+            os.path.join(
+                (
+                    os.path.join(os.environ["SLURM_TMPDIR"], "replay_buffer")
+                    if args.buffer_dir == "slurm"
+                    else args.buffer_dir
+                ),
+                run_name,
+            ),
+            device,
+            n_envs=args.num_envs,
         )
-        if random.random() < epsilon:  # or agent_step < args.learning_starts
-            actions = np.array(
-                [envs.single_action_space.sample() for _ in range(envs.num_envs)]
-            )
+    else:
+        rb = ReplayBuffer(
+            args.buffer_size,
+            envs.single_observation_space,
+            envs.single_action_space,
+            device,
+            n_envs=args.num_envs,
+        )
+    rb_log = ReplayBufferLog(rb, run_name) if checkpointer is not None else None
+
+    # Held by the actor while adding to the buffer and syncing weights, and by the learner
+    # while sampling and updating.
+    buffer_lock = threading.Lock()
+    network_lock = threading.Lock()
+
+    def train(agent_step):
+        with buffer_lock:
+            data = rb.sample(args.batch_size)
+        with network_lock:
+            with torch.no_grad():
+                target_max, _ = target_network(data.next_observations).max(dim=1)
+                td_target = data.rewards.flatten() + data.discounts.flatten() * (
+                    target_max * (1 - data.dones.flatten())
+                )
+            old_val = q_network(data.observations).gather(1, data.actions).squeeze()
+            loss = F.mse_loss(td_target, old_val)
+
+            metrics.record("agent_losses/td_loss", loss)
+            metrics.record("agent_losses/q_values", old_val.mean())
+
+            # optimize the model
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+
+    # How the async envs summarise repeated steps, only the `sync` backend has a choice.
+    aggregator = (
+        args.async_aggregator
+        if args.async_datarate is not None and args.async_vector_backend == "sync"
+        else "sum"
+    )
+
+    def add_trajectory(obs, real_next_obs, actions, terminations, infos):
+        """
+        Adds every env step behind the agent's step as a transition of its own, playing
+            the agent's action, instead of one transition summing them.
+        """
+        if "final_info" in infos:
+            trajectory = infos["final_info"][0]["trajectory"]
         else:
-            q_values = q_network(torch.Tensor(obs).to(device))
-            actions = torch.argmax(q_values, dim=1).cpu().numpy()
+            trajectory = infos["trajectory"][0]
+        observations, step_rewards = trajectory["observations"], trajectory["rewards"]
+        # Steps past the aggregator's `max_steps` weren't recorded, the last transition
+        # spans them with their discounted reward.
+        num_intermediate = len(step_rewards) - (0 if trajectory["num_dropped"] else 1)
+        previous_obs = obs
+        for step in range(num_intermediate):
+            step_obs = observations[step : step + 1]
+            rb.add(
+                previous_obs,
+                step_obs,
+                actions,
+                step_rewards[step : step + 1],
+                np.zeros(1, dtype=bool),
+                infos,
+                discount=args.gamma,
+            )
+            previous_obs = step_obs
+        reward, discount = last_transition(trajectory, args.gamma)
+        rb.add(
+            previous_obs,
+            real_next_obs,
+            actions,
+            np.full(1, reward, dtype=np.float32),
+            terminations,
+            infos,
+            discount=discount,
+        )
+
+    def update_target_network(agent_step):
+        writer.add_scalar("dqn/update_target_network", 1, agent_step)
+        with network_lock:
+            for target_network_param, q_network_param in zip(
+                target_network.parameters(), q_network.parameters()
+            ):
+                target_network_param.data.copy_(
+                    args.tau * q_network_param.data
+                    + (1.0 - args.tau) * target_network_param.data
+                )
+
+    # The learner's i-th update stands for the i-th training step of the inline loop.
+    first_train_step = (
+        args.learning_starts // args.train_frequency + 1
+    ) * args.train_frequency
+
+    def learner_update(update_index):
+        agent_step = first_train_step + update_index * args.train_frequency
+        train(agent_step)
+        # update the target network whenever a multiple of its frequency was crossed
+        previous_step = agent_step - args.train_frequency
+        if (
+            agent_step // args.target_network_frequency
+            > max(previous_step, args.learning_starts) // args.target_network_frequency
+        ):
+            update_target_network(agent_step)
+        if update_index % args.log_frequency == 0:
+            writer.add_scalar(
+                "learner/updates_per_second",
+                learner.updates_per_second(),
+                agent_step,
+            )
+            writer.add_scalar("learner/lag", learner.lag, agent_step)
+
+    start_step = 0
+    if checkpoint is not None:
+        start_step = checkpoint["agent_step"]
+        q_network.load_state_dict(checkpoint["q_network"])
+        target_network.load_state_dict(checkpoint["target_network"])
+        optimizer.load_state_dict(checkpoint["optimizer"])
+        if args.async_learner:
+            actor_network.load_state_dict(checkpoint["q_network"])
+        rb_log.restore(checkpoint["replay_buffer"], checkpointer.directory)
+        if checkpoint["envs"] is not None:
+            envs.load_state_dict(checkpoint["envs"])
+        load_rng_state_dict(checkpoint["rng"], action_selector.rng)
+        print(f"resuming from {checkpointer.path} at step {start_step}")
+
+    if args.async_learner:
+        learner = Learner(
+            learner_update,
+            num_updates=checkpoint["learner_updates"] if checkpoint is not None else 0,
+        )
+        learner.start()
+
+    def save_checkpoint(agent_step):
+        """Checkpoints the run, to resume at `agent_step`."""
+        if args.async_learner:
+            learner.drain()
+        # Only copies the state, it's written on the checkpointer's thread. Of the
+        # replay buffer, only the rows added since the last checkpoint are copied.
+        with buffer_lock:
+            buffer_state, buffer_files, stale_buffer_files = rb_log.checkpoint()
+        with network_lock:
+            checkpointer.save(
+                {
+                    "agent_step": agent_step,
+                    "config_key": key,
+                    "run_name": run_name,
+                    "wandb_id": wandb.run.id if args.track else None,
+                    "q_network": q_network.state_dict(),
+                    "target_network": target_network.state_dict(),
+                    "optimizer": optimizer.state_dict(),
+                    "learner_updates": learner.num_updates if args.async_learner else 0,
+                    "replay_buffer": buffer_state,
+                    "envs": (
+                        envs.state_dict() if hasattr(envs, "state_dict") else None
+                    ),
+                    "rng": rng_state_dict(action_selector.rng),
+                },
+                files=buffer_files,
+                stale_files=stale_buffer_files,
+            )
+
+    # TRY NOT TO MODIFY: start the game
+    # A resumed run starts new episodes, the replay buffer keeps the cut one apart.
+    obs, _ = envs.reset(seed=args.seed + start_step)
+
+    epsilons = linear_schedule(
+        args.start_e,
+        args.end_e,
+        args.exploration_fraction * args.total_timesteps,
+        np.arange(args.total_timesteps),
+    )
+    # The async envs' per-step infos, looked up once instead of on every step.
+    environment_metrics = None
+
+    # Everything the agent does between two env steps, other than acting and training,
+    # delays its response like inference does. The lean loop only times the step
+    # ahead of each log.
+    progress = tqdm(total=args.total_timesteps, initial=start_step)
+    progress_frequency = args.log_frequency if args.lean_loop else 1
+    env_step_end_time = None
+    train_time = 0.0
+    log_start_time = time.monotonic()
+    log_start_step = start_step
+    loop_start_time = log_start_time
+    for agent_step in range(start_step, args.total_timesteps):
+        timed = not args.lean_loop or (agent_step + 1) % args.log_frequency == 0
+        dstart_time = time.monotonic()
+        if env_step_end_time is not None:
+            metrics.record(
+                "agent/loop_overhead", dstart_time - env_step_end_time - train_time
+            )
+            env_step_end_time = None
+        # ALGO LOGIC: put action logic here
+        actions = action_selector(obs, epsilons[agent_step])
 
         # TRY NOT TO MODIFY: execute the game and log data.
         next_obs, rewards, terminations, truncations, infos = envs.step(actions)
+        if timed:
+            env_step_end_time = time.monotonic()
+        train_time = 0.0
+        if environment_metrics is None:
+            environment_metrics = [
+                name
+                for name in ("num_repeat_actions", "agent_response_time", "ratio")
+                if name in infos
+            ]
 
         # TRY NOT TO MODIFY: record rewards for plotting purposes
         if "final_info" in infos:
@@ -299,96 +518,137 @@ poetry run pip install "stable_baselines3==2.0.0a1"
                     writer.add_scalar(
                         "charts/episodic_length", info["episode"]["l"], agent_step
                     )
+                for name, summary in (info or {}).get("latency", {}).items():
+                    for statistic in ("p50", "p90", "p99", "p99.9"):
+                        writer.add_scalar(
+                            f"latency/{name}_{statistic}",
+                            summary[statistic],
+                            agent_step,
+                        )
 
         # TRY NOT TO MODIFY: save data to reply buffer; handle `final_observation`
         real_next_obs = next_obs.copy()
         for idx, trunc in enumerate(truncations):
             if trunc:
                 real_next_obs[idx] = infos["final_observation"][idx]
-        rb.add(obs, real_next_obs, actions, rewards, terminations, infos)
+        with buffer_lock:
+            if aggregator == "trajectory":
+                add_trajectory(obs, real_next_obs, actions, terminations, infos)
+            else:
+                rb.add(
+                    obs,
+                    real_next_obs,
+                    actions,
+                    rewards,
+                    terminations,
+                    infos,
+                    # `discounted` rewards span the repeated env steps, so does the
+                    # discount of the value bootstrapped after them.
+                    discount=(
+                        args.gamma ** infos["num_steps"]
+                        if aggregator == "discounted"
+                        else args.gamma
+                    ),
+                )
 
         # TRY NOT TO MODIFY: CRUCIAL step easy to overlook
         obs = next_obs
 
         # ALGO LOGIC: training.
-        if agent_step > args.learning_starts:
-            if agent_step % args.train_frequency == 0:
-                data = rb.sample(args.batch_size)
-                with torch.no_grad():
-                    target_max, _ = target_network(data.next_observations).max(dim=1)
-                    td_target = data.rewards.flatten() + args.gamma * target_max * (
-                        1 - data.dones.flatten()
-                    )
-                old_val = q_network(data.observations).gather(1, data.actions).squeeze()
-                loss = F.mse_loss(td_target, old_val)
-
-                writer.add_scalar("agent_losses/td_loss", loss, agent_step)
-                writer.add_scalar(
-                    "agent_losses/q_values", old_val.mean().item(), agent_step
+        if args.async_learner:
+            if agent_step >= first_train_step:
+                learner.allow(
+                    (agent_step - first_train_step) // args.train_frequency + 1
                 )
-
-                # optimize the model
-                optimizer.zero_grad()
-                loss.backward()
-                optimizer.step()
+            if agent_step % args.actor_sync_frequency == 0:
+                with network_lock:
+                    actor_network.load_state_dict(q_network.state_dict())
+        elif agent_step > args.learning_starts:
+            train_start_time = time.monotonic()
+            if agent_step % args.train_frequency == 0:
+                train(agent_step)
 
             # update target network
             if agent_step % args.target_network_frequency == 0:
-                writer.add_scalar(
-                    "dqn/update_target_network",
-                    int(agent_step % args.target_network_frequency == 0),
-                    agent_step,
-                )
-                for target_network_param, q_network_param in zip(
-                    target_network.parameters(), q_network.parameters()
-                ):
-                    target_network_param.data.copy_(
-                        args.tau * q_network_param.data
-                        + (1.0 - args.tau) * target_network_param.data
-                    )
-
-        end_time = time.monotonic()
-        sps = agent_step / (end_time - start_time)
-        dsps = 1 / (end_time - dstart_time)
-
-        if agent_step % args.log_frequency == 0:
-            writer.add_scalar(
-                "agent/step_sps",
-                dsps,
-                agent_step,
-            )
-            writer.add_scalar(
-                "agent/step_dt",
-                end_time - dstart_time,
-                agent_step,
-            )
-
-            if "num_repeat_actions" in infos:
-                writer.add_scalar(
-                    "environment/num_repeat_actions",
-                    infos["num_repeat_actions"],
-                    agent_step,
-                )
-
-            if "agent_response_time" in infos:
-                writer.add_scalar(
-                    "environment/agent_response_time",
-                    infos["agent_response_time"],
-                    agent_step,
-                )
-
-            if "ratio" in infos:
-                writer.add_scalar(
-                    "environment/ratio",
-                    infos["ratio"],
-                    agent_step,
-                )
+                update_target_network(agent_step)
+            train_time = time.monotonic() - train_start_time
+
+        log = agent_step % args.log_frequency == 0
+        if not args.lean_loop:
+            end_time = time.monotonic()
+            metrics.record("agent/step_sps", 1 / (end_time - dstart_time))
+            metrics.record("agent/step_dt", end_time - dstart_time)
+        elif log and agent_step > log_start_step:
+            # The mean step over the last `log_frequency` steps.
+            end_time = time.monotonic()
+            step_dt = (end_time - log_start_time) / (agent_step - log_start_step)
+            metrics.record("agent/step_sps", 1 / step_dt)
+            metrics.record("agent/step_dt", step_dt)
+            log_start_time, log_start_step = end_time, agent_step
+        if not args.lean_loop or log:
+            for name in environment_metrics:
+                metrics.record(f"environment/{name}", infos[name].mean())
+        if agent_step % progress_frequency == 0:
+            progress.update(agent_step + 1 - progress.n)
+        if log:
+            metrics.flush(agent_step)
+
+        if checkpointer is not None and (
+            (agent_step + 1) % args.checkpoint_frequency == 0
+            or agent_step + 1 == args.total_timesteps
+            or checkpointer.requested
+        ):
+            save_checkpoint(agent_step + 1)
+            if checkpointer.requested:
+                break
+
+    loop_seconds = time.monotonic() - loop_start_time
+
+    def log_run(end_step):
+        """Appends how long the steps from `start_step` to `end_step` took to the run log."""
+        if args.run_log is None:
+            return
+        record = {
+            "env_id": args.env_id,
+            "async_datarate": args.async_datarate,
+            "cluster": os.getenv("SLURM_CLUSTERID"),
+            "hostname": platform.node(),
+            "processor": platform.processor(),
+            "steps": end_step - start_step,
+            "loop_seconds": loop_seconds,
+            "seconds": time.monotonic() - main_start_time,
+            "sps": (end_step - start_step) / loop_seconds,
+            "args": vars(args),
+        }
+        # One write in append mode, lines from runs sharing the log don't interleave.
+        with open(args.run_log, "a") as f:
+            f.write(json.dumps(record) + "\n")
+
+    if args.async_learner:
+        learner.stop()
+        print(f"learner updates/sec {learner.updates_per_second():.1f}")
+
+    if checkpointer is not None:
+        checkpointer.close()
+        if checkpointer.requested:
+            progress.close()
+            print(f"checkpointed at step {agent_step + 1}, stopping early")
+            envs.close()
+            if args.buffer_dir is not None:
+                rb.close()
+            metrics.close(agent_step + 1)
+            writer.close()
+            log_run(agent_step + 1)
+            sys.exit(PREEMPTED_EXIT_CODE)
+
+    progress.update(args.total_timesteps - progress.n)
+    progress.close()
 
     if args.save_model:
         model_path = f"runs/{run_name}/{args.exp_name}.cleanrl_model"
         torch.save(q_network.state_dict(), model_path)
         print(f"model saved to {model_path}")
-        from src.dqn_eval import evaluate
+        from dqn_eval import evaluate
 
         episodic_returns = evaluate(
             model_path,
@@ -404,5 +664,25 @@ poetry run pip install "stable_baselines3==2.0.0a1"
         for idx, episodic_return in enumerate(episodic_returns):
             writer.add_scalar("eval/episodic_return", episodic_return, idx)
 
+    if args.buffer_dir is not None:
+        rb.close()
     envs.close()
+    metrics.close(args.total_timesteps)
     writer.close()
+    log_run(args.total_timesteps)
+
+    if args.result_cache is not None:
+        ResultCache(args.result_cache).put(
+            key,
+            {
+                "run_name": run_name,
+                "revision": revision,
+                "args": vars(args),
+                "run_dir": os.path.abspath(f"runs/{run_name}"),
+                "model_path": os.path.abspath(model_path) if args.save_model else None,
+                "checkpoint_dir": args.checkpoint_dir,
+                "wandb_url": wandb.run.url if args.track else None,
+                "finished_at": time.time(),
+            },
+        )
+        print(f"result stored in {args.result_cache} under {key}")
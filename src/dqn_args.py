@@ -0,0 +1,117 @@
+"""
+The arguments of `dqn.py`, apart from it so they can be resolved without importing
+torch, e.g. by `job_submitter.py` to key runs.
+"""
+
+from dataclasses import dataclass
+
+
+@dataclass
+class Args:
+    async_datarate: int = None  # Hz
+    """the data rate of the async environment"""
+    async_vector_backend: str = "sync"
+    """how async envs are stepped: `sync` in this process, or `subprocess` with one real-time worker per env"""
+    async_clock: str = "monotonic"
+    """the clock measuring the agent's response time with the `sync` backend: `monotonic`, `compute` or `cost_model`"""
+    async_flops_per_second: float = 1e9
+    """the compute speed assumed by the `cost_model` clock to turn the QNetwork's FLOPs into seconds"""
+    async_aggregator: str = "sum"
+    """how repeated steps are summarised with the `sync` backend: `sum`, `discounted` (by gamma, bootstrapping with gamma to the number of env steps) or `trajectory` (every env step is a transition, needs `num-envs 1`)"""
+    async_latency_histograms: bool = False
+    """if toggled, the `sync` backend records latency histograms and logs their per-episode percentiles under `latency/`"""
+    num_repeat_actions: int = None
+    """the number of repeated actions used to be deterministic"""
+    accumulate_rewards: bool = True
+    """should the environment accumulate rewards for the repeated actions"""
+    exp_name: str = "dqn"
+    """the name of this experiment"""
+    seed: int = 1
+    """seed of the experiment"""
+    torch_deterministic: bool = True
+    """if toggled, `torch.backends.cudnn.deterministic=False`"""
+    cuda: bool = True
+    """if toggled, cuda will be enabled by default"""
+    track: bool = False
+    """if toggled, this experiment will be tracked with Weights and Biases"""
+    wandb_project_name: str = "cleanRL"
+    """the wandb's project name"""
+    wandb_entity: str = None
+    """the entity (team) of wandb's project"""
+    capture_video: bool = False
+    """whether to capture videos of the agent performances (check out `videos` folder)"""
+    save_model: bool = False
+    """whether to save model into the `runs/{run_name}` folder"""
+    upload_model: bool = False
+    """whether to upload the saved model to huggingface"""
+    hf_entity: str = ""
+    """the user or org name of the model repository from the Hugging Face Hub"""
+    log_frequency: int = 100
+    """the frequency of logging"""
+    metrics_capacity: int = 1024
+    """the number of values of each metric kept between two logs, older ones are dropped"""
+    checkpoint_dir: str = None
+    """if set, the run is checkpointed into this directory every `checkpoint-frequency` steps and on SIGUSR1/SIGTERM, and resumes from the checkpoint it finds there"""
+    checkpoint_frequency: int = 25_000
+    """the timesteps between checkpoints"""
+    run_log: str = None
+    """if set, a JSON line with the run's config, hardware and measured speed is appended to this file when the run stops, for `job_submitter.RuntimeModel`"""
+    result_cache: str = None
+    """if set, a finished run stores where its outputs are in this directory, under a hash of its args and the code revision, see `result_cache.ResultCache`"""
+    code_revision: str = None
+    """the code revision the run's results and checkpoints are keyed by, `result_cache.code_revision` of this checkout by default; the job submitter passes its own"""
+
+    # Algorithm specific arguments
+    env_id: str = "CartPole-v1"
+    """the id of the environment"""
+    total_timesteps: int = 300_000
+    """total timesteps of the experiments"""
+    learning_rate: float = 0.003
+    """the learning rate of the optimizer"""
+    num_envs: int = 1
+    """the number of parallel game environments"""
+    buffer_size: int = 10000
+    """the replay memory buffer size"""
+    buffer_dir: str = None
+    """if set, the replay memory is memory-mapped from files in `{buffer-dir}/{run_name}` (`slurm` for `$SLURM_TMPDIR/replay_buffer`), which are removed when the run stops; it resumes from the checkpoint"""
+    gamma: float = 0.99
+    """the discount factor gamma"""
+    tau: float = 1.0
+    """the target network update rate"""
+    target_network_frequency: int = 500
+    """the timesteps it takes to update the target network"""
+    batch_size: int = 128
+    """the batch size of sample from the reply memory"""
+    start_e: float = 1
+    """the starting epsilon for exploration"""
+    end_e: float = 0.05
+    """the ending epsilon for exploration"""
+    exploration_fraction: float = 0.25
+    """the fraction of `total-timesteps` it takes from start-e to go end-e"""
+    learning_starts: int = 10000
+    """timestep to start learning"""
+    train_frequency: int = 10
+    """the frequency of training"""
+    async_learner: bool = False
+    """if toggled, gradient steps run on a learner thread and the actor acts with a periodically synced copy of the QNetwork"""
+    actor_sync_frequency: int = 100
+    """the timesteps between copies of the learner's QNetwork weights into the actor's, with `--async-learner`"""
+    q_network_compile: str = None
+    """if set, the QNetwork picking actions is compiled for inference: `script` (TorchScript) or `compile` (`torch.compile`)"""
+    lean_loop: bool = False
+    """if toggled, per-step timings, environment metrics and progress updates are only taken once every `log-frequency` steps"""
+
+    """
+    poetry run python src/dqn.py --num-envs 1 --env-id MountainCar-v0 --total-timesteps 200_000 --wandb-entity the-orbital-mind --wandb-project-name async-mdp-performance-vs-steprate-mountaincar-v0 --track --seed 0 \
+    --buffer_size 10_000 \
+    --learning_rate 4e-3 \
+    --gamma 0.99  \
+    --target_network_frequency 600 \
+    --batch_size 128 \
+    --start_e 1 \
+    --end_e 0.07 \
+    --exploration_fraction 0.2 \
+    --learning_starts 1_000 \
+    --train_frequency 16
+    1.2e5 = 120,000
+    """
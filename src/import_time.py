@@ -0,0 +1,120 @@
+"""
+Measures what importing the modules a job starts with costs, with
+`python -X importtime`, and checks it against a budget so that slow or optional
+imports don't creep back into the start-up of every run of a sweep.
+
+PYTHONPATH=./src python src/import_time.py
+PYTHONPATH=./src python src/import_time.py --modules dqn --repeats 10 --top 20
+"""
+
+import statistics
+import subprocess
+import sys
+from dataclasses import dataclass, field
+from typing import Dict, List, Tuple
+
+import tyro
+
+# Milliseconds, the median over fresh interpreters once the files are in the page
+# cache. torch is most of `dqn`'s.
+IMPORT_BUDGETS_MS = {
+    "dqn": 3500,
+    "simple_asyncmdp": 400,
+    "multiprocess_asyncmdp": 450,
+    "asyncio_asyncmdp": 450,
+    # Resolved by the job submitter, which must not need torch for it.
+    "dqn_args": 100,
+}
+
+# Only needed on optional paths: tracking, video capture, evaluation and uploads, the
+# `subprocess` backend and the legacy gym API. Importing them at start-up fails.
+DEFERRED_MODULES = (
+    "wandb",
+    "stable_baselines3",
+    "huggingface_hub",
+    "moviepy",
+    "cleanrl",
+    "gym",
+    "dqn_eval",
+    "async_vector_env",
+)
+
+
+@dataclass
+class Args:
+    modules: List[str] = field(default_factory=lambda: list(IMPORT_BUDGETS_MS))
+    """the modules to import, each in a fresh interpreter"""
+    repeats: int = 5
+    """the imports timed per module, after one that warms the page cache"""
+    top: int = 10
+    """the number of the module's slowest imports to print"""
+    budget_scale: float = 1.0
+    """multiplies the budgets, for machines slower than the ones they were set on"""
+
+
+def measure(module: str) -> List[Tuple[int, str, int, int]]:
+    """
+    `(depth, name, self_us, cumulative_us)` for every module loaded by importing
+        `module`, in the order `-X importtime` reports them: each after its imports.
+    """
+    process = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True,
+        text=True,
+    )
+    if process.returncode != 0:
+        raise RuntimeError(f"importing {module} failed:\n{process.stderr[-2000:]}")
+
+    imports = []
+    for line in process.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:") :].split("|")
+        # One space after the bar, then two per level of nesting.
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        imports.append((depth, name.strip(), int(self_us), int(cumulative_us)))
+    return imports
+
+
+def check(module: str, args: Args) -> List[str]:
+    """Prints the import time of `module`, returns what is wrong with it."""
+    measure(module)
+    runs = [measure(module) for _ in range(args.repeats)]
+    milliseconds = statistics.median(
+        next(cumulative for _, name, _, cumulative in run if name == module) / 1e3
+        for run in runs
+    )
+    budget = IMPORT_BUDGETS_MS.get(module)
+    budget = budget * args.budget_scale if budget is not None else None
+    print(
+        f"{module}: {milliseconds:.0f} ms"
+        + (f" (budget {budget:.0f} ms)" if budget is not None else "")
+    )
+
+    # The slowest direct imports of the last run, each also counts what it imports.
+    slowest: Dict[str, int] = {
+        name: cumulative for depth, name, _, cumulative in runs[-1] if depth == 1
+    }
+    for name, cumulative in sorted(slowest.items(), key=lambda item: -item[1])[
+        : args.top
+    ]:
+        print(f"\t{cumulative / 1e3:8.1f} ms  {name}")
+
+    problems = []
+    if budget is not None and milliseconds > budget:
+        problems.append(f"{module} takes {milliseconds:.0f} ms, over {budget:.0f} ms")
+    loaded = {name for _, name, _, _ in runs[-1]}
+    for name in DEFERRED_MODULES:
+        if name in loaded:
+            problems.append(f"{module} imports {name}, which should only be deferred")
+    return problems
+
+
+if __name__ == "__main__":
+    args = tyro.cli(Args)
+    problems = []
+    for module in args.modules:
+        problems += check(module, args)
+    for problem in problems:
+        print(f"FAIL: {problem}")
+    sys.exit(1 if problems else 0)
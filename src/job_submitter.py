@@ -1,6 +1,32 @@
+import functools
 import itertools
+import json
 import math
 import os
+import queue
+import shlex
+import signal
+import statistics
+import subprocess
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from result_cache import ResultCache, code_revision, config_key, resolve_args
+
+# Environment data rates (Hz) swept by `simplified_async_interface_with_dqn`, also the
+# default rates of `benchmark.py`.
+DATA_RATES = [500, 1000, 1500, 2000, 2500, 3000, 3500, 4000]
+
+# Exit status of a run that checkpointed and stopped early, see
+# `checkpoint.PREEMPTED_EXIT_CODE` (not imported, it would pull in torch).
+PREEMPTED_EXIT_CODE = 75
+
+# The time limit of one allocation (`slurm_job.sh`), and what copying the venv and
+# cloning the repository takes at its start.
+MAX_ALLOCATION_SECONDS = 2 * 3600 + 59 * 60
+SETUP_SECONDS = 3 * 60
 
 
 def convert_job_dic_to_key(job_dic: dict) -> str:
@@ -124,10 +150,328 @@ def simplified_async_interface_with_dqn(env_name="CartPole-v1", num_seeds=10):
 
     # yield from experiment_run(defaults=defaults, seed=0, data_rate=0)
 
-    for data_rate in [500, 1000, 1500, 2000, 2500, 3000, 3500, 4000]:
+    for data_rate in DATA_RATES:
         yield from experiment_run(defaults=defaults, seed=0, data_rate=data_rate)
 
 
+def command_line(run_list: List[str], job_dic: dict) -> str:
+    return " ".join(
+        run_list
+        + [
+            f"--{k} {v}" if type(v) != bool else f"--{k}"
+            for k, v in job_dic.items()
+            if k not in ("algo", "command")
+        ]
+    )
+
+
+def expand_seeds(jobs: Dict[str, dict], seeds: Iterable[int]) -> Dict[str, dict]:
+    """One job per seed for the jobs without one, as the array of `slurm_job.sh` does."""
+    expanded = {}
+    for job_UID, job_dic in jobs.items():
+        if "seed" in job_dic:
+            expanded[job_UID] = job_dic
+            continue
+        for seed in seeds:
+            expanded[f"{job_UID}-{seed}"] = dict(job_dic, seed=seed)
+    return expanded
+
+
+def estimate_runtime(job_dic: dict) -> float:
+    """
+    Seconds a run is expected to take: start-up, plus its steps at 100 sps or at the
+        env's data rate, whichever is slower.
+    """
+    total_timesteps = job_dic.get("total-timesteps", 300_000)
+    data_rate = job_dic.get("async-datarate")
+    return 120 + max(
+        total_timesteps / 100,
+        math.ceil(total_timesteps / data_rate) if data_rate else 0,
+    )
+
+
+def speed_config(args: dict) -> tuple:
+    """
+    The args of a run, as `dqn.py` resolves them, that change how fast it steps
+        besides its env and data rate.
+    """
+    return (
+        args.get("total_timesteps"),
+        args.get("lean_loop"),
+        args.get("async_learner"),
+        args.get("num_envs"),
+        args.get("async_vector_backend"),
+        # memory-mapped or in memory
+        args.get("buffer_dir") is not None,
+    )
+
+
+class RuntimeModel:
+    def __init__(self, records: List[dict], margin: float = 1.2):
+        """
+        Expected run times fitted on the records `dqn.py --run-log` appends.
+        A run takes the median overhead (start-up, evaluation, ...) of the runs on its
+            cluster, plus its steps at the median sps measured for its env, data rate,
+            cluster and `speed_config`. Data rates that weren't measured are
+            interpolated between the nearest ones with the rest the same.
+        Estimates are padded by `margin`, runs without a comparable record fall back
+            to `estimate_runtime`, padded too.
+        """
+        self.margin = margin
+        sps = {}
+        overheads = {}
+        for record in records:
+            key = (
+                record["env_id"],
+                record["async_datarate"],
+                record["cluster"],
+                speed_config(record.get("args", {})),
+            )
+            sps.setdefault(key, []).append(record["sps"])
+            overheads.setdefault(record["cluster"], []).append(
+                record["seconds"] - record["loop_seconds"]
+            )
+        self._sps = {key: statistics.median(values) for key, values in sps.items()}
+        self._overheads = {
+            cluster: statistics.median(values) for cluster, values in overheads.items()
+        }
+
+    @classmethod
+    def load(cls, path: str, **kwargs) -> "RuntimeModel":
+        records = []
+        if os.path.exists(path):
+            with open(path) as f:
+                records = [json.loads(line) for line in f if line.strip()]
+        return cls(records, **kwargs)
+
+    def __len__(self) -> int:
+        return len(self._sps)
+
+    def sps(self, args: dict, cluster: str) -> Optional[float]:
+        """
+        The expected sps of a run with the resolved `args`, or None without comparable
+            records.
+        """
+        env_id, data_rate = args["env_id"], args["async_datarate"]
+        config = speed_config(args)
+        if (env_id, data_rate, cluster, config) in self._sps:
+            return self._sps[(env_id, data_rate, cluster, config)]
+        if data_rate is None:
+            return None
+        measured = sorted(
+            (rate, sps)
+            for (env, rate, on, other), sps in self._sps.items()
+            if env == env_id and on == cluster and other == config and rate is not None
+        )
+        if not measured:
+            return None
+        below = [(rate, sps) for rate, sps in measured if rate < data_rate]
+        above = [(rate, sps) for rate, sps in measured if rate > data_rate]
+        if not below:
+            return above[0][1]
+        if not above:
+            return below[-1][1]
+        (low_rate, low_sps), (high_rate, high_sps) = below[-1], above[0]
+        weight = (data_rate - low_rate) / (high_rate - low_rate)
+        return low_sps + weight * (high_sps - low_sps)
+
+    def estimate(self, args: dict, cluster: str) -> float:
+        sps = self.sps(args, cluster)
+        if sps is None:
+            return self.margin * estimate_runtime(
+                {
+                    "total-timesteps": args["total_timesteps"],
+                    "async-datarate": args["async_datarate"],
+                }
+            )
+        return self.margin * (self._overheads[cluster] + args["total_timesteps"] / sps)
+
+
+def pack_jobs(
+    jobs: Dict[str, dict],
+    slots_per_pack: int,
+    max_seconds: float,
+    estimate: Callable[[dict], float] = estimate_runtime,
+) -> List[Tuple[List[str], float]]:
+    """
+    Groups jobs into packs that each run `slots_per_pack` jobs at a time, every slot
+        running its jobs one after the other for at most `max_seconds`.
+    The longest jobs are placed first, each in the least loaded slot of the first pack
+        it fits in. A `LocalScheduler` given a pack's jobs in order starts them in the
+        same slots. Jobs longer than `max_seconds` get a pack of their own.
+    Returns the job UIDs of each pack and its expected seconds.
+    """
+    packs = []
+    for job_UID in sorted(jobs, key=lambda job_UID: -estimate(jobs[job_UID])):
+        seconds = estimate(jobs[job_UID])
+        for job_UIDs, loads in packs:
+            slot = loads.index(min(loads))
+            if loads[slot] + seconds <= max_seconds:
+                break
+        else:
+            job_UIDs, loads = [], [0.0] * slots_per_pack
+            slot = 0
+            packs.append((job_UIDs, loads))
+        job_UIDs.append(job_UID)
+        loads[slot] += seconds
+    return [(job_UIDs, max(loads)) for job_UIDs, loads in packs]
+
+
+def write_json_atomically(path: str, data):
+    """Readers see the old or the new file, never a partial one."""
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
+
+
+class LocalScheduler:
+    def __init__(
+        self,
+        max_parallel: int = None,
+        cpus_per_job: int = 1,
+        retries: int = 1,
+        log_dir: str = "logs",
+    ):
+        """
+        Runs jobs on this machine, `max_parallel` at a time (as many as fit the usable
+            CPUs by default).
+        Each running job is pinned to its own `cpus_per_job` CPUs, so the timing of
+            async runs isn't disturbed by their neighbours. Pinning needs
+            `os.sched_setaffinity` (Linux), elsewhere jobs are only limited in number.
+        A job's output goes to `log_dir/<job UID>.log`, a failed job is run again up
+            to `retries` times.
+        """
+        if hasattr(os, "sched_getaffinity"):
+            cpus = sorted(os.sched_getaffinity(0))
+            slots = [
+                cpus[i : i + cpus_per_job]
+                for i in range(0, len(cpus) - cpus_per_job + 1, cpus_per_job)
+            ]
+            assert slots, f"{cpus_per_job} CPUs per job, only {len(cpus)} usable"
+            if max_parallel is not None:
+                slots = slots[:max_parallel]
+        else:
+            slots = [None] * (max_parallel or max(os.cpu_count() // cpus_per_job, 1))
+
+        self.max_parallel = len(slots)
+        self.retries = retries
+        self.log_dir = log_dir
+        self.stopping = False
+        self._free_slots = queue.Queue()
+        for slot in slots:
+            self._free_slots.put(slot)
+        self._processes = set()
+        self._lock = threading.Lock()
+        self._signal = None
+
+    def handle_signals(self, signals: Iterable[int] = (signal.SIGUSR1, signal.SIGTERM)):
+        """
+        On any of `signals`, passes it on to the running jobs, e.g. for them to
+            checkpoint, and starts or retries no more jobs. Jobs that didn't get to
+            run return `PREEMPTED_EXIT_CODE`.
+        """
+
+        def stop(signum, frame):
+            self.stopping = True
+            self._signal = signum
+            with self._lock:
+                for process in self._processes:
+                    process.send_signal(signum)
+
+        for signum in signals:
+            signal.signal(signum, stop)
+
+    def _run_job(self, job_UID: str, command: str) -> int:
+        cpus = self._free_slots.get()
+        try:
+            log_path = os.path.join(self.log_dir, f"{job_UID}.log")
+            returncode = PREEMPTED_EXIT_CODE
+            for attempt in range(self.retries + 1):
+                if self.stopping:
+                    break
+                with open(log_path, "a") as log:
+                    log.write(f"# attempt {attempt + 1} on CPUs {cpus}: {command}\n")
+                    log.flush()
+                    process = subprocess.Popen(
+                        command,
+                        shell=True,
+                        stdout=log,
+                        stderr=subprocess.STDOUT,
+                    )
+                    # Not in `preexec_fn`, which isn't safe to use from threads. The
+                    # local and packed commands `exec` the run, so this pins it before
+                    # it starts any threads of its own, they inherit the affinity. A
+                    # command that forks the run instead (e.g. `poetry run`) races it.
+                    if cpus is not None:
+                        try:
+                            os.sched_setaffinity(process.pid, cpus)
+                        except ProcessLookupError:
+                            pass
+                    with self._lock:
+                        self._processes.add(process)
+                        if self.stopping:
+                            process.send_signal(self._signal)
+                    returncode = process.wait()
+                    with self._lock:
+                        self._processes.discard(process)
+                if returncode == 0:
+                    break
+                print(f"Job {job_UID} failed with return code {returncode}")
+            return returncode
+        finally:
+            self._free_slots.put(cpus)
+
+    def run(
+        self,
+        jobs: Dict[str, dict],
+        on_done: Optional[Callable[[str, int], None]] = None,
+    ) -> Dict[str, int]:
+        """
+        Runs the `command` of every job in `jobs`, returns their return codes.
+        `on_done(job_UID, returncode)` is called from this thread as each job ends.
+        """
+        os.makedirs(self.log_dir, exist_ok=True)
+        returncodes = {}
+        with ThreadPoolExecutor(max_workers=self.max_parallel) as executor:
+            futures = {
+                executor.submit(self._run_job, job_UID, job_dic["command"]): job_UID
+                for job_UID, job_dic in jobs.items()
+            }
+            for future in as_completed(futures):
+                job_UID = futures[future]
+                returncodes[job_UID] = future.result()
+                if on_done is not None:
+                    on_done(job_UID, returncodes[job_UID])
+        return returncodes
+
+
+def run_pack(path: str) -> int:
+    """
+    Runs the jobs of a pack written by the submission below, inside its allocation.
+    Returns `PREEMPTED_EXIT_CODE` if the pack was signalled before all its jobs
+        finished, so `slurm_pack.sh` requeues it, 1 if any job failed and 0 otherwise.
+    """
+    with open(path) as f:
+        pack = json.load(f)
+    scheduler = LocalScheduler(
+        cpus_per_job=pack["cpus_per_job"],
+        retries=pack["retries"],
+        log_dir=os.getenv("JOB_LOG_DIR", default="logs"),
+    )
+    scheduler.handle_signals()
+    print(f"Running {len(pack['jobs'])} jobs, {scheduler.max_parallel} at a time")
+    returncodes = scheduler.run(
+        pack["jobs"],
+        on_done=lambda job_UID, returncode: print(
+            f"Job {job_UID} completed with return code {returncode}"
+        ),
+    )
+    if scheduler.stopping and any(returncodes.values()):
+        return PREEMPTED_EXIT_CODE
+    return int(any(returncodes.values()))
+
+
 def seconds_to_hms(seconds: float):
     hours = seconds // 3600
     minutes = (seconds % 3600) // 60
@@ -136,6 +480,9 @@ def seconds_to_hms(seconds: float):
 
 
 if __name__ == "__main__":
+    if len(sys.argv) == 3 and sys.argv[1] == "--run-pack":
+        sys.exit(run_pack(sys.argv[2]))
+
     ENV_NAMES = ["CartPole-v1", "LunarLander-v2"]  # "MountainCar-v0", "Acrobot-v1",
     EXPERIMENTS = {
         # "observing_steprate_over_training": observing_steprate_over_training,
@@ -147,6 +494,34 @@ if __name__ == "__main__":
 
     all_jobs = {}
 
+    # RUN_LOG collects the measured speed of finished runs, to size time limits by
+    run_log = os.getenv("RUN_LOG")
+    cluster = os.getenv("SLURM_CLUSTERID")
+    runtime_model = RuntimeModel.load(run_log) if run_log else RuntimeModel([])
+    print(f"Runtime model fitted on {len(runtime_model)} configurations")
+
+    # The run's args as `dqn.py` resolves them, defaults filled in, to compare it with
+    # the records and to key its results.
+    from dqn_args import Args
+
+    @functools.lru_cache(maxsize=None)
+    def resolved_args(job_command_line: str) -> dict:
+        return resolve_args(Args, job_command_line)
+
+    def job_args(job_dic):
+        return resolved_args(command_line([], job_dic))
+
+    def expected_seconds(job_dic):
+        return runtime_model.estimate(job_args(job_dic), cluster)
+
+    # Finished runs store where their outputs are in RESULT_CACHE, on a filesystem
+    # the runs can write to
+    result_cache = ResultCache(
+        os.path.abspath(os.getenv("RESULT_CACHE", default="results_cache"))
+    )
+    seeds = range(1, int(os.getenv("NUM_SEEDS", default=30)) + 1)
+    revision = code_revision(os.path.dirname(os.path.abspath(__file__)))
+
     for env_name in ENV_NAMES:
         for job_dic in EXPERIMENTS[experiment_name](env_name=env_name):
             job_UID = "-".join(
@@ -163,28 +538,38 @@ if __name__ == "__main__":
             )
             if os.getenv("DONT_SUBMIT_SEEDS") != "1":
                 job_UID += f"-{job_dic.get('seed')}"
+            if run_log:
+                job_dic["run-log"] = run_log
+            job_dic["result-cache"] = result_cache.directory
+            # The runs key their results by this revision, not that of their clone
+            job_dic["code-revision"] = revision
+
+            seconds = expected_seconds(job_dic) + SETUP_SECONDS
+            if seconds > MAX_ALLOCATION_SECONDS:
+                print(
+                    f"Warning: {job_UID} is expected to take {seconds_to_hms(int(seconds))}, "
+                    f"over the {seconds_to_hms(MAX_ALLOCATION_SECONDS)} limit, "
+                    "it will only finish by checkpointing and being requeued"
+                )
 
-            run_list = ["poetry", "run", "python", job_dic["algo"]]
+            # Local runs (m1_mac) `exec` the interpreter the submitter runs in, its
+            # project environment: `LocalScheduler` pins the process it starts, which
+            # is then the run itself and not a shell or `poetry run` that forks it.
+            run_list = ["exec", shlex.quote(sys.executable), job_dic["algo"]]
             if os.getenv("SLURM_CLUSTERID") != "m1_mac":
+                # The full allocation, unless runs like it were measured
+                time_limit = MAX_ALLOCATION_SECONDS
+                if runtime_model.sps(job_args(job_dic), cluster) is not None:
+                    time_limit = min(int(seconds), MAX_ALLOCATION_SECONDS)
                 run_list = [
                     "sbatch",
                     f"--job-name {job_UID}",
+                    f"--time {seconds_to_hms(time_limit)}",
                     "./slurm_job.sh",
                     job_dic["algo"],
                 ]
 
-            job_dic.update(
-                {
-                    "command": " ".join(
-                        run_list
-                        + [
-                            f"--{k} {v}" if type(v) != bool else f"--{k}"
-                            for k, v in job_dic.items()
-                            if k != "algo"
-                        ]
-                    ),
-                }
-            )
+            job_dic.update({"command": command_line(run_list, job_dic)})
 
             print(job_UID, job_dic)
 
@@ -196,27 +581,121 @@ if __name__ == "__main__":
                     print(f"\t{k}: {v}")
 
     print(len(all_jobs))
-    import subprocess
 
-    # write all jobs to a json to record completeness
-    import json
+    # PACK_CPUS > 0 submits allocations of that many CPUs, each running several jobs
+    pack_cpus = int(os.getenv("PACK_CPUS", default=0))
+    if pack_cpus > 0:
+        all_jobs = expand_seeds(all_jobs, seeds)
 
     print(f"Total number of jobs: {len(all_jobs)}")
-    # Load or initialize the job completion record
+    # Load or initialize the record of submitted jobs
     try:
         with open("jobs.json", "r") as f:
-            completed_jobs = json.load(f)
+            submitted_jobs = json.load(f)
     except FileNotFoundError:
-        completed_jobs = {}
+        submitted_jobs = {}
 
     if int(os.getenv("DEBUG", default=0)) > 0:
         # print command of first job and exit
         print(all_jobs[list(all_jobs.keys())[0]]["command"])
         exit()
 
-    # Run all jobs that are not marked as completed
+    # A job is known by the keys of the runs it makes, one per seed of the array when
+    # it has no seed. They hash the fully resolved args and the code revision, the
+    # same keys the runs store their results and checkpoints under.
+    job_keys = {}
     for job_UID, job_dic in all_jobs.items():
-        if job_UID not in completed_jobs:
+        args = job_args(job_dic)
+        job_keys[job_UID] = [
+            config_key(dict(args, seed=seed), revision)
+            for seed in ([job_dic["seed"]] if "seed" in job_dic else seeds)
+        ]
+
+    # Jobs whose runs all have a result, or that were submitted with the same keys,
+    # are skipped. Jobs that failed or changed are run again.
+    pending_jobs = {}
+    for job_UID, job_dic in all_jobs.items():
+        keys = job_keys[job_UID]
+        if all(key in result_cache for key in keys):
+            print(
+                f"Skipping job {job_UID}, its results are in {result_cache.directory}"
+            )
+        elif submitted_jobs.get(job_UID) == {"returncode": 0, "keys": keys}:
+            print(f"Skipping submitted job {job_UID}")
+        else:
+            pending_jobs[job_UID] = job_dic
+
+    def mark_done(job_UID, returncode):
+        submitted_jobs[job_UID] = {"returncode": returncode, "keys": job_keys[job_UID]}
+        write_json_atomically("jobs.json", submitted_jobs)
+        print(
+            f"Job {job_UID} completed with return code {returncode}, saved to jobs.json"
+        )
+
+    if os.getenv("SLURM_CLUSTERID") == "m1_mac":
+        # LOCAL_JOBS defaults to as many as fit the usable CPUs
+        scheduler = LocalScheduler(
+            max_parallel=int(os.getenv("LOCAL_JOBS", default=0)) or None,
+            cpus_per_job=int(os.getenv("CPUS_PER_JOB", default=1)),
+            retries=int(os.getenv("JOB_RETRIES", default=1)),
+            log_dir=os.getenv("JOB_LOG_DIR", default="logs"),
+        )
+        print(f"Running {len(pending_jobs)} jobs, {scheduler.max_parallel} at a time")
+        scheduler.run(pending_jobs, on_done=mark_done)
+    elif pack_cpus > 0:
+        cpus_per_job = int(os.getenv("CPUS_PER_JOB", default=1))
+        packs = pack_jobs(
+            pending_jobs,
+            slots_per_pack=pack_cpus // cpus_per_job,
+            max_seconds=MAX_ALLOCATION_SECONDS - SETUP_SECONDS,
+            estimate=expected_seconds,
+        )
+        print(f"Packing {len(pending_jobs)} jobs into {len(packs)} allocations")
+        os.makedirs("packs", exist_ok=True)
+        for i, (job_UIDs, seconds) in enumerate(packs):
+            pack_name = f"{experiment_name.replace('_', '')}-{i}"
+            pack_path = os.path.abspath(os.path.join("packs", f"{pack_name}.json"))
+            # `exec` so the signals passed on by the pack reach the run itself. Runs of
+            # a pack start together, the job's UID keeps their run names apart.
+            jobs = {
+                job_UID: {
+                    "command": command_line(
+                        ["exec", "python", pending_jobs[job_UID]["algo"]],
+                        pending_jobs[job_UID],
+                    )
+                    + f" --exp-name {job_UID}"
+                    # Named by the config, a changed job doesn't resume another's
+                    + f" --checkpoint-dir $CHECKPOINT_ROOT/{job_keys[job_UID][0]}"
+                }
+                for job_UID in job_UIDs
+            }
+            write_json_atomically(
+                pack_path,
+                {
+                    "cpus_per_job": cpus_per_job,
+                    "retries": int(os.getenv("JOB_RETRIES", default=1)),
+                    "jobs": jobs,
+                },
+            )
+            time_limit = min(seconds + SETUP_SECONDS, MAX_ALLOCATION_SECONDS)
+            command = " ".join(
+                [
+                    "sbatch",
+                    f"--job-name {pack_name}",
+                    f"--cpus-per-task {pack_cpus}",
+                    f"--time {seconds_to_hms(int(time_limit))}",
+                    "./slurm_pack.sh",
+                    pack_path,
+                ]
+            )
+            print(f"Submitting {pack_name}: {len(job_UIDs)} jobs, {command}")
+            process = subprocess.run(command, shell=True, capture_output=True)
+            if process.returncode != 0:
+                print(process.stderr.decode())
+            for job_UID in job_UIDs:
+                mark_done(job_UID, process.returncode)
+    else:
+        for job_UID, job_dic in pending_jobs.items():
 
             # check if we're on the slurm cluster
             # if os.getenv("IS_SLURM"):
@@ -227,22 +706,15 @@ if __name__ == "__main__":
             print(f"Submitting job {job_UID}")
             # print(f"\t{job_dic['command']}")
             process = subprocess.run(
-                job_dic["command"], shell=True, check=True, capture_output=True
+                job_dic["command"], shell=True, capture_output=True
             )
-
-            # Mark the job as completed
-            completed_jobs[job_UID] = process.returncode
-
-            # Write the updated completion status to the JSON file
-            with open("jobs.json", "w") as f:
-                json.dump(completed_jobs, f)
-
-            print(
-                f"Job {job_UID} completed with return code {process.returncode}, saved to jobs.json"
-            )
-
-        else:
-            print(f"Skipping completed job {job_UID}")
+            if process.returncode != 0:
+                print(process.stderr.decode())
+            mark_done(job_UID, process.returncode)
 
 # SLURM_CLUSTERID=m1_mac PYTHONPATH=./src:. poetry run python src/job_submitter.py
+# SLURM_CLUSTERID=m1_mac LOCAL_JOBS=4 CPUS_PER_JOB=2 JOB_RETRIES=2 python src/job_submitter.py
+# DONT_SUBMIT_SEEDS=1 PACK_CPUS=32 NUM_SEEDS=30 SLURM_CLUSTERID=beluga python src/job_submitter.py
+# RUN_LOG=~/scratch/run_log.jsonl DONT_SUBMIT_SEEDS=1 SLURM_CLUSTERID=beluga python src/job_submitter.py
+# RESULT_CACHE=~/scratch/results_cache DONT_SUBMIT_SEEDS=1 SLURM_CLUSTERID=beluga python src/job_submitter.py
 # DONT_SUBMIT_SEEDS=1 SLURM_CLUSTERID=beluga_8cpu python src/job_submitter.py
@@ -0,0 +1,159 @@
+import time
+from typing import Dict, Iterable
+
+import numpy as np
+
+PERCENTILES = (50, 90, 99, 99.9)
+
+
+class Histogram:
+    """
+    HDR-style histogram: constant memory and O(1) `record`, with a bounded relative
+        error instead of keeping every sample.
+    Values are counted in multiples of `unit`. Below `2**significant_bits` units each
+        value has its own bucket, above that buckets double in width every
+        `2**(significant_bits - 1)` buckets, so percentiles are within
+        `2**-(significant_bits - 1)` of the true value (under 2% by default).
+    Values above `highest` units are counted in the last bucket.
+    """
+
+    def __init__(
+        self, unit: float = 1e-6, highest: float = 60e6, significant_bits: int = 7
+    ):
+        self.unit = unit
+        self._sub_bucket_count = 2**significant_bits
+        self._half_count = self._sub_bucket_count // 2
+        self._significant_bits = significant_bits
+        self._highest = int(highest)
+        self._num_buckets = self._index(self._highest) + 1
+        self.reset()
+
+    def _index(self, value: int) -> int:
+        if value < self._sub_bucket_count:
+            return value
+        shift = value.bit_length() - self._significant_bits
+        return (
+            self._sub_bucket_count
+            + (shift - 1) * self._half_count
+            + (value >> shift)
+            - self._half_count
+        )
+
+    def _value(self, index: int) -> float:
+        """The middle of the bucket at `index`, in units."""
+        if index < self._sub_bucket_count:
+            return float(index)
+        shift, top = divmod(index - self._sub_bucket_count, self._half_count)
+        shift += 1
+        return float(((top + self._half_count) << shift) + (1 << shift) / 2)
+
+    def reset(self):
+        # A list is faster than a NumPy array to increment one element of.
+        self.counts = [0] * self._num_buckets
+        self.total_count = 0
+        self.min = float("inf")
+        self.max = float("-inf")
+
+    def record(self, value: float):
+        value_units = min(max(int(value / self.unit), 0), self._highest)
+        self.counts[self._index(value_units)] += 1
+        self.total_count += 1
+        if value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+
+    def merge(self, other: "Histogram"):
+        assert len(self.counts) == len(other.counts), "histograms differ in layout"
+        self.counts = [a + b for a, b in zip(self.counts, other.counts)]
+        self.total_count += other.total_count
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+    def percentiles(self, percentiles: Iterable[float] = PERCENTILES) -> np.ndarray:
+        if self.total_count == 0:
+            return np.full(len(tuple(percentiles)), np.nan)
+        cumulative = np.cumsum(self.counts)
+        ranks = np.ceil(np.asarray(percentiles) / 100 * self.total_count)
+        indices = np.searchsorted(cumulative, np.maximum(ranks, 1))
+        values = np.array([self._value(index) for index in indices]) * self.unit
+        # The extremes are tracked exactly, don't report past them.
+        return np.clip(values, self.min, self.max)
+
+    def summary(self, percentiles: Iterable[float] = PERCENTILES) -> Dict[str, float]:
+        percentiles = tuple(percentiles)
+        summary = {
+            f"p{percentile:g}": float(value)
+            for percentile, value in zip(percentiles, self.percentiles(percentiles))
+        }
+        summary["count"] = self.total_count
+        summary["max"] = self.max if self.total_count else float("nan")
+        return summary
+
+
+class LatencyRecorder:
+    """
+    Named histograms for one side of an agent-environment loop, summarised and reset
+        once per episode.
+    Durations are in seconds, at microsecond resolution up to a minute. Names listed
+        in `counts` (by default `repeats`) are recorded in whole units instead.
+    """
+
+    def __init__(self, counts: Iterable[str] = ("repeats",)):
+        self._counts = set(counts)
+        self.histograms: Dict[str, Histogram] = {}
+        self._marks: Dict[str, float] = {}
+
+    def record(self, name: str, value: float):
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            if name in self._counts:
+                histogram = Histogram(unit=1, highest=1_000_000)
+            else:
+                histogram = Histogram()
+            self.histograms[name] = histogram
+        histogram.record(value)
+
+    def start(self, name: str):
+        """Starts timing `name`, recorded by the matching `stop`."""
+        self._marks[name] = time.perf_counter()
+
+    def stop(self, name: str):
+        mark = self._marks.pop(name, None)
+        if mark is not None:
+            self.record(name, time.perf_counter() - mark)
+
+    def summary(self, reset: bool = True) -> Dict[str, Dict[str, float]]:
+        """`{name: {"p50": ..., "p90": ..., "p99": ..., "p99.9": ..., "count": ..., "max": ...}}`."""
+        summary = {
+            name: histogram.summary()
+            for name, histogram in self.histograms.items()
+            if histogram.total_count > 0
+        }
+        if reset:
+            self.reset()
+        return summary
+
+    def reset(self):
+        for histogram in self.histograms.values():
+            histogram.reset()
+        self._marks.clear()
+
+
+if __name__ == "__main__":
+    rng = np.random.default_rng(0)
+    samples = rng.lognormal(mean=np.log(1e-3), sigma=1.0, size=100_000)
+    histogram = Histogram()
+    for sample in samples:
+        histogram.record(sample)
+
+    expected = np.percentile(samples, PERCENTILES)
+    recorded = histogram.percentiles()
+    print(dict(zip(PERCENTILES, recorded)))
+    assert np.all(np.abs(recorded - expected) / expected < 2**-6), (recorded, expected)
+
+    counts = Histogram(unit=1, highest=1000)
+    for value in range(100):
+        counts.record(value)
+    assert counts.percentiles((50, 100)).tolist() == [49, 99]
+    print("Done")
@@ -0,0 +1,80 @@
+import threading
+import time
+from typing import Callable
+
+
+class Learner(threading.Thread):
+    """
+    Runs gradient updates on a background thread, so they don't stall the thread
+        acting in the environment.
+    The actor grants updates with `allow`, the learner runs `update(i)` for every
+        granted `i` in order and then waits for more. Granting one update every
+        `train_frequency` agent steps keeps the same number of updates per
+        environment step as training inline.
+    `update` runs on the learner thread, it has to take the locks it shares with the
+        actor itself.
+    """
+
+    def __init__(self, update: Callable[[int], None], num_updates: int = 0):
+        """`num_updates` is the number of updates already run, when resuming."""
+        super(Learner, self).__init__(daemon=True, name="learner")
+        self.update = update
+        self.num_updates = num_updates
+        self._num_allowed = num_updates
+        self._initial_updates = num_updates
+        self._stopped = False
+        self._condition = threading.Condition()
+        self._error = None
+        self._start_time = None
+
+    def allow(self, num_updates: int):
+        """Allows the learner to run up to `num_updates` updates in total."""
+        if self._error is not None:
+            raise RuntimeError("the learner thread failed") from self._error
+        with self._condition:
+            if num_updates > self._num_allowed:
+                self._num_allowed = num_updates
+                self._condition.notify()
+
+    @property
+    def lag(self) -> int:
+        """The number of allowed updates that haven't run yet."""
+        return self._num_allowed - self.num_updates
+
+    def updates_per_second(self) -> float:
+        num_updates = self.num_updates - self._initial_updates
+        if self._start_time is None or num_updates == 0:
+            return 0.0
+        return num_updates / (time.monotonic() - self._start_time)
+
+    def run(self):
+        try:
+            while True:
+                with self._condition:
+                    self._condition.wait_for(
+                        lambda: self._stopped or self.num_updates < self._num_allowed
+                    )
+                    if self._stopped:
+                        return
+                if self._start_time is None:
+                    self._start_time = time.monotonic()
+                self.update(self.num_updates)
+                self.num_updates += 1
+        except BaseException as error:
+            self._error = error
+            raise
+
+    def drain(self):
+        """Blocks until the allowed updates have run."""
+        with self._condition:
+            while self.is_alive() and self.num_updates < self._num_allowed:
+                self._condition.wait(0.01)
+
+    def stop(self, drain: bool = True):
+        """Stops the learner, after running the allowed updates if `drain`."""
+        if drain:
+            self.drain()
+        with self._condition:
+            self._stopped = True
+            self._condition.notify()
+        self.join()
@@ -0,0 +1,92 @@
+import queue
+import threading
+from typing import Dict, Tuple, Union
+
+import numpy as np
+import torch
+
+STATISTICS = {
+    "": np.mean,
+    "_p50": lambda values: np.percentile(values, 50),
+    "_p99": lambda values: np.percentile(values, 99),
+}
+
+
+class Metrics:
+    """
+    Collects scalars in preallocated ring buffers and writes summary statistics of
+        them (the mean under the metric's name, `_p50` and `_p99`) when `flush`ed.
+    `record` only copies the value into the buffer. Tensors are kept on their device,
+        so recording e.g. a cuda loss doesn't synchronise with the GPU.
+    Reading the buffers back, computing the statistics and writing them to the
+        SummaryWriter all happen on a background thread.
+    Each metric keeps the last `capacity` values recorded since the previous flush.
+    Safe to record from several threads.
+    """
+
+    def __init__(self, writer, capacity: int = 1024):
+        self.writer = writer
+        self.capacity = capacity
+        self._buffers: Dict[str, Union[np.ndarray, torch.Tensor]] = {}
+        self._counts: Dict[str, int] = {}
+        self._lock = threading.Lock()
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._write, daemon=True, name="metrics")
+        self._thread.start()
+
+    def record(self, name: str, value: Union[float, torch.Tensor]):
+        with self._lock:
+            buffer = self._buffers.get(name)
+            if buffer is None:
+                if isinstance(value, torch.Tensor):
+                    buffer = torch.empty(
+                        self.capacity, dtype=torch.float32, device=value.device
+                    )
+                else:
+                    buffer = np.empty(self.capacity, dtype=np.float64)
+                self._buffers[name] = buffer
+                self._counts[name] = 0
+
+            count = self._counts[name]
+            if isinstance(value, torch.Tensor):
+                buffer[count % self.capacity].copy_(value.detach())
+            else:
+                buffer[count % self.capacity] = value
+            self._counts[name] = count + 1
+
+    def flush(self, step: int):
+        """Hands the values recorded so far to the writer thread, logged at `step`."""
+        values: Dict[str, Tuple[Union[np.ndarray, torch.Tensor], int]] = {}
+        with self._lock:
+            for name, count in self._counts.items():
+                if count == 0:
+                    continue
+                # Copies on the buffer's device, reading them back is the thread's job.
+                recorded = self._buffers[name][: min(count, self.capacity)]
+                values[name] = (
+                    recorded.clone()
+                    if isinstance(recorded, torch.Tensor)
+                    else recorded.copy()
+                )
+                self._counts[name] = 0
+        if values:
+            self._queue.put((step, values))
+
+    def _write(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            step, values = item
+            for name, recorded in values.items():
+                if isinstance(recorded, torch.Tensor):
+                    recorded = recorded.cpu().numpy()
+                for suffix, statistic in STATISTICS.items():
+                    self.writer.add_scalar(name + suffix, statistic(recorded), step)
+
+    def close(self, step: int = None):
+        """Flushes the remaining values at `step`, if given, and stops the thread."""
+        if step is not None:
+            self.flush(step)
+        self._queue.put(None)
+        self._thread.join()
@@ -4,6 +4,10 @@ from multiprocessing import Manager, Process
 from loguru import logger
 import gymnasium as gym
 
+from latency import LatencyRecorder
+from shared_memory_ring import ActionRing, TransitionRing
+from wakeup import Doorbell, wait_until
+
 
 # Define send and receive functions as standalone, top-level functions
 def queue_get(l):
@@ -27,11 +31,6 @@ def get_env_as_int(name, default: int = 0):
     return int(os.getenv(name, str(default)))
 
 
-import gym
-from multiprocessing import Manager
-from gym import spaces
-
-
 class AsyncGymWrapper:
     def __init__(
         self,
@@ -41,19 +40,57 @@ class AsyncGymWrapper:
         agent_receive_fn=stack_get,
         env_send_fn=queue_put,
         env_receive_fn=queue_get,
+        transport="shared_memory",
+        buffer_capacity=1024,
+        wait_policy="hybrid",
+        spin_budget=50e-6,
+        record_latency=False,
     ):
-        manager = Manager()
+        """
+        `transport="shared_memory"` exchanges actions and transitions through lock-free
+            rings with slots sized from the env's spaces.
+        `transport="manager"` uses `Manager().list()` proxies, which support arbitrary
+            payloads at the cost of a round-trip to the manager process per access.
+        `wait_policy` decides how both sides wait for data: "spin" busy-waits, "block"
+            sleeps on a doorbell, "hybrid" spins for `spin_budget` seconds then sleeps.
+        With `record_latency`, the agent's time between steps (`inference`), the
+            round trip, the worker-to-agent `transport` time, the env step and the ticks
+            played without a fresh action (`repeats`) are recorded in histograms, and the
+            last transition of each episode carries their percentiles in `info["latency"]`.
+        """
+        self._env = env
+        self._transport = transport
 
         # Initialize buffers
-        self._env_buffer = manager.list()
-        self._agent_buffer = manager.list()
+        if transport == "shared_memory":
+            self._env_buffer = ActionRing(env.action_space, capacity=buffer_capacity)
+            # The agent takes the newest transition, after a stall it must be the
+            # latest one and not one from `buffer_capacity` ticks ago.
+            self._agent_buffer = TransitionRing(
+                env.observation_space, capacity=buffer_capacity, overwrite=True
+            )
+        elif transport == "manager":
+            manager = Manager()
+            self._env_buffer = manager.list()
+            self._agent_buffer = manager.list()
+        else:
+            raise ValueError(f"Unknown transport {transport}")
+
+        # Rung by whoever appended to the buffer the other side reads from
+        self._env_doorbell = Doorbell()
+        self._agent_doorbell = Doorbell()
+        self._wait_policy = wait_policy
+        self._spin_budget = spin_budget
 
         # Assign functions
-        self._agent_send = lambda payload: agent_send_fn(self._env_buffer, payload)
+        self._agent_send_fn = agent_send_fn
         self._agent_receive = lambda: agent_receive_fn(self._agent_buffer)
 
         self._data_rate = data_rate
 
+        self._latency = LatencyRecorder() if record_latency else None
+        self._last_receive_time = None
+
         self.worker = EnvironmentWorker(
             environment_buffer=self._env_buffer,
             agent_buffer=self._agent_buffer,
@@ -61,6 +98,11 @@ class AsyncGymWrapper:
             data_rate=self._data_rate,
             env_send_fn=env_send_fn,
             env_receive_fn=env_receive_fn,
+            environment_doorbell=self._env_doorbell,
+            agent_doorbell=self._agent_doorbell,
+            wait_policy=wait_policy,
+            spin_budget=spin_budget,
+            record_latency=record_latency,
         )
 
         self.start()
@@ -74,14 +116,45 @@ class AsyncGymWrapper:
         self.worker.daemon = True
         self.worker.start()
 
+    def _agent_send(self, payload):
+        self._agent_send_fn(self._env_buffer, payload)
+        self._env_doorbell.ring()
+
+    def _transition_ready(self):
+        return len(self._agent_buffer) > 0
+
     def step(self, action):
+        send_time = time.monotonic()
         self._agent_send(action)
 
         # agent waits for data
-        while len(self._agent_buffer) == 0:
-            pass
-
-        return self._agent_receive()
+        wait_until(
+            self._transition_ready,
+            self._agent_doorbell,
+            policy=self._wait_policy,
+            spin_budget=self._spin_budget,
+        )
+        return self._receive(send_time)
+
+    def _receive(self, send_time):
+        *transition, sent_at = self._agent_receive()
+        if self._latency is not None:
+            self._record_latency(transition, sent_at, send_time)
+        return tuple(transition)
+
+    def _record_latency(self, transition, sent_at, send_time):
+        receive_time = time.monotonic()
+        if self._last_receive_time is not None:
+            self._latency.record("inference", send_time - self._last_receive_time)
+        self._last_receive_time = receive_time
+        self._latency.record("round_trip", receive_time - send_time)
+
+        observation, reward, terminated, truncated, info = transition
+        # CLOCK_MONOTONIC is system-wide, so the worker's timestamp is comparable
+        if sent_at:
+            self._latency.record("transport", receive_time - sent_at)
+        if terminated or truncated:
+            info["latency"] = {**info.get("latency", {}), **self._latency.summary()}
 
     def close(self):
         self.worker.terminate()
@@ -93,7 +166,12 @@ class AsyncGymWrapper:
             logger.error(f"Error closing environment worker: {e}")
             pass
         del self.worker
-        super().close()  # Make sure to close the underlying env as well
+        if self._transport == "shared_memory":
+            self._env_buffer.close()
+            self._agent_buffer.close()
+        self._env_doorbell.close()
+        self._agent_doorbell.close()
+        self._env.close()  # Make sure to close the underlying env as well
 
 
 class EnvironmentWorker(Process):
@@ -105,6 +183,11 @@ class EnvironmentWorker(Process):
         data_rate: int = 2,
         env_send_fn=queue_put,
         env_receive_fn=queue_get,
+        environment_doorbell=None,
+        agent_doorbell=None,
+        wait_policy="spin",
+        spin_budget=50e-6,
+        record_latency=False,
     ):
         super(EnvironmentWorker, self).__init__()
         self._env_buffer = environment_buffer
@@ -113,15 +196,46 @@ class EnvironmentWorker(Process):
         self._env_send_fn = env_send_fn
         self._env_receive_fn = env_receive_fn
         self._data_rate = data_rate
+        self._env_doorbell = environment_doorbell
+        self._agent_doorbell = agent_doorbell
+        self._wait_policy = wait_policy
+        self._spin_budget = spin_budget
+        self._record_latency = record_latency
+        self._latency = None
 
     def _env_send(self, payload):
-        self._env_send_fn(self._agent_buffer, payload)
+        observation, reward, terminated, truncated, info = payload
+        # Sent next to the info rather than in it, so the ring doesn't pickle an
+        # otherwise empty info on every step and time that as transport
+        sent_at = 0.0
+        if self._latency is not None:
+            sent_at = time.monotonic()
+            if terminated or truncated:
+                info = dict(info, latency=self._latency.summary())
+        self._env_send_fn(
+            self._agent_buffer,
+            (observation, reward, terminated, truncated, info, sent_at),
+        )
+        if self._agent_doorbell is not None:
+            self._agent_doorbell.ring()
+
+    def _wait_for_action(self, deadline=None):
+        return wait_until(
+            lambda: len(self._env_buffer) > 0,
+            self._env_doorbell,
+            deadline=deadline,
+            policy=self._wait_policy,
+            spin_budget=self._spin_budget,
+        )
 
     def _env_receive(self):
         return self._env_receive_fn(self._env_buffer)
 
     def run(self):
         self.running = True
+        if self._record_latency:
+            self._latency = LatencyRecorder()
+        ticks_without_action = 0
 
         (observation, info) = self._env.reset()
 
@@ -129,23 +243,34 @@ class EnvironmentWorker(Process):
 
         # Process loop
         while self.running:
-            start_time = time.time()
+            start_time = time.monotonic()
 
             if self._data_rate == 0:
-                while len(self._env_buffer) == 0:
-                    continue
+                self._wait_for_action()
                 action = self._env_receive()
 
             else:
                 action = self._env.action_space.sample()
 
-                while (time.time() - start_time) < (1 / self._data_rate):
-                    if len(self._env_buffer) == 0:
-                        continue
-                    else:
+                # Play the latest action that arrives before the next tick
+                deadline = start_time + 1 / self._data_rate
+                fresh_action = False
+                while self._wait_for_action(deadline):
+                    while len(self._env_buffer) > 0:
                         action = self._env_receive()
+                        fresh_action = True
+
+                if self._latency is not None:
+                    if fresh_action:
+                        self._latency.record("repeats", ticks_without_action)
+                        ticks_without_action = 0
+                    else:
+                        ticks_without_action += 1
 
+            step_start_time = time.monotonic()
             data = self._env.step(action)
+            if self._latency is not None:
+                self._latency.record("env_step", time.monotonic() - step_start_time)
             self._env_send(data)
 
             terminated, truncated = data[2], data[3]
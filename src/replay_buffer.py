@@ -0,0 +1,400 @@
+import os
+from typing import Dict, List, NamedTuple, Tuple
+
+import numpy as np
+import torch
+from gymnasium import spaces
+
+
+class ReplayBufferSamples(NamedTuple):
+    observations: torch.Tensor
+    actions: torch.Tensor
+    next_observations: torch.Tensor
+    dones: torch.Tensor
+    rewards: torch.Tensor
+    discounts: torch.Tensor
+
+
+class ReplayBuffer:
+    def __init__(
+        self,
+        buffer_size: int,
+        observation_space: spaces.Space,
+        action_space: spaces.Space,
+        device: torch.device = "cpu",
+        n_envs: int = 1,
+    ):
+        """
+        Circular replay buffer with the same `add`/`sample` interface as stable_baselines3's,
+            plus the discount of each transition's bootstrapped value.
+        Each observation is stored once: the next observation of a transition is the
+            observation of the following row. When the two differ (the episode ended and
+            the env was reset) the next observation is moved to a small side table before
+            it is overwritten.
+        `sample` gathers straight into preallocated (pinned, when on cuda) tensors. They
+            are double-buffered, so a batch stays valid until the second call after it.
+        """
+        self.buffer_size = max(buffer_size // n_envs, 1)
+        self.n_envs = n_envs
+        self.device = torch.device(device)
+
+        self.observation_shape = observation_space.shape
+        if isinstance(action_space, spaces.Discrete):
+            self.action_shape = (1,)
+        else:
+            self.action_shape = action_space.shape
+        action_dtype = (
+            np.int64 if isinstance(action_space, spaces.Discrete) else np.float32
+        )
+
+        self.observations = self._allocate(
+            "observations",
+            (self.buffer_size, n_envs) + self.observation_shape,
+            observation_space.dtype,
+        )
+        self.actions = self._allocate(
+            "actions", (self.buffer_size, n_envs) + self.action_shape, action_dtype
+        )
+        self.rewards = self._allocate("rewards", (self.buffer_size, n_envs), np.float32)
+        self.dones = self._allocate("dones", (self.buffer_size, n_envs), np.float32)
+        self.discounts = self._allocate(
+            "discounts", (self.buffer_size, n_envs), np.float32
+        )
+        self.has_final_observation = np.zeros(
+            (self.buffer_size, n_envs), dtype=np.bool_
+        )
+        self.final_observations: Dict[Tuple[int, int], np.ndarray] = {}
+
+        self.pos = 0
+        self.full = False
+        # The number of `add` calls, row `i % buffer_size` holds the i-th one.
+        self.num_added = 0
+        self._batches = {}
+        self._num_samples = 0
+
+    def _allocate(self, name: str, shape: Tuple[int, ...], dtype) -> np.ndarray:
+        return np.zeros(shape, dtype=dtype)
+
+    def size(self) -> int:
+        return self.buffer_size if self.full else self.pos
+
+    def add(self, obs, next_obs, action, reward, done, infos=None, discount=1.0):
+        """
+        `discount` multiplies the value bootstrapped from `next_obs`: gamma, or gamma
+            to the power of the number of env steps the transition spans.
+        """
+        pos = self.pos
+        next_pos = (pos + 1) % self.buffer_size
+
+        # The previous transition's next observation sits in this row, keep it aside
+        # if the env was reset in between.
+        if self.pos > 0 or self.full:
+            previous = (pos - 1) % self.buffer_size
+            reset = (self.observations[pos] != obs).reshape(self.n_envs, -1).any(axis=1)
+            for env in np.flatnonzero(reset):
+                self.final_observations[(previous, env)] = self.observations[
+                    pos, env
+                ].copy()
+                self.has_final_observation[previous, env] = True
+
+        self._forget_final_observations(pos)
+        self.observations[pos] = obs
+        self.actions[pos] = np.asarray(action).reshape(
+            (self.n_envs,) + self.action_shape
+        )
+        self.rewards[pos] = reward
+        self.dones[pos] = done
+        self.discounts[pos] = discount
+
+        # Overwrites the oldest row's observation, that row stops being sampled.
+        self._forget_final_observations(next_pos)
+        self.observations[next_pos] = next_obs
+
+        self.pos = next_pos
+        if self.pos == 0:
+            self.full = True
+        self.num_added += 1
+
+    def spec(self) -> dict:
+        """What a state must match to be loaded into this buffer."""
+        return {
+            "buffer_size": self.buffer_size,
+            "n_envs": self.n_envs,
+            "observations": (self.observation_shape, str(self.observations.dtype)),
+            "actions": (self.action_shape, str(self.actions.dtype)),
+        }
+
+    def state_dict(self) -> dict:
+        """The buffer's contents, by reference, see `checkpoint.snapshot` for a copy."""
+        return {
+            "spec": self.spec(),
+            "observations": self.observations,
+            "actions": self.actions,
+            "rewards": self.rewards,
+            "dones": self.dones,
+            "discounts": self.discounts,
+            "has_final_observation": self.has_final_observation,
+            "final_observations": self.final_observations,
+            "pos": self.pos,
+            "full": self.full,
+            "num_added": self.num_added,
+        }
+
+    def load_state_dict(self, state: dict):
+        if state["spec"] != self.spec():
+            raise ValueError(
+                f"the replay buffer state is for {state['spec']}, not {self.spec()}"
+            )
+        for name in ("observations", "actions", "rewards", "dones", "discounts"):
+            getattr(self, name)[...] = state[name]
+        self.has_final_observation[...] = state["has_final_observation"]
+        self.final_observations = dict(state["final_observations"])
+        self.pos = state["pos"]
+        self.full = state["full"]
+        self.num_added = state["num_added"]
+
+    def changes_since(self, num_added: int) -> Dict[str, np.ndarray]:
+        """
+        Copies of the rows written since `add` had been called `num_added` times, for
+            `apply_changes`: each `add` writes its own row, the observation of the
+            next one and the side table entry of the previous one.
+        """
+        first = max(num_added - 1, self.num_added + 1 - self.buffer_size, 0)
+        rows = np.arange(first, self.num_added + 1) % self.buffer_size
+        final_indices = np.argwhere(self.has_final_observation[rows])
+        final_indices[:, 0] = rows[final_indices[:, 0]]
+        final_observations = np.zeros(
+            (len(final_indices),) + self.observation_shape,
+            dtype=self.observations.dtype,
+        )
+        for i, (row, env) in enumerate(final_indices):
+            final_observations[i] = self.final_observations[(row, env)]
+        return {
+            "rows": rows,
+            "observations": self.observations[rows],
+            "actions": self.actions[rows],
+            "rewards": self.rewards[rows],
+            "dones": self.dones[rows],
+            "discounts": self.discounts[rows],
+            "has_final_observation": self.has_final_observation[rows],
+            "final_indices": final_indices,
+            "final_observations": final_observations,
+            "pos": np.array(self.pos),
+            "full": np.array(self.full),
+            "num_added": np.array(self.num_added),
+        }
+
+    def apply_changes(self, changes: Dict[str, np.ndarray]):
+        """Writes rows copied by `changes_since`, replacing their side table entries."""
+        rows = changes["rows"]
+        for name in ("observations", "actions", "rewards", "dones", "discounts"):
+            getattr(self, name)[rows] = changes[name]
+        changed = np.zeros(self.buffer_size, dtype=np.bool_)
+        changed[rows] = True
+        for row, env in list(self.final_observations):
+            if changed[row]:
+                del self.final_observations[(row, env)]
+        self.has_final_observation[rows] = changes["has_final_observation"]
+        for (row, env), observation in zip(
+            changes["final_indices"], changes["final_observations"]
+        ):
+            self.final_observations[(int(row), int(env))] = observation
+        self.pos = int(changes["pos"])
+        self.full = bool(changes["full"])
+        self.num_added = int(changes["num_added"])
+
+    def _forget_final_observations(self, row: int):
+        if self.has_final_observation[row].any():
+            for env in np.flatnonzero(self.has_final_observation[row]):
+                del self.final_observations[(row, env)]
+            self.has_final_observation[row] = False
+
+    def _batch(self, batch_size: int) -> ReplayBufferSamples:
+        # Two sets of buffers, so a pending non-blocking copy of the previous batch is
+        # never overwritten.
+        self._num_samples += 1
+        if batch_size not in self._batches:
+            pin_memory = self.device.type == "cuda"
+
+            def empty(shape, dtype):
+                return torch.empty(
+                    (batch_size,) + shape,
+                    dtype=torch.from_numpy(np.empty(0, dtype=dtype)).dtype,
+                    pin_memory=pin_memory,
+                )
+
+            self._batches[batch_size] = [
+                ReplayBufferSamples(
+                    observations=empty(self.observation_shape, self.observations.dtype),
+                    actions=empty(self.action_shape, self.actions.dtype),
+                    next_observations=empty(
+                        self.observation_shape, self.observations.dtype
+                    ),
+                    dones=empty((1,), np.float32),
+                    rewards=empty((1,), np.float32),
+                    discounts=empty((1,), np.float32),
+                )
+                for _ in range(2)
+            ]
+        return self._batches[batch_size][self._num_samples % 2]
+
+    def _sample_indices(self, batch_size: int) -> Tuple[np.ndarray, np.ndarray]:
+        # The row at `pos` had its observation overwritten by the newest next observation.
+        if self.full:
+            rows = (
+                np.random.randint(1, self.buffer_size, size=batch_size) + self.pos
+            ) % (self.buffer_size)
+        else:
+            rows = np.random.randint(0, self.pos, size=batch_size)
+        envs = np.random.randint(0, self.n_envs, size=batch_size)
+        return rows, envs
+
+    def sample(self, batch_size: int) -> ReplayBufferSamples:
+        return self._gather(*self._sample_indices(batch_size))
+
+    def _gather(self, rows: np.ndarray, envs: np.ndarray) -> ReplayBufferSamples:
+        batch = self._batch(len(rows))
+        flat = rows * self.n_envs + envs
+        next_flat = (rows + 1) % self.buffer_size * self.n_envs + envs
+
+        def flatten(array):
+            return array.reshape((-1,) + array.shape[2:])
+
+        # mode="clip" lets np.take write into `out` without an intermediate buffer.
+        observations = flatten(self.observations)
+        np.take(observations, flat, axis=0, out=batch.observations.numpy(), mode="clip")
+        next_observations = batch.next_observations.numpy()
+        np.take(observations, next_flat, axis=0, out=next_observations, mode="clip")
+        for i in np.flatnonzero(self.has_final_observation[rows, envs]):
+            next_observations[i] = self.final_observations[(rows[i], envs[i])]
+        np.take(
+            flatten(self.actions), flat, axis=0, out=batch.actions.numpy(), mode="clip"
+        )
+        np.take(
+            self.dones.reshape(-1),
+            flat,
+            out=batch.dones.numpy().reshape(-1),
+            mode="clip",
+        )
+        np.take(
+            self.rewards.reshape(-1),
+            flat,
+            out=batch.rewards.numpy().reshape(-1),
+            mode="clip",
+        )
+        np.take(
+            self.discounts.reshape(-1),
+            flat,
+            out=batch.discounts.numpy().reshape(-1),
+            mode="clip",
+        )
+
+        return ReplayBufferSamples(
+            *(tensor.to(self.device, non_blocking=True) for tensor in batch)
+        )
+
+
+class MemmapReplayBuffer(ReplayBuffer):
+    def __init__(
+        self,
+        buffer_size: int,
+        observation_space: spaces.Space,
+        action_space: spaces.Space,
+        directory: str,
+        device: torch.device = "cpu",
+        n_envs: int = 1,
+    ):
+        """
+        `ReplayBuffer` whose storage lives in `np.memmap` files under `directory`, so
+            large buffers are backed by the page cache instead of the job's anonymous
+            memory.
+        The files are scratch space for one run: they are created empty, whatever
+            `directory` held before, and `close` removes them. A run resumes its buffer
+            from its checkpoint, `directory` should be its own (e.g. named after it).
+        Mini-batches are gathered in sorted order, so reads walk the files forwards.
+        """
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        super(MemmapReplayBuffer, self).__init__(
+            buffer_size, observation_space, action_space, device, n_envs
+        )
+
+    def _allocate(self, name: str, shape: Tuple[int, ...], dtype) -> np.ndarray:
+        path = os.path.join(self.directory, f"{name}.npy")
+        return np.lib.format.open_memmap(path, mode="w+", dtype=dtype, shape=shape)
+
+    def close(self):
+        """Removes the files, the buffer can't be used afterwards."""
+        for name in ("observations", "actions", "rewards", "dones", "discounts"):
+            os.remove(os.path.join(self.directory, f"{name}.npy"))
+        if not os.listdir(self.directory):
+            os.rmdir(self.directory)
+
+    def sample(self, batch_size: int) -> ReplayBufferSamples:
+        rows, envs = self._sample_indices(batch_size)
+        order = np.argsort(rows * self.n_envs + envs)
+        return self._gather(rows[order], envs[order])
+
+
+class ReplayBufferLog:
+    def __init__(self, buffer: ReplayBuffer, run_id: str):
+        """
+        Checkpoints `buffer` incrementally, as files of the rows that changed between
+            two checkpoints, so a checkpoint only copies what was added since the
+            previous one instead of the whole buffer.
+        `checkpoint` returns the state to save with the checkpoint, the new file and
+            the files it no longer needs, whose rows have all been written again since.
+        `restore` replays the files of a saved state into `buffer`, after checking they
+            are for a buffer like it and were written by the run `run_id`.
+        """
+        self.buffer = buffer
+        self.run_id = run_id
+        # (filename, start, end), `end` is `buffer.num_added` when it was written.
+        self.files: List[Tuple[str, int, int]] = []
+        self._num_added = 0
+
+    def checkpoint(self) -> Tuple[dict, Dict[str, dict], List[str]]:
+        start, end = self._num_added, self.buffer.num_added
+        new_files = {}
+        if end > start:
+            filename = f"replay_buffer-{start}-{end}.npz"
+            new_files[filename] = dict(
+                self.buffer.changes_since(start), run_id=np.array(self.run_id)
+            )
+            self.files.append((filename, start, end))
+        # The later files hold the rows from the one before this file's end to the
+        # current one, once those are all of them it isn't needed.
+        stale_files = [
+            filename
+            for filename, _, file_end in self.files
+            if file_end < end and end - file_end + 2 >= self.buffer.buffer_size
+        ]
+        self.files = [file for file in self.files if file[0] not in stale_files]
+        self._num_added = end
+        state = {
+            "spec": self.buffer.spec(),
+            "run_id": self.run_id,
+            "files": list(self.files),
+            "num_added": end,
+        }
+        return state, new_files, stale_files
+
+    def restore(self, state: dict, directory: str):
+        if state["spec"] != self.buffer.spec():
+            raise ValueError(
+                f"the replay buffer state is for {state['spec']}, "
+                f"not {self.buffer.spec()}"
+            )
+        if state["run_id"] != self.run_id:
+            raise ValueError(
+                f"the replay buffer state is of run {state['run_id']}, "
+                f"not {self.run_id}"
+            )
+        for filename, _, _ in state["files"]:
+            path = os.path.join(directory, filename)
+            with np.load(path) as changes:
+                if str(changes["run_id"]) != self.run_id:
+                    raise ValueError(f"{path} was written by run {changes['run_id']}")
+                self.buffer.apply_changes(changes)
+        self.files = list(state["files"])
+        self._num_added = state["num_added"]
@@ -0,0 +1,103 @@
+import hashlib
+import json
+import os
+import shlex
+import subprocess
+from typing import Optional
+
+import tyro
+
+# Args that only say where outputs go or how often state is saved, not what is run,
+# and the code revision, which is keyed on its own.
+IGNORED_FIELDS = (
+    "exp_name",
+    "track",
+    "wandb_project_name",
+    "wandb_entity",
+    "buffer_dir",
+    "checkpoint_dir",
+    "checkpoint_frequency",
+    "run_log",
+    "result_cache",
+    "code_revision",
+)
+
+
+def code_revision(directory: str = None) -> str:
+    """
+    The git commit checked out in `directory`, with a hash of the uncommitted changes
+        under `src/` appended if there are any: the diff of tracked files and the
+        paths and contents of untracked ones that aren't ignored. Changes elsewhere,
+        e.g. to notebooks, don't change what a run does.
+    """
+
+    def git(*args):
+        return subprocess.run(
+            ["git", *args], cwd=directory, capture_output=True, check=True
+        ).stdout
+
+    try:
+        revision = git("rev-parse", "HEAD").decode().strip()
+        top = git("rev-parse", "--show-toplevel").decode().strip()
+        diff = git("diff", "HEAD", "--", ":/src")
+        # Relative to `top` wherever this runs, NUL-separated
+        untracked = git(
+            "ls-files", "--others", "--exclude-standard", "--full-name", "-z"
+        ).split(b"\0")
+        untracked = sorted(path for path in untracked if path.startswith(b"src/"))
+        changes = hashlib.sha256(diff)
+        for path in untracked:
+            with open(os.path.join(top, os.fsdecode(path)), "rb") as f:
+                changes.update(b"\0" + path + b"\0" + f.read())
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+    if diff or untracked:
+        revision += "+" + changes.hexdigest()[:12]
+    return revision
+
+
+def resolve_args(args_class, command_line: str) -> dict:
+    """The fields of `args_class` parsed from `command_line`, defaults filled in."""
+    return vars(tyro.cli(args_class, args=shlex.split(command_line)))
+
+
+def config_key(args: dict, revision: str) -> str:
+    """Hash of `args`, minus `IGNORED_FIELDS`, and the code `revision`."""
+    config = {key: value for key, value in args.items() if key not in IGNORED_FIELDS}
+    canonical = json.dumps(
+        {"args": config, "revision": revision},
+        sort_keys=True,
+        separators=(",", ":"),
+        default=str,
+    )
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+
+class ResultCache:
+    def __init__(self, directory: str):
+        """
+        Pointers to the outputs of finished runs, one JSON file per `config_key` in
+            `directory`. Runs add their own entry when they finish, so only runs
+            that completed are ever found.
+        """
+        self.directory = directory
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.json")
+
+    def __contains__(self, key: str) -> bool:
+        return os.path.exists(self._path(key))
+
+    def get(self, key: str) -> Optional[dict]:
+        if key not in self:
+            return None
+        with open(self._path(key)) as f:
+            return json.load(f)
+
+    def put(self, key: str, entry: dict):
+        os.makedirs(self.directory, exist_ok=True)
+        path = self._path(key)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(entry, f, default=str)
+        os.replace(tmp_path, path)
@@ -0,0 +1,488 @@
+import multiprocessing
+import pickle
+import platform
+from contextlib import nullcontext
+from multiprocessing import shared_memory
+from typing import Any, Tuple
+
+import numpy as np
+from loguru import logger
+
+# head and tail live on separate cache lines so the producer and consumer
+# never write to the same line.
+_HEAD_OFFSET = 0
+_DROPPED_OFFSET = 8
+_TAIL_OFFSET = 64
+_HEADER_NBYTES = 128
+
+# The lock-free paths publish a record by storing a counter after the record's bytes,
+# which only works if the other process sees the stores in that order. x86 guarantees
+# it (total store order), weakly ordered CPUs like ARM (e.g. Apple silicon) don't, so
+# there a lock, whose acquire and release are memory barriers, orders the accesses.
+STRONGLY_ORDERED = platform.machine().lower() in (
+    "x86_64",
+    "amd64",
+    "i386",
+    "i686",
+)
+
+
+def _ordering_lock():
+    return None if STRONGLY_ORDERED else multiprocessing.Lock()
+
+
+def space_dtype(space) -> Tuple[np.dtype, Tuple[int, ...]]:
+    """Returns the fixed (dtype, shape) used to store a sample of `space`."""
+    if getattr(space, "dtype", None) is None or getattr(space, "shape", None) is None:
+        raise ValueError(
+            f"{space} has no fixed dtype and shape, it cannot be stored in a shared memory slot"
+        )
+    return np.dtype(space.dtype), tuple(space.shape)
+
+
+def transition_dtype(observation_space, info_nbytes: int = 1024) -> np.dtype:
+    """
+    Slot layout for `(observation, reward, terminated, truncated, info, sent_at)`
+        payloads.
+    The info dict is pickled into a fixed number of bytes, and only when it is non-empty.
+        The `sent_at` timestamp has a field of its own, so it never makes it non-empty.
+    """
+    observation_dtype, observation_shape = space_dtype(observation_space)
+    return np.dtype(
+        [
+            ("observation", observation_dtype, observation_shape),
+            ("reward", np.float64),
+            ("terminated", np.bool_),
+            ("truncated", np.bool_),
+            ("sent_at", np.float64),
+            ("info_nbytes", np.uint32),
+            ("info", np.uint8, (info_nbytes,)),
+        ]
+    )
+
+
+def mailbox_transition_dtype(observation_space, info_nbytes: int = 1024) -> np.dtype:
+    """
+    Slot layout of `TransitionMailbox`: the latest transition, with the running reward
+        and episode count instead of the step's reward and the time it was sent, and
+        the end of the latest episode.
+    """
+    observation_dtype, observation_shape = space_dtype(observation_space)
+    return np.dtype(
+        [
+            ("observation", observation_dtype, observation_shape),
+            ("cumulative_reward", np.float64),
+            ("episode", np.uint64),
+            ("terminated", np.bool_),
+            ("truncated", np.bool_),
+            ("sent_at", np.float64),
+            ("info_nbytes", np.uint32),
+            ("info", np.uint8, (info_nbytes,)),
+            ("final_observation", observation_dtype, observation_shape),
+            ("final_cumulative_reward", np.float64),
+            ("final_terminated", np.bool_),
+            ("final_truncated", np.bool_),
+            ("final_info_nbytes", np.uint32),
+            ("final_info", np.uint8, (info_nbytes,)),
+        ]
+    )
+
+
+def action_dtype(action_space) -> np.dtype:
+    dtype, shape = space_dtype(action_space)
+    return np.dtype([("action", dtype, shape)])
+
+
+class SharedMemoryRing:
+    """
+    Lock-free single-producer/single-consumer ring of fixed-size records backed by
+        `multiprocessing.shared_memory`.
+    The producer only ever writes `head`, the consumer only ever writes `tail`, and a
+        record is published by bumping `head` after its slot has been filled.
+    It mimics the subset of the `list` interface used by the transport functions in
+        `multiprocess_asyncmdp`, so `append`, `pop(0)` (oldest) and `pop()` (newest)
+        become index arithmetic instead of manager round-trips.
+    Taking the newest record also discards everything older than it, the consumer
+        cannot leave holes behind in a ring.
+    When the ring is full the new record is dropped and counted in `dropped`. With
+        `overwrite` it replaces the oldest record instead, which is counted, so a
+        consumer taking the newest record always gets the latest one published. Its
+        reads then check that the producer didn't lap the slot they copied.
+    Lock-free only where stores are seen in program order (x86, see
+        `STRONGLY_ORDERED`), elsewhere `append` and `pop` take a shared lock.
+    """
+
+    def __init__(self, dtype: np.dtype, capacity: int = 1024, overwrite: bool = False):
+        assert capacity > 0, "capacity must be positive"
+        self.dtype = np.dtype(dtype)
+        self.capacity = capacity
+        self.overwrite = overwrite
+        self._lock = _ordering_lock()
+        self._shm = shared_memory.SharedMemory(
+            create=True, size=_HEADER_NBYTES + capacity * self.dtype.itemsize
+        )
+        self._owner = True
+        self._attach()
+        self._head[0] = 0
+        self._tail[0] = 0
+        self._dropped[0] = 0
+
+    def _attach(self):
+        buf = self._shm.buf
+        self._head = np.ndarray((1,), dtype=np.uint64, buffer=buf, offset=_HEAD_OFFSET)
+        self._dropped = np.ndarray(
+            (1,), dtype=np.uint64, buffer=buf, offset=_DROPPED_OFFSET
+        )
+        self._tail = np.ndarray((1,), dtype=np.uint64, buffer=buf, offset=_TAIL_OFFSET)
+        self._records = np.ndarray(
+            (self.capacity,), dtype=self.dtype, buffer=buf, offset=_HEADER_NBYTES
+        )
+
+    def __getstate__(self):
+        return {
+            "name": self._shm.name,
+            "dtype": self.dtype,
+            "capacity": self.capacity,
+            "overwrite": self.overwrite,
+            "lock": self._lock,
+        }
+
+    def __setstate__(self, state):
+        self.dtype = state["dtype"]
+        self.capacity = state["capacity"]
+        self.overwrite = state["overwrite"]
+        self._lock = state["lock"]
+        # Child processes share the creator's resource tracker, only the creator unlinks.
+        self._shm = shared_memory.SharedMemory(name=state["name"])
+        self._owner = False
+        self._attach()
+
+    @property
+    def dropped(self) -> int:
+        return int(self._dropped[0])
+
+    @property
+    def appended(self) -> int:
+        """The number of records published since the ring was created."""
+        return int(self._head[0])
+
+    def __len__(self) -> int:
+        return min(int(self._head[0]) - int(self._tail[0]), self.capacity)
+
+    def append(self, item: Any):
+        with self._lock or nullcontext():
+            head = int(self._head[0])
+            if head - int(self._tail[0]) >= self.capacity:
+                self._dropped[0] += 1
+                if not self.overwrite:
+                    return
+            self._encode(self._records[head % self.capacity], item)
+            self._head[0] = head + 1
+
+    def pop(self, index: int = -1) -> Any:
+        if index not in (0, -1):
+            raise IndexError("a ring can only pop its oldest (0) or newest (-1) item")
+        with self._lock or nullcontext():
+            return self._pop(index)
+
+    def _pop(self, index: int) -> Any:
+        while True:
+            tail = int(self._tail[0])
+            head = int(self._head[0])
+            if head == tail:
+                raise IndexError("pop from empty ring")
+
+            if index == -1:
+                position = head - 1
+            elif self.overwrite:
+                # The records the producer lapped are gone, and the oldest slot may be
+                # the one it is writing.
+                position = max(tail, head - self.capacity + 1)
+            else:
+                position = tail
+            item = self._decode(self._records[position % self.capacity])
+            # The slot is only written again for record `position + capacity`.
+            if not self.overwrite or int(self._head[0]) < position + self.capacity:
+                break
+
+        self._tail[0] = position + 1 if index == 0 else head
+        return item
+
+    def _encode(self, record: np.void, item: Any):
+        # A record can't be assigned a tuple as a whole, only field by field.
+        for name, value in zip(record.dtype.names, item):
+            record[name] = value
+
+    def _decode(self, record: np.void) -> Any:
+        return record.copy()
+
+    def close(self):
+        self._head = self._tail = self._dropped = self._records = None
+        self._shm.close()
+        if self._owner:
+            self._shm.unlink()
+
+
+class ActionRing(SharedMemoryRing):
+    def __init__(self, action_space, capacity: int = 1024):
+        super(ActionRing, self).__init__(action_dtype(action_space), capacity)
+
+    def _encode(self, record, action):
+        record["action"] = action
+
+    def _decode(self, record):
+        action = record["action"]
+        return action.item() if action.ndim == 0 else action.copy()
+
+
+class TransitionRing(SharedMemoryRing):
+    def __init__(
+        self,
+        observation_space,
+        capacity: int = 1024,
+        info_nbytes: int = 1024,
+        overwrite: bool = False,
+    ):
+        super(TransitionRing, self).__init__(
+            transition_dtype(observation_space, info_nbytes), capacity, overwrite
+        )
+
+    def _encode(self, record, item):
+        observation, reward, terminated, truncated, info, sent_at = item
+        record["observation"] = observation
+        record["reward"] = reward
+        record["terminated"] = terminated
+        record["truncated"] = truncated
+        record["sent_at"] = sent_at
+        _encode_info(record, "info", info)
+
+    def _decode(self, record):
+        return (
+            record["observation"].copy(),
+            float(record["reward"]),
+            bool(record["terminated"]),
+            bool(record["truncated"]),
+            _decode_info(record, "info"),
+            float(record["sent_at"]),
+        )
+
+
+def _encode_info(record: np.void, field: str, info: dict):
+    """Pickles `info` into the `field` bytes of `record`, only when it is non-empty."""
+    if not info:
+        record[f"{field}_nbytes"] = 0
+        return
+
+    blob = pickle.dumps(info, protocol=pickle.HIGHEST_PROTOCOL)
+    if len(blob) > record[field].shape[0]:
+        logger.warning(
+            f"Dropping info of {len(blob)} bytes, the slot only holds {record[field].shape[0]}"
+        )
+        record[f"{field}_nbytes"] = 0
+        return
+    record[field][: len(blob)] = np.frombuffer(blob, dtype=np.uint8)
+    record[f"{field}_nbytes"] = len(blob)
+
+
+def _decode_info(record: np.void, field: str) -> dict:
+    nbytes = int(record[f"{field}_nbytes"])
+    return pickle.loads(record[field][:nbytes].tobytes()) if nbytes else {}
+
+
+class SharedMemoryMailbox:
+    """
+    Single-slot, latest-value channel between one writer and one reader, backed by
+        `multiprocessing.shared_memory`.
+    `put` overwrites the slot instead of queueing, so `get` always returns the newest
+        item and never a backlog.
+    The slot is guarded by a sequence lock: the writer makes the sequence number odd
+        while it writes and even again once the item is published, the reader retries
+        when the number is odd or changed during its copy. Neither side ever blocks
+        the other where stores are seen in program order (x86, see
+        `STRONGLY_ORDERED`), elsewhere `put` and `get` take a shared lock.
+    The reader counts the items that were overwritten before it got to them in
+        `overwritten`.
+    """
+
+    def __init__(self, dtype: np.dtype):
+        self.dtype = np.dtype(dtype)
+        self._lock = _ordering_lock()
+        self._shm = shared_memory.SharedMemory(
+            create=True, size=_HEADER_NBYTES + self.dtype.itemsize
+        )
+        self._owner = True
+        self._attach()
+        self._sequence[0] = 0
+        self._read_sequence = 0
+        self.overwritten = 0
+
+    def _attach(self):
+        buf = self._shm.buf
+        self._sequence = np.ndarray(
+            (1,), dtype=np.uint64, buffer=buf, offset=_HEAD_OFFSET
+        )
+        self._record = np.ndarray(
+            (1,), dtype=self.dtype, buffer=buf, offset=_HEADER_NBYTES
+        )
+
+    def __getstate__(self):
+        return {"name": self._shm.name, "dtype": self.dtype, "lock": self._lock}
+
+    def __setstate__(self, state):
+        self.dtype = state["dtype"]
+        self._lock = state["lock"]
+        # Child processes share the creator's resource tracker, only the creator unlinks.
+        self._shm = shared_memory.SharedMemory(name=state["name"])
+        self._owner = False
+        self._attach()
+        self._read_sequence = 0
+        self.overwritten = 0
+
+    @property
+    def published(self) -> int:
+        """The number of items written since the mailbox was created."""
+        return (int(self._sequence[0]) & ~1) // 2
+
+    def __len__(self) -> int:
+        """1 if an item was published since the last `get`, else 0."""
+        return int((int(self._sequence[0]) & ~1) > self._read_sequence)
+
+    def put(self, item: Any):
+        with self._lock or nullcontext():
+            sequence = int(self._sequence[0])
+            self._sequence[0] = sequence + 1
+            self._encode(self._record[0], item)
+            self._sequence[0] = sequence + 2
+
+    def get(self) -> Any:
+        while True:
+            with self._lock or nullcontext():
+                sequence = int(self._sequence[0])
+                if sequence & 1:
+                    continue
+                if sequence == self._read_sequence:
+                    raise IndexError("get from a mailbox without a new item")
+                record = self._record[0].copy()
+                if int(self._sequence[0]) == sequence:
+                    break
+
+        self.overwritten += (sequence - self._read_sequence) // 2 - 1
+        self._read_sequence = sequence
+        return self._decode(record)
+
+    def _encode(self, record: np.void, item: Any):
+        # A record can't be assigned a tuple as a whole, only field by field.
+        for name, value in zip(record.dtype.names, item):
+            record[name] = value
+
+    def _decode(self, record: np.void) -> Any:
+        return record
+
+    def close(self):
+        self._sequence = self._record = None
+        self._shm.close()
+        if self._owner:
+            self._shm.unlink()
+
+
+class TransitionMailbox(SharedMemoryMailbox):
+    """
+    Latest-value channel for `(observation, reward, terminated, truncated, info,
+        sent_at)` payloads, which loses observations the agent was too slow to read but
+        not rewards or episode ends. `sent_at` is a timestamp kept in a fixed field, so
+        it doesn't make an otherwise empty info pickled.
+    The writer publishes its running reward instead of the step's, so the reward `get`
+        returns is the sum over every transition since the previous `get`. `get` also
+        returns the episode's reward so far after the transition:
+        `(observation, reward, terminated, truncated, info, sent_at, episode_reward)`.
+    The end of the latest episode stays in the slot: when the agent only sees the
+        reset of the next episode, `get` still reports it as terminated or truncated,
+        with the ended episode's last observation and info in
+        `info["final_observation"]` and `info["final_info"]` as gymnasium's vector
+        environments do.
+    Rewards of the next episode are held back until the following `get`, so the ended
+        episode's transition only carries its own rewards.
+    Episode ends that were overwritten by a later one are counted in `dropped`, their
+        rewards are summed into the next episode the agent sees end.
+    The infos of overwritten transitions are lost.
+    """
+
+    def __init__(self, observation_space, info_nbytes: int = 1024):
+        super(TransitionMailbox, self).__init__(
+            mailbox_transition_dtype(observation_space, info_nbytes)
+        )
+        self._reset_state()
+
+    def __setstate__(self, state):
+        super(TransitionMailbox, self).__setstate__(state)
+        self._reset_state()
+
+    def _reset_state(self):
+        # writer side
+        self._cumulative_reward = 0.0
+        self._episode = 0
+        self._episode_ended = False
+        # reader side
+        self._read_cumulative_reward = 0.0
+        self._read_episode_start_reward = 0.0
+        self._read_episode = 0
+        self.dropped = 0
+
+    def _encode(self, record, item):
+        observation, reward, terminated, truncated, info, sent_at = item
+        if self._episode_ended:
+            self._episode += 1
+            self._episode_ended = False
+        self._cumulative_reward += reward
+
+        record["observation"] = observation
+        record["cumulative_reward"] = self._cumulative_reward
+        record["episode"] = self._episode
+        record["terminated"] = terminated
+        record["truncated"] = truncated
+        record["sent_at"] = sent_at
+        _encode_info(record, "info", info)
+        if terminated or truncated:
+            self._episode_ended = True
+            record["final_observation"] = observation
+            record["final_cumulative_reward"] = self._cumulative_reward
+            record["final_terminated"] = terminated
+            record["final_truncated"] = truncated
+            _encode_info(record, "final_info", info)
+
+    def _decode(self, record):
+        cumulative_reward = float(record["cumulative_reward"])
+        info = _decode_info(record, "info")
+        terminated = bool(record["terminated"])
+        truncated = bool(record["truncated"])
+        episode = int(record["episode"])
+        # The episode following the last one the agent saw end
+        next_episode = episode + 1 if terminated or truncated else episode
+
+        if episode > self._read_episode and (terminated or truncated):
+            # Only the end of the latest episode is kept.
+            self.dropped += episode - self._read_episode
+        elif episode > self._read_episode:
+            # The episode the agent was in ended without it seeing the last transition.
+            self.dropped += episode - self._read_episode - 1
+            terminated = bool(record["final_terminated"])
+            truncated = bool(record["final_truncated"])
+            info["final_observation"] = record["final_observation"].copy()
+            info["final_info"] = _decode_info(record, "final_info")
+            cumulative_reward = float(record["final_cumulative_reward"])
+        self._read_episode = next_episode
+
+        reward = cumulative_reward - self._read_cumulative_reward
+        self._read_cumulative_reward = cumulative_reward
+        episode_reward = cumulative_reward - self._read_episode_start_reward
+        if terminated or truncated:
+            self._read_episode_start_reward = cumulative_reward
+        return (
+            record["observation"].copy(),
+            reward,
+            terminated,
+            truncated,
+            info,
+            float(record["sent_at"]),
+            episode_reward,
+        )
@@ -1,7 +1,13 @@
 import math
 import time
+from copy import deepcopy
 from typing import Any, Dict, List, Tuple, TypeVar
 import gymnasium as gym
+import numpy as np
+
+from aggregators import SumRewards
+from clocks import MonotonicClock
+from latency import LatencyRecorder
 
 ObsType = TypeVar("ObsType")
 ActType = TypeVar("ActType")
@@ -31,8 +37,79 @@ def compute_num_repeated_actions(
     return max(0, math.floor(ratio)), ratio
 
 
+def compute_num_repeated_actions_batch(
+    environment_steps_per_second: np.ndarray, agent_response_time: float
+) -> Tuple[np.ndarray, np.ndarray]:
+    """`compute_num_repeated_actions` for many environment rates in one NumPy pass."""
+    ratio = np.asarray(environment_steps_per_second, dtype=np.float64) * (
+        agent_response_time
+    )
+    rounded_ratio = np.round(ratio)
+    on_rate = np.abs(ratio - rounded_ratio) <= 0.001 * np.maximum(
+        np.abs(ratio), np.abs(rounded_ratio)
+    )
+    num_repeat_actions = np.where(on_rate, rounded_ratio - 1, np.floor(ratio))
+    return np.maximum(0, num_repeat_actions).astype(np.int64), ratio
+
+
+def fast_forward(env: gym.Env, action, num_steps: int):
+    """
+    Plays `action` up to `num_steps` times, stopping early at the end of an episode.
+    Only the running reward sum and the last step are kept, no per-step lists or infos.
+    Environments (or the outermost wrapper) can provide a native
+        `step_n(action, n) -> (observation, total_reward, terminated, truncated, info, num_steps_taken)`
+        which is used instead of the Python loop.
+    Returns `(observation, total_reward, terminated, truncated, info, num_steps_taken)`.
+    """
+    # Looked up on the class, so a `step_n` hidden deeper in the wrapper stack can't
+    # silently bypass the wrappers in front of it.
+    if hasattr(type(env), "step_n"):
+        return env.step_n(action, num_steps)
+
+    total_reward = 0.0
+    for i in range(num_steps):
+        observation, reward, terminated, truncated, info = env.step(action)
+        total_reward += reward
+        if terminated or truncated:
+            return observation, total_reward, terminated, truncated, info, i + 1
+    return observation, total_reward, terminated, truncated, info, num_steps
+
+
+def catch_up(env: gym.Env, action, num_steps: int, aggregator):
+    """
+    Plays `action` up to `num_steps` times into `aggregator`, stopping early at the end of
+        an episode, and fast-forwards when the aggregator only needs the reward sum.
+    Returns `(observation, terminated, truncated, info, num_steps_taken)`.
+    """
+    if aggregator.supports_fast_forward:
+        (
+            observation,
+            total_reward,
+            terminated,
+            truncated,
+            info,
+            num_steps_taken,
+        ) = fast_forward(env, action, num_steps)
+        aggregator.add_fast_forward(observation, total_reward, num_steps_taken)
+        return observation, terminated, truncated, info, num_steps_taken
+
+    for i in range(num_steps):
+        observation, reward, terminated, truncated, info = env.step(action)
+        aggregator.add(observation, reward)
+        if terminated or truncated:
+            return observation, terminated, truncated, info, i + 1
+    return observation, terminated, truncated, info, num_steps
+
+
 class AsynchronousGym(gym.Wrapper):
-    def __init__(self, env: gym.Env, environment_steps_per_second: int = 2):
+    def __init__(
+        self,
+        env: gym.Env,
+        environment_steps_per_second: int = 2,
+        clock=None,
+        aggregator=None,
+        record_latency: bool = False,
+    ):
         """
         Async Wrapper simulates the _asynchronous problem setting_ where the rate
             at which the agent and environment interact is different.
@@ -42,19 +119,47 @@ class AsynchronousGym(gym.Wrapper):
         If the agent is fast, the environment will play the agent's action preference.
         If at any point the episode is terminated or truncated, the environment will
             return immediately with the accumulated reward and episode statistics.
+        The response time is measured with `clock`, wall-clock time by default, see
+            `clocks` for virtual clocks that don't depend on the host's speed.
+        How the repeated steps are summarised for the agent is up to `aggregator`, the
+            last observation and summed reward by default, see `aggregators`.
+        With `record_latency`, the agent's response time (`inference`), the catch-up,
+            the agent's own env step and the number of repeated actions are recorded in
+            histograms, and the last step of each episode carries their percentiles in
+            `info["latency"]`.
         """
         super(AsynchronousGym, self).__init__(env)
         self._environment_steps_per_second = environment_steps_per_second
+        self.clock = clock if clock is not None else MonotonicClock()
+        self.aggregator = aggregator if aggregator is not None else SumRewards()
+        self.latency = LatencyRecorder() if record_latency else None
 
         self._seconds_since_last_action = None
         self._roundtrip_start_time = None
         self._last_action = None
 
+    def state_dict(self) -> dict:
+        """
+        The timing state: the data rate and the clock's, if it keeps any.
+        The round trip in flight isn't part of it, the env is reset after loading.
+        """
+        state = {"environment_steps_per_second": self._environment_steps_per_second}
+        if hasattr(self.clock, "state_dict"):
+            state["clock"] = self.clock.state_dict()
+        return state
+
+    def load_state_dict(self, state: dict):
+        self._environment_steps_per_second = state["environment_steps_per_second"]
+        if "clock" in state:
+            self.clock.load_state_dict(state["clock"])
+
     def reset(
         self, environment_steps_per_second: int = None, **kwargs
     ) -> Tuple[ObsType, dict]:
         self._roundtrip_start_time = None
         self._last_action = None
+        if self.latency is not None:
+            self.latency.reset()
         if environment_steps_per_second is not None:
             self._environment_steps_per_second = environment_steps_per_second
 
@@ -77,51 +182,224 @@ class AsynchronousGym(gym.Wrapper):
             num_repeat_actions = 0
             ratio = 0
         else:
-            agent_response_time = time.monotonic() - self._roundtrip_start_time
+            agent_response_time = self.clock.elapsed(self._roundtrip_start_time)
             num_repeat_actions, ratio = compute_num_repeated_actions(
                 self._environment_steps_per_second, agent_response_time
             )
 
-        observations = []
-        rewards = []
-        infos = []
-        for i in range(num_repeat_actions):
-            observation, reward, truncated, terminated, info = self.env.step(action)
-            observations.append(observation)
-            rewards.append(reward)
-            info.update(
-                {
-                    "num_repeat_actions": i + 1,
-                    "agent_response_time": agent_response_time,
-                    "ratio": ratio,
-                }
+        if self.latency is not None and self._roundtrip_start_time is not None:
+            self.latency.record("inference", agent_response_time)
+
+        self.aggregator.begin()
+        if num_repeat_actions > 0:
+            catch_up_start_time = time.perf_counter()
+            observation, terminated, truncated, info, num_steps_taken = catch_up(
+                self.env, action, num_repeat_actions, self.aggregator
             )
-            infos.append(info)
+            if self.latency is not None:
+                self.latency.record(
+                    "catch_up", time.perf_counter() - catch_up_start_time
+                )
 
             if terminated or truncated:
-                self._roundtrip_start_time = time.monotonic()
-                return accumulate_rewards_and_pick_last_obs(
-                    observations, rewards, truncated, terminated, infos
+                info.update(
+                    {
+                        "num_repeat_actions": num_steps_taken,
+                        "num_steps": num_steps_taken,
+                        "agent_response_time": agent_response_time,
+                        "ratio": ratio,
+                    }
+                )
+                self.aggregator.update_info(info)
+                if self.latency is not None:
+                    self.latency.record("repeats", num_steps_taken)
+                    info["latency"] = self.latency.summary()
+                self._roundtrip_start_time = self.clock.mark()
+                return (
+                    observation,
+                    self.aggregator.reward(),
+                    terminated,
+                    truncated,
+                    info,
                 )
 
         # Once the environment is caught up, the agent's new action will be played.
-        observation, reward, truncated, terminated, info = self.env.step(action)
-        observations.append(observation)
-        rewards.append(reward)
+        step_start_time = time.perf_counter()
+        observation, reward, terminated, truncated, info = self.env.step(action)
+        if self.latency is not None:
+            self.latency.record("env_step", time.perf_counter() - step_start_time)
+        self.aggregator.add(observation, reward)
         info.update(
             {
                 "num_repeat_actions": num_repeat_actions,
+                "num_steps": num_repeat_actions + 1,
                 "agent_response_time": agent_response_time,
                 "ratio": ratio,
             }
         )
-        infos.append(info)
+        self.aggregator.update_info(info)
+        if self.latency is not None:
+            self.latency.record("repeats", num_repeat_actions)
+            if terminated or truncated:
+                info["latency"] = self.latency.summary()
         self._last_action = action
 
         # Start measuring the agent's response time.
-        self._roundtrip_start_time = time.monotonic()
-        return accumulate_rewards_and_pick_last_obs(
-            observations, rewards, truncated, terminated, infos
+        self._roundtrip_start_time = self.clock.mark()
+        return (observation, self.aggregator.reward(), terminated, truncated, info)
+
+
+class AsynchronousVectorGym(gym.vector.SyncVectorEnv):
+    def __init__(
+        self,
+        env_fns,
+        environment_steps_per_second=2,
+        clock=None,
+        aggregator_fn=None,
+        record_latency: bool = False,
+        **kwargs,
+    ):
+        """
+        Vector version of `AsynchronousGym`.
+        All sub-environments share one wall-clock: the agent's response time is measured
+            once per batch and every sub-environment repeats the agent's action
+            according to its own rate, which may be a scalar or one rate per env.
+        The response time is measured with `clock`, as in `AsynchronousGym`.
+        `aggregator_fn(env)` builds each sub-environment's aggregator, summed rewards by
+            default.
+        Observations, rewards and flags come back stacked, the `num_repeat_actions`,
+            `num_steps`, `agent_response_time` and `ratio` infos come back as arrays.
+            `num_steps` is the number of env steps behind each transition, the repeats
+            plus the agent's own step unless the episode ended before it.
+        With `record_latency`, each sub-environment keeps latency histograms as in
+            `AsynchronousGym`, reported in its `final_info["latency"]`.
+        """
+        super(AsynchronousVectorGym, self).__init__(env_fns, **kwargs)
+        self._environment_steps_per_second = np.broadcast_to(
+            np.asarray(environment_steps_per_second, dtype=np.float64),
+            (self.num_envs,),
+        ).copy()
+        self.clock = clock if clock is not None else MonotonicClock()
+        self.aggregators = [
+            aggregator_fn(env) if aggregator_fn is not None else SumRewards()
+            for env in self.envs
+        ]
+        self.latencies = (
+            [LatencyRecorder() for _ in self.envs] if record_latency else None
+        )
+        self._roundtrip_start_time = None
+
+    def state_dict(self) -> dict:
+        """See `AsynchronousGym.state_dict`."""
+        state = {"environment_steps_per_second": self._environment_steps_per_second}
+        if hasattr(self.clock, "state_dict"):
+            state["clock"] = self.clock.state_dict()
+        return state
+
+    def load_state_dict(self, state: dict):
+        self._environment_steps_per_second[...] = state["environment_steps_per_second"]
+        if "clock" in state:
+            self.clock.load_state_dict(state["clock"])
+
+    def reset_wait(self, seed=None, options=None):
+        self._roundtrip_start_time = None
+        for latency in self.latencies or ():
+            latency.reset()
+        observations, infos = super(AsynchronousVectorGym, self).reset_wait(
+            seed=seed, options=options
+        )
+        infos.update(
+            {
+                "num_repeat_actions": np.zeros(self.num_envs, dtype=np.int64),
+                "num_steps": np.zeros(self.num_envs, dtype=np.int64),
+                "agent_response_time": np.zeros(self.num_envs),
+            }
+        )
+        return observations, infos
+
+    def step_wait(self):
+        # If the agent is delayed, every environment repeats its action to catch up.
+        if self._roundtrip_start_time is None:
+            agent_response_time = 0
+            num_repeat_actions = np.zeros(self.num_envs, dtype=np.int64)
+            ratio = np.zeros(self.num_envs)
+        else:
+            agent_response_time = self.clock.elapsed(self._roundtrip_start_time)
+            num_repeat_actions, ratio = compute_num_repeated_actions_batch(
+                self._environment_steps_per_second, agent_response_time
+            )
+
+        played_repeat_actions = num_repeat_actions.copy()
+        num_steps = np.zeros(self.num_envs, dtype=np.int64)
+        observations, infos = [], {}
+        for i, (env, action) in enumerate(zip(self.envs, self._actions)):
+            aggregator = self.aggregators[i]
+            latency = self.latencies[i] if self.latencies is not None else None
+            if latency is not None and self._roundtrip_start_time is not None:
+                latency.record("inference", agent_response_time)
+            aggregator.begin()
+            terminated, truncated = False, False
+            if num_repeat_actions[i] > 0:
+                catch_up_start_time = time.perf_counter()
+                (
+                    observation,
+                    terminated,
+                    truncated,
+                    info,
+                    played_repeat_actions[i],
+                ) = catch_up(env, action, num_repeat_actions[i], aggregator)
+                if latency is not None:
+                    latency.record(
+                        "catch_up", time.perf_counter() - catch_up_start_time
+                    )
+
+            if not (terminated or truncated):
+                # Once the environment is caught up, the agent's new action is played.
+                step_start_time = time.perf_counter()
+                observation, reward, terminated, truncated, info = env.step(action)
+                if latency is not None:
+                    latency.record("env_step", time.perf_counter() - step_start_time)
+                aggregator.add(observation, reward)
+                num_steps[i] = 1
+            num_steps[i] += played_repeat_actions[i]
+            aggregator.update_info(info)
+            if latency is not None:
+                latency.record("repeats", played_repeat_actions[i])
+                if terminated or truncated:
+                    info["latency"] = latency.summary()
+
+            self._rewards[i] = aggregator.reward()
+            self._terminateds[i] = terminated
+            self._truncateds[i] = truncated
+
+            if terminated or truncated:
+                old_observation, old_info = observation, info
+                observation, info = env.reset()
+                info["final_observation"] = old_observation
+                info["final_info"] = old_info
+            observations.append(observation)
+            infos = self._add_info(infos, info, i)
+
+        self.observations = gym.vector.utils.concatenate(
+            self.single_observation_space, observations, self.observations
+        )
+        infos.update(
+            {
+                "num_repeat_actions": played_repeat_actions,
+                "num_steps": num_steps,
+                "agent_response_time": np.full(self.num_envs, agent_response_time),
+                "ratio": ratio,
+            }
+        )
+
+        # Start measuring the agent's response time.
+        self._roundtrip_start_time = self.clock.mark()
+        return (
+            deepcopy(self.observations) if self.copy else self.observations,
+            np.copy(self._rewards),
+            np.copy(self._terminateds),
+            np.copy(self._truncateds),
+            infos,
         )
 
 
@@ -186,4 +464,14 @@ if __name__ == "__main__":
         assert (
             num_repeated_actions == expected_repeat_actions
         ), f"A{agent_rate}:E{environment_rate} expected {expected_repeat_actions} but got {num_repeated_actions}"
+
+    agent_rates, environment_rates, expected = map(np.array, zip(*tests))
+    for agent_rate in np.unique(agent_rates):
+        batch = agent_rates == agent_rate
+        num_repeated_actions, ratio = compute_num_repeated_actions_batch(
+            environment_rates[batch], 1 / agent_rate
+        )
+        assert np.array_equal(
+            num_repeated_actions, expected[batch]
+        ), f"A{agent_rate}: expected {expected[batch]} but got {num_repeated_actions}"
     print("Done")
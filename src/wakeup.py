@@ -0,0 +1,156 @@
+import asyncio
+import multiprocessing as mp
+import os
+import select
+import sys
+import time
+from typing import Callable, Optional
+
+WAIT_POLICIES = ("spin", "block", "hybrid")
+
+
+def _inherits_file_descriptors(context=None) -> bool:
+    if context is not None:
+        return context.get_start_method() == "fork"
+    method = mp.get_start_method(allow_none=True)
+    if method is None:
+        method = "fork" if sys.platform.startswith("linux") else "spawn"
+    return method == "fork"
+
+
+class Doorbell:
+    """
+    Cross-process wake-up signal.
+    The producer rings after publishing data, the consumer blocks in `wait` instead of
+        spinning on the buffer.
+    Rings are sticky until the consumer wakes up, so a ring that happens between the
+        consumer checking its buffer and calling `wait` is never lost.
+    Uses `os.eventfd` where available (Linux, forked workers), otherwise a semaphore.
+    Pass the multiprocessing `context` the workers are started from, if not the default.
+    """
+
+    def __init__(self, context=None):
+        self._eventfd = None
+        self._semaphore = None
+        if hasattr(os, "eventfd") and _inherits_file_descriptors(context):
+            self._eventfd = os.eventfd(0, os.EFD_NONBLOCK | os.EFD_CLOEXEC)
+        else:
+            self._semaphore = (context or mp).Semaphore(0)
+
+    def ring(self):
+        if self._eventfd is not None:
+            os.eventfd_write(self._eventfd, 1)
+        else:
+            self._semaphore.release()
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        """Blocks until rung or `timeout` seconds pass, returns whether it was rung."""
+        if self._eventfd is not None:
+            readable, _, _ = select.select([self._eventfd], [], [], timeout)
+            if not readable:
+                return False
+            try:
+                os.eventfd_read(self._eventfd)
+            except BlockingIOError:
+                return False
+            return True
+
+        if not self._semaphore.acquire(timeout=timeout):
+            return False
+        # Collapse rings that piled up while nobody was waiting.
+        while self._semaphore.acquire(block=False):
+            pass
+        return True
+
+    def fileno(self) -> int:
+        if self._eventfd is None:
+            raise OSError("this doorbell is not backed by a file descriptor")
+        return self._eventfd
+
+    def close(self):
+        if self._eventfd is not None:
+            os.close(self._eventfd)
+            self._eventfd = None
+
+
+def wait_until(
+    predicate: Callable[[], bool],
+    doorbell: Optional[Doorbell],
+    deadline: Optional[float] = None,
+    policy: str = "hybrid",
+    spin_budget: float = 50e-6,
+) -> bool:
+    """
+    Waits until `predicate()` holds or `time.monotonic()` passes `deadline`.
+    `spin` busy-waits (lowest latency, burns a core), `block` sleeps on the doorbell,
+        `hybrid` spins for `spin_budget` seconds before falling back to blocking.
+    Returns the final value of `predicate()`.
+    """
+    assert policy in WAIT_POLICIES, f"unknown wait policy {policy}"
+    if predicate():
+        return True
+
+    if policy == "spin" or doorbell is None:
+        while not predicate():
+            if deadline is not None and time.monotonic() >= deadline:
+                return False
+        return True
+
+    if policy == "hybrid":
+        spin_until = time.monotonic() + spin_budget
+        if deadline is not None:
+            spin_until = min(spin_until, deadline)
+        while time.monotonic() < spin_until:
+            if predicate():
+                return True
+
+    while not predicate():
+        if deadline is None:
+            doorbell.wait()
+            continue
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return False
+        doorbell.wait(remaining)
+    return True
+
+
+async def wait_until_async(
+    predicate: Callable[[], bool],
+    doorbell: Optional[Doorbell],
+    poll_interval: float = 100e-6,
+):
+    """
+    `wait_until` for coroutines: the running event loop watches the doorbell's eventfd,
+        so any number of waits share one thread and nothing spins.
+    Doorbells without a file descriptor are polled every `poll_interval` seconds.
+    """
+    if predicate():
+        return
+
+    try:
+        fd = doorbell.fileno() if doorbell is not None else None
+    except OSError:
+        fd = None
+    if fd is None:
+        while not predicate():
+            await asyncio.sleep(poll_interval)
+        return
+
+    loop = asyncio.get_running_loop()
+    ready = loop.create_future()
+
+    def on_ring():
+        try:
+            os.eventfd_read(fd)
+        except BlockingIOError:
+            pass
+        if not ready.done() and predicate():
+            ready.set_result(None)
+
+    # Rings are sticky, one between the check above and here still wakes the reader.
+    loop.add_reader(fd, on_ring)
+    try:
+        await ready
+    finally:
+        loop.remove_reader(fd)